@@ -32,23 +32,176 @@ Convert current time or string date to Unix timestamp
 """
 
 # TODO: When you add a new pip package, don't forget to update setup_work.env.sh
-import sys, os, fnmatch, gzip, re, linecache, json, sqlite3
-from time import time, mktime, strftime
+import sys, os, fnmatch, gzip, re, linecache, json, sqlite3, contextlib, functools, threading
+import importlib.util
+from time import time, mktime, strftime, process_time, thread_time, sleep
+from itertools import islice, count
 from datetime import datetime
-from dateutil import parser
-import pandas as pd
-from sqlalchemy import create_engine
-import matplotlib.pyplot as plt
+import multiprocessing as mp
 
-try:
-    from lxml import etree
-    import pyjq
-    import multiprocessing as mp
-    import jaydebeapi
-    import IPython
-except ImportError:
-    # Above modules are not mandatory
-    pass
+
+class _OnLoadLoader(object):
+    """
+    A loader wrapper which calls a function after the module is executed (used with LazyLoader)
+    """
+
+    def __init__(self, loader, on_load):
+        self.loader = loader
+        self.on_load = on_load
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.loader.exec_module(module)
+        self.on_load(module)
+
+
+def _lazy_import(name, on_load=None):
+    """
+    Import a module lazily: the module is actually loaded when one of its attributes is used first time
+    (so that 'import jn_utils' is fast). Heavy but rarely used modules (matplotlib, jaydebeapi etc.) are imported
+    inside the functions which use them.
+    :param name: Module name
+    :param on_load: (optional) A function object which accepts the module, called when the module is loaded
+    :return: Module object, or None if the module is not installed
+    >>> _lazy_import('not_existing_module') is None
+    True
+    """
+    if name in sys.modules:
+        if on_load is not None:
+            on_load(sys.modules[name])
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader if on_load is None else _OnLoadLoader(spec.loader, on_load))
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def _import_benchmark(module="jn_utils"):
+    """
+    Measure the import time of this script in a new python process, and list heavy modules loaded by the import
+    To guard against regressions of the lazy imports.
+    :param module: Module name to import
+    :return: (seconds, list of heavy modules which were actually loaded)
+    >>> _import_benchmark()[1]    # not asserting the seconds, as it depends on the machine
+    []
+    """
+    import subprocess
+    heavy = ['pandas.core', 'numpy.linalg', 'pyarrow.lib', 'matplotlib', 'sqlalchemy', 'jaydebeapi', 'lxml', 'pyjq',
+             'IPython', 'dateutil']
+    code = "import sys, time; s = time.time(); import %s; e = time.time() - s; print(e); print(','.join(" \
+           "[m for m in %s if m in sys.modules]))" % (module, str(heavy))
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout.splitlines()
+    return (float(out[0]), [m for m in out[1].split(",") if len(m) > 0] if len(out) > 1 else [])
+
+
+def _register_pandas_accessors(pandas_module):
+    """
+    Register the 'ju' Series accessor (see _JuSeriesAccessor) when pandas is loaded
+    :param pandas_module: pandas module object
+    :return: void
+    >>> hasattr(pd.Series, 'ju')
+    True
+    """
+    if hasattr(pandas_module.Series, 'ju') is False:
+        pandas_module.api.extensions.register_series_accessor("ju")(_JuSeriesAccessor)
+
+
+class _JuSeriesAccessor(object):
+    """
+    Vectorized conversions of size/duration strings (eg: health monitor values), used as df['col'].ju.to_bytes()
+    >>> pd.Series(["350MB", "1.5G", "2 KB", "12", "85%", None]).ju.to_bytes().tolist()
+    [367001600, 1610612736, 2048, 12, 85, <NA>]
+    >>> pd.Series(["60s", "60ms", "2m", "1 h", "85%", "1x"]).ju.to_ms().tolist()
+    [60000.0, 60.0, 120000.0, 3600000.0, 85.0, nan]
+    >>> pd.Series([1234567890123.756, 999, None]).ju.humanize().tolist()
+    ['1.23 TB', '999.0 B', None]
+    >>> pd.Series([1234567890.756, 1500, 10]).ju.humanize("msec").tolist()
+    ['14.29 d', '1.5 s', '10.0 ms']
+    """
+    # '%' passes the number through, same as _udf_str_to_int() (eg: 'heap.memory.used/max=85%')
+    _BYTES_UNITS = {'': 1, '%': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'KIB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2,
+                    'MIB': 1024 ** 2, 'G': 1024 ** 3, 'GB': 1024 ** 3, 'GIB': 1024 ** 3, 'T': 1024 ** 4,
+                    'TB': 1024 ** 4, 'TIB': 1024 ** 4}
+    _MS_UNITS = {'': 1, '%': 1, 'NS': 0.000001, 'US': 0.001, 'MS': 1, 'S': 1000, 'SEC': 1000, 'M': 60000, 'MIN': 60000,
+                 'H': 3600000, 'HOUR': 3600000, 'D': 86400000, 'DAY': 86400000}
+
+    def __init__(self, series):
+        self._s = series
+
+    def _to_number(self, units):
+        # Metrics repeat a lot, so parsing only the unique values (one regex extraction), then the unit factors are
+        # looked up with the category codes, and the results are mapped back with the factorized codes
+        (codes, uniques) = pd.factorize(self._s)
+        ext = pd.Series(uniques, dtype=object).astype(str).str.extract(r'([-\d.]+) ?([a-zA-Z%]*)')
+        num = pd.to_numeric(ext[0], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        keys = list(units.keys())
+        unit_codes = pd.Categorical(ext[1].fillna('').str.upper(), categories=keys).codes
+        # Unknown unit (code -1) => NaN
+        factors = np.append(np.array([units[k] for k in keys], dtype='float64'), np.nan)
+        # Missing value (code -1) => NaN
+        values = np.append(num * factors[unit_codes], np.nan)
+        return pd.Series(values[codes], index=self._s.index, name=self._s.name)
+
+    def to_bytes(self):
+        """
+        Convert strings like 350M, 350MB, 1.5GB, 2 KiB to bytes (1024 based). 85% is 85
+        :return: Int64 Series (<NA> if not a size)
+        """
+        return self._to_number(self._BYTES_UNITS).round().astype('Int64')
+
+    def to_ms(self):
+        """
+        Convert strings like 60s, 60ms, 2m, 1h to milliseconds. 85% is 85
+        :return: float Series (NaN if not a duration)
+        """
+        return self._to_number(self._MS_UNITS)
+
+    def humanize(self, base_unit="byte", r=2):
+        """
+        Convert numbers to human readable strings (same as _human_readable_num() but for a whole column)
+        :param base_unit: 'byte' or 'bytes' or 'msec' or 'milliseconds'
+        :param r: used in round function
+        :return: object Series (None if not numeric)
+        """
+        n = pd.to_numeric(self._s, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        a = np.abs(n)
+        if base_unit in ['msec', 'milliseconds']:
+            bases = np.array([86400000, 3600000, 60000, 1000, 1], dtype='float64')
+            units = np.array(['d', 'h', 'm', 's', 'ms'])
+            idx = np.select([a > b for b in bases[:-1]], list(range(len(bases) - 1)), default=len(bases) - 1)
+        else:
+            bases = 1000.0 ** np.arange(6)
+            units = np.array(['B', 'KB', 'MB', 'GB', 'TB', 'PB'])
+            # same as int((len(str(int(abs(n)))) - 1) / 3)
+            idx = np.clip(np.floor(np.log10(np.fmax(np.nan_to_num(a), 1)) / 3), 0, 5).astype(int)
+        values = pd.Series(np.round(n / bases[idx], r), index=self._s.index)
+        rtn = values.astype(str) + " " + units[idx]
+        return rtn.where(values.notnull(), None).rename(self._s.name)
+
+    def to_epoch_ms(self, fmt=None, tz=None):
+        """
+        Convert timestamp strings to UTC epoch milliseconds (format detected once from a sample if fmt is None)
+        :param fmt: strptime format (eg: '%d/%b/%Y:%H:%M:%S %z')
+        :param tz: Time zone of the timestamps without offset. If None, UTC
+        :return: Int64 Series
+        >>> pd.Series(["14/Oct/2019:00:00:05 +0800"]).ju.to_epoch_ms().tolist()
+        [1570982405000]
+        """
+        return _to_epoch_ms(self._s, fmt=fmt, tz=tz).rename(self._s.name)
+
+
+pd = _lazy_import('pandas', on_load=_register_pandas_accessors)
+np = _lazy_import('numpy')
+# Optional: faster CSV parser which can stream record batches, and Parquet
+pa = _lazy_import('pyarrow')
 
 try:
     from urllib.request import urlopen, Request
@@ -59,18 +212,216 @@ _DEBUG = False
 _LOAD_UDFS = True
 
 _LAST_CONN = None
+# (history db path, connection) for query history
+_QHISTORY_CONN = None
+# If True, query() records the plan of each (history enabled) execution, so that qhistory(trend=...) shows if an
+# index helped. EXPLAIN runs only when the query or the schema version (eg: CREATE INDEX, ANALYZE) changed
+_QHISTORY_EXPLAIN = True
+# (id(conn), query, schema_version) => (tables, plan) of _explain_query()
+_EXPLAIN_CACHE = {}
+# display() converts only this number of rows into HTML at once
+_DISPLAY_PAGE_SIZE = 200
+# In-process schema catalog: id(conn) => {tablename: {'columns': [], 'types': [], 'rows': int or None, ...}}
+# '_changes' and '_data_version' keys keep conn.total_changes and PRAGMA data_version the row counts are valid for
+_SCHEMA_CATALOG = {}
 _DB_SCHEMA = 'db'
 _SIZE_REGEX = r"[sS]ize ?= ?([0-9]+)"
 _TIME_REGEX = r"\b([0-9.,]+) ([km]?s)\b"
+# If a CSV file is larger than this (bytes), csv2df reads the file in chunks
+_CSV_CHUNK_THRESHOLD = (1024 * 1024 * 100)
+# Per file timings of the last load_jsons / load_csvs (slowest first)
+_LAST_LOAD_TIMINGS = []
+# Time-bucket rollups (see rollup_register()): source table name => list of rollup specs
+_ROLLUPS = {'t_logs': [{'name': 't_logs_hourly', 'keys': ['loglevel', 'class'], 'measures': [],
+                        'time_col': 'date_time', 'bucket_sec': 3600}],
+            't_request_logs': [{'name': 't_request_logs_hourly', 'keys': ['statusCode'],
+                                'measures': ['elapsedTime', 'bytesSent'], 'time_col': 'date', 'bucket_sec': 3600}]}
+# analyse_logs() stages: (id(conn), stage name) => (fingerprint of the inputs, result)
+_STAGE_CACHE = {}
+# Instrumentation (t_ju_metrics). Set _METRICS = False to disable, _METRICS_TRACEMALLOC = True to trace allocations
+_METRICS = True
+_METRICS_TRACEMALLOC = False
+_METRICS_BUFFER = []
+_METRICS_SEQ = count(1)
+_METRICS_PID = os.getpid()
+_METRICS_SESSION = "%d-%d" % (_METRICS_PID, int(time()))
+_METRICS_LOCAL = threading.local()
+_METRICS_CONN = None
+# For the current RSS from /proc/self/statm (pages)
+_PAGE_SIZE_KB = int(os.sysconf('SC_PAGE_SIZE') / 1024) if hasattr(os, 'sysconf') else 4
+# Persistent Hive connections of this process: (conn_str, thread id) => (cursor, user, pwd)
+_HIVE_CONNS = {}
+# Per thread connections of replay_queries()
+_REPLAY_LOCAL = threading.local()
+# Persistent worker pool for _mexec(): (key, pid, multiprocessing.Pool, module names when the pool was forked)
+_POOL = None
+_MEXEC_FUNC = None
+# Compiled regexes (per process). Pool workers precompile _SHARED_REGEXES
+_REGEX_CACHE = {}
+# Thread dump: the first line of a thread ("name" ...), and the date time line of jstack -l output
+_THREAD_HEAD_REGEX = r'^"(.+)"(.*)$'
+_THREAD_TIME_REGEX = r'^(\d\d\d\d-\d\d-\d\d[ T]\d\d:\d\d:\d\d)$'
+# key=value pairs in a log message (eg: Hazelcast HealthMonitor), used by kv2df()
+_KV_REGEX = r'([^ ,=\[\]]+)=([^, ]*)'
+# Hazelcast HealthMonitor: logger (class) name, and the columns/regex of the beginning of the message
+_HAZEL_HEALTH_CLASS = 'com.hazelcast.internal.diagnostics.HealthMonitor'
+_HAZEL_HEALTH_HEAD = (['ip', 'port', 'user', 'cluster_ver'], r'^\[([^\]]+)]:([^ ]+) \[([^\]]+)\] \[([^\]]+)\]')
+# Timestamp formats tried by _ts_detect_format() (the first one which parses all samples is used)
+_TS_FORMATS = ['%Y-%m-%d %H:%M:%S,%f%z', '%Y-%m-%d %H:%M:%S.%f%z', '%Y-%m-%d %H:%M:%S,%f', '%Y-%m-%d %H:%M:%S.%f',
+               '%Y-%m-%dT%H:%M:%S,%f%z', '%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d %H:%M:%S%z',
+               '%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%d/%b/%Y:%H:%M:%S %z',
+               '%d/%b/%Y:%H:%M:%S', '%a %b %d %H:%M:%S %Z %Y', '%b %d, %Y %I:%M:%S %p']
+# Detected format per timestamp shape (see _ts_shape())
+_TS_FORMAT_CACHE = {}
+_SHARED_REGEXES = [_SIZE_REGEX, _TIME_REGEX, r"\d\d\d\d-\d\d-\d\d.\d\d:\d\d:\d\d,\d+", r"^\d\d\d\d-\d\d-\d\d"]
+
+
+def _compile(regex, flags=0):
+    """
+    Return the compiled regex from the per-process cache (pool workers precompile the shared regexes)
+    :param regex: A regex string (or bytes)
+    :param flags: re flags (eg: re.MULTILINE)
+    :return: compiled regex object
+    >>> _compile("^a") is _compile("^a")
+    True
+    """
+    global _REGEX_CACHE
+    key = regex if flags == 0 else (regex, flags)
+    c = _REGEX_CACHE.get(key)
+    if c is None:
+        c = _REGEX_CACHE[key] = re.compile(regex, flags)
+    return c
+
+
+def _mexec_init(regexes=(), initializer=None, initargs=()):
+    """
+    Pool initializer: precompile the shared regexes and the given regexes, then call the optional initializer
+    :param regexes: A list of regex strings
+    :param initializer: (optional) A function object
+    :param initargs: Arguments for the initializer
+    :return: void
+    >>> _mexec_init(["^test_mexec_init"]); "^test_mexec_init" in _REGEX_CACHE
+    True
+    """
+    global _SHARED_REGEXES
+    for regex in list(_SHARED_REGEXES) + list(regexes):
+        _compile(regex)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _mexec_worker(args):
+    """
+    Execute one chunk of functions in a worker
+    The function and arguments are unpickled here (not by the pool), so that a task which can't be unpickled in
+    this worker (eg: a class defined after the fork) returns the error instead of killing the worker
+    :param args: ([index, ...], pickled (function object (None to use the function inherited from the parent),
+                 [arguments, ...]))
+    :return: A list of (index, result, exception or None)
+    >>> import pickle; _mexec_worker(([0], pickle.dumps((max, [(1, 2)]))))
+    [(0, 2, None)]
+    >>> _mexec_worker(([0, 1], b"broken"))[1][0]
+    1
+    """
+    import pickle
+    global _MEXEC_FUNC
+    (indexes, payload) = args
+    try:
+        (func_obj, args_list) = pickle.loads(payload)
+    except Exception as e:
+        return [(i, None, e) for i in indexes]
+    func_obj = func_obj or _MEXEC_FUNC
+    rtn = []
+    for (i, func_args) in zip(indexes, args_list):
+        try:
+            rtn.append((i, func_obj(*func_args), None))
+        except Exception as e:
+            rtn.append((i, None, e))
+    return rtn
+
+
+def _mexec_progress(done, total, i, result):
+    """
+    A progress callback for _mexec(), which outputs every 10%
+    >>> _mexec_progress(1, 3, 0, None)
+    """
+    if done == total or done % max(int(total / 10), 1) == 0:
+        _err("  Completed %d/%d (%s) ..." % (done, total, _timestamp(format="%H:%M:%S")))
+
+
+def _get_pool(num=None, initializer=None, initargs=(), regexes=(), module_name=None):
+    """
+    Return the persistent worker pool. A new pool is created only if the number of processes or the initializer
+    is changed, if the workers don't have the module of the function (imported after the fork), or after pool_close()
+    :param num: number of processes. if None, half of CPUs
+    :param initializer: (optional) A function object which each worker process calls once when it starts
+    :param initargs: Arguments for the initializer
+    :param regexes: Regexes to precompile in each worker (in addition to _SHARED_REGEXES) when a pool is created
+    :param module_name: (optional) The module name of the function which will be executed
+    :return: multiprocessing.Pool object
+    >>> _get_pool(1) is _get_pool(1)
+    True
+    >>> pool_close()
+    """
+    global _POOL
+    if bool(num) is False:
+        num = max(int(mp.cpu_count() / 2), 1)
+    key = (num, initializer, initargs)
+    if _POOL is not None and _POOL[0] == key and _POOL[1] == os.getpid() and (
+            module_name is None or module_name in _POOL[3]):
+        return _POOL[2]
+    pool_close()
+    # Loading (lazily imported) pandas before forking, so that each worker doesn't import it again
+    pd.DataFrame
+    pool = mp.Pool(processes=num, initializer=_mexec_init, initargs=(tuple(regexes), initializer, initargs))
+    _POOL = (key, os.getpid(), pool, frozenset(sys.modules.keys()))
+    return pool
+
+
+def pool_close(terminate=False):
+    """
+    Close the persistent worker pool used by _mexec() (eg: to release memory, or after changing this module)
+    :param terminate: If True, kill the workers without waiting for the running tasks
+    :return: void
+    >>> pool_close()
+    """
+    global _POOL
+    if _POOL is None:
+        return
+    (key, pid, pool, _) = _POOL
+    _POOL = None
+    # The pool object copied into a forked child can't be closed
+    if pid != os.getpid():
+        return
+    if terminate:
+        pool.terminate()
+    else:
+        # close() (not terminate()) so that workers exit normally and run their finalizers
+        pool.close()
+    pool.join()
 
 
-def _mexec(func_obj, args_list, num=None):
+def _mexec(func_obj, args_list, num=None, initializer=None, initargs=(), chunksize=None, callback=None,
+           timeout=None, regexes=()):
     """
-    Execute multiple functions asynchronously
+    Execute multiple functions asynchronously with the persistent worker pool (see _get_pool())
+    If the function is not importable by the workers (eg: defined in a Jupyter cell, ie. __main__), a temporary pool
+    is forked, which inherits the function. If the function's module was imported after the persistent pool was
+    forked, the pool is re-created.
     :param func_obj: A function object to be executed
     :param args_list: A list contains tuples of arguments
     :param num: number of pool. if None, half of CPUs (NOTE: if threads, it does not matter)
-    :return: list contains results. Currently result order is random (not same as args_list)
+    :param initializer: (optional) A function object which each worker process calls once when it starts
+    :param initargs: Arguments for the initializer
+    :param chunksize: Number of tasks sent to a worker at once. If None, about 4 chunks per worker
+    :param callback: (optional) A function object which accepts (done, total, index, result), called in this
+                     process as each result arrives (eg: _mexec_progress)
+    :param timeout: (optional) Seconds to wait for the next result. If exceeded or interrupted, the pool is
+                    terminated and the partial results are returned
+    :param regexes: Regexes to precompile in each worker when a new pool is created
+    :return: list contains results in the same order as args_list. If a function raised an exception (or the
+             task couldn't be pickled/unpickled), the exception object. None for the functions which didn't
+             complete (timeout). If a worker died, ChildProcessError for the functions which didn't complete.
     >>> def multi(x, y): return x * y
     ...
     >>> _mexec(multi, [(1, 2)])[0]
@@ -78,7 +429,13 @@ def _mexec(func_obj, args_list, num=None):
     >>> rs = _mexec(multi, [(1,2), (2,3)])
     >>> rs[0] + rs[1]
     8
+    >>> type(_mexec(int, [("1",), ("a",)])[1]).__name__
+    'ValueError'
+    >>> rs = _mexec(multi, [(1, 2), (lambda: 1, 1)]); rs[0], type(rs[1]).__name__
+    (2, 'PicklingError')
     """
+    import pickle
+    global _MEXEC_FUNC
     rs = []
     if bool(args_list) is False or bool(func_obj) is False:
         return None
@@ -87,10 +444,231 @@ def _mexec(func_obj, args_list, num=None):
         rs.append(func_obj(*args_list[0]))
         return rs
     if bool(num) is False:
-        num = int(mp.cpu_count() / 2)
-    executor = mp.Pool(processes=num)
-    rs = executor.starmap_async(func_obj, args_list)
-    return rs.get()
+        num = max(int(mp.cpu_count() / 2), 1)
+    if bool(chunksize) is False:
+        # Same as Pool.map(): fewer round trips (pickling) but still balanced
+        chunksize = max(int(len(args_list) / (num * 4)), 1)
+    module_name = getattr(func_obj, '__module__', None)
+    module = sys.modules.get(module_name)
+    # __main__ (Jupyter cells, scripts) keeps changing after the fork, so the workers may not have the function
+    importable = module_name != '__main__' and module is not None and getattr(
+        module, getattr(func_obj, '__qualname__', ''), None) is func_obj
+    if importable:
+        pool = _get_pool(num, initializer=initializer, initargs=initargs, regexes=regexes, module_name=module_name)
+    else:
+        _MEXEC_FUNC = func_obj
+        pd.DataFrame
+        pool = mp.Pool(processes=num, initializer=_mexec_init, initargs=(tuple(regexes), initializer, initargs))
+    rs = [None] * len(args_list)
+    completed = set()
+    # Pickling each chunk here (the function is pickled by reference), so that a task which can't be pickled
+    # fails alone, and _mexec_worker() unpickles it (a task which the pool can't unpickle is lost silently)
+    chunks = []
+    for c in _chunks(list(enumerate(args_list)), chunksize):
+        indexes = [i for (i, _) in c]
+        try:
+            chunks.append((indexes, pickle.dumps((func_obj if importable else None, [a for (_, a) in c]))))
+        except Exception as e:
+            for i in indexes:
+                rs[i] = e
+                completed.add(i)
+    # Only workers dying (eg: OOM killer) changes the pids, and their tasks never return
+    pids = set(p.pid for p in getattr(pool, '_pool', []))
+    try:
+        results_iter = pool.imap_unordered(_mexec_worker, chunks)
+        step = min(timeout, 1) if bool(timeout) else 1
+        for _ in range(len(chunks)):
+            waited = 0
+            while True:
+                try:
+                    chunk_rs = results_iter.next(step)
+                    break
+                except mp.TimeoutError:
+                    waited += step
+                    if bool(timeout) and waited >= timeout:
+                        raise
+                    if set(p.pid for p in getattr(pool, '_pool', [])) != pids:
+                        raise ChildProcessError("A worker of _mexec died")
+            for (i, r, error) in chunk_rs:
+                rs[i] = error if error is not None else r
+                completed.add(i)
+                if callback is not None:
+                    callback(len(completed), len(args_list), i, rs[i])
+    except (mp.TimeoutError, KeyboardInterrupt, ChildProcessError) as e:
+        _err("WARN: _mexec stopped after %d/%d results (%s). Returning partial results." % (
+            len(completed), len(args_list), type(e).__name__))
+        if isinstance(e, ChildProcessError):
+            rs = [r if i in completed else e for (i, r) in enumerate(rs)]
+        if importable:
+            pool_close(terminate=True)
+        else:
+            pool.terminate()
+    finally:
+        if importable is False:
+            pool.close()
+            pool.join()
+            _MEXEC_FUNC = None
+    return rs
+
+
+def _texec_iter(func_obj, args_list, num=16, timeout=None, initializer=None, initargs=()):
+    """
+    Execute multiple functions with a thread pool (for I/O bound functions, such as DB queries), and yield
+    each outcome as soon as it completes (completion order)
+    NOTE: a thread can't be killed, so a timed-out function keeps using its thread until it returns
+    :param func_obj: A function object to be executed
+    :param args_list: A list contains tuples of arguments
+    :param num: Max number of concurrently running functions (threads)
+    :param timeout: (optional) Seconds. If a function runs longer, its outcome is yielded with TimeoutError
+    :param initializer: (optional) A function object which each thread calls once when it starts
+    :param initargs: Arguments for the initializer
+    :return: generator of dict {'index': index in args_list, 'result', 'error', 'elapsed_ms'}
+    >>> sorted(o['result'] for o in _texec_iter(max, [(1, 2), (3, 4)]))
+    [2, 4]
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    started = {}
+
+    def _run(i, args):
+        started[i] = time()
+        return func_obj(*args)
+
+    executor = ThreadPoolExecutor(max_workers=num, initializer=initializer, initargs=initargs)
+    futures = {executor.submit(_run, i, args): i for (i, args) in enumerate(args_list)}
+    pending = set(futures.keys())
+    poll_sec = min(timeout / 4.0, 1.0) if bool(timeout) else None
+    timed_out = 0
+    try:
+        while len(pending) > 0:
+            (done, pending) = wait(pending, timeout=poll_sec, return_when=FIRST_COMPLETED)
+            for f in done:
+                i = futures[f]
+                error = f.exception()
+                yield {'index': i, 'result': None if error else f.result(), 'error': error,
+                       'elapsed_ms': round((time() - started.get(i, time())) * 1000, 3)}
+            if bool(timeout) is False:
+                continue
+            now = time()
+            for f in list(pending):
+                i = futures[f]
+                if i in started and (now - started[i]) > timeout:
+                    pending.discard(f)
+                    timed_out += 1
+                    yield {'index': i, 'result': None, 'error': TimeoutError("Timed out after %s seconds" % (timeout)),
+                           'elapsed_ms': round((now - started[i]) * 1000, 3)}
+    finally:
+        # Not waiting for timed-out (or not started, if the generator is closed) functions
+        executor.shutdown(wait=(len(pending) == 0 and timed_out == 0), cancel_futures=True)
+
+
+def _texec(func_obj, args_list, num=16, timeout=None, callback=None, initializer=None, initargs=()):
+    """
+    Execute multiple functions with a thread pool (see _texec_iter()), and return the results in the same order as
+    args_list. If a function raised an exception or timed out, the exception object is the result
+    :param func_obj: A function object to be executed
+    :param args_list: A list contains tuples of arguments
+    :param num: Max number of concurrently running functions (threads)
+    :param timeout: (optional) Seconds per function
+    :param callback: (optional) A function object which accepts an outcome dict, called as each function completes
+    :param initializer: (optional) A function object which each thread calls once when it starts
+    :param initargs: Arguments for the initializer
+    :return: list contains results
+    >>> from time import sleep
+    >>> rs = _texec(sleep, [(0.5,), (5,), (0,)], num=3, timeout=1)
+    >>> rs[0] is None, type(rs[1]).__name__, rs[2] is None
+    (True, 'TimeoutError', True)
+    """
+    rs = [None] * len(args_list)
+    for o in _texec_iter(func_obj, args_list, num=num, timeout=timeout, initializer=initializer, initargs=initargs):
+        rs[o['index']] = o['error'] if o['error'] is not None else o['result']
+        if callback is not None:
+            callback(o)
+    return rs
+
+
+def _load_file_worker(loader, file_path):
+    """
+    Parse one file in a worker (no DB connection, so the loader returns a DataFrame)
+    :param loader: A function object which accepts 'filename', such as csv2df, json2df
+    :param file_path: File path
+    :return: (file_path, DataFrame or None, elapsed seconds, error string or None)
+    >>> pass    # Testing in _load_files_parallel()
+    """
+    _start = time()
+    try:
+        df = loader(filename=file_path)
+        if df is False:
+            df = None
+        return (file_path, df, time() - _start, None)
+    except Exception as e:
+        return (file_path, None, time() - _start, str(e))
+
+
+def _load_files_parallel(loader, names_dict, writer=None, num=None):
+    """
+    Parse multiple files concurrently with a process pool, and write each result from this (one) thread,
+    as SQLite connection should be used by one writer
+    :param loader: A function object which accepts 'filename', such as csv2df, json2df
+    :param names_dict: dict of tablename => file path
+    :param writer: A function object which accepts (df, tablename). If None, DataFrames are returned
+    :param num: number of pool. if None, half of CPUs
+    :return: dict of tablename => writer's result or DataFrame
+    >>> import tempfile; d = tempfile.mkdtemp()
+    >>> with open(d + "/a.csv", "w") as f: _ = f.write("k,v\\n1,a\\n")
+    >>> _load_files_parallel(csv2df, {"t_a": d + "/a.csv"})["t_a"]["v"][0]
+    'a'
+    """
+    global _LAST_LOAD_TIMINGS
+    rtn = {}
+    timings = []
+    if bool(names_dict) is False:
+        return rtn
+    tables = {v: k for k, v in names_dict.items()}
+    args_list = [(loader, f) for f in names_dict.values()]
+    if bool(num) is False:
+        num = max(int(mp.cpu_count() / 2), 1)
+    num = min(num, len(args_list))
+    if num < 2:
+        results = (_load_file_worker(*args) for args in args_list)
+        pool = None
+    else:
+        # Loading (lazily imported) pandas before forking, so that each worker doesn't import it again
+        pd.DataFrame
+        pool = mp.Pool(processes=num)
+        # imap_unordered so that the writer can start as soon as the first file is parsed
+        results = pool.imap_unordered(_star_load_file_worker, args_list)
+    try:
+        for (f, df, parse_sec, error) in results:
+            tablename = tables[f]
+            if bool(error) or df is None:
+                _err("WARN: Loading %s failed (%.2fs): %s" % (f, parse_sec, str(error)))
+                rtn[tablename] = False
+                continue
+            if pool is not None:
+                _add_metric("job:" + loader.__name__, round(parse_sec * 1000, 3), bytes_read=os.stat(f).st_size,
+                            rows=len(df), in_worker=True)
+            _start = time()
+            rtn[tablename] = writer(df, tablename) if writer is not None else df
+            write_sec = time() - _start
+            timings.append({'file': f, 'table': tablename, 'size_kb': int(os.stat(f).st_size / 1024),
+                            'rows': len(df), 'parse_sec': round(parse_sec, 3), 'write_sec': round(write_sec, 3)})
+            _err("Loaded %s (%d KB, %d rows) parse: %.2fs, write: %.2fs" % (
+                f, timings[-1]['size_kb'], len(df), parse_sec, write_sec))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    _LAST_LOAD_TIMINGS = sorted(timings, key=lambda t: t['parse_sec'] + t['write_sec'], reverse=True)
+    if len(timings) > 1:
+        _err("Slowest files:")
+        for t in _LAST_LOAD_TIMINGS[:5]:
+            _err("    %s parse: %.2fs, write: %.2fs" % (t['file'], t['parse_sec'], t['write_sec']))
+    return rtn
+
+
+def _star_load_file_worker(args):
+    # imap_unordered passes one argument only
+    return _load_file_worker(*args)
 
 
 def _dict2global(d, scope=None, overwrite=False):
@@ -230,8 +808,326 @@ def _debug(message):
         sys.stderr.write("[%s] DEBUG: %s\n" % (_timestamp(), str(message)))
 
 
-def load_jsons(src="./", conn=None, include_ptn='*.json', exclude_ptn='', chunksize=1000,
-               json_cols=['connectionId', 'planJson', 'json']):
+def _metrics_stack():
+    """
+    Return the ids of the running instrumented calls in this thread
+    >>> _metrics_stack()
+    []
+    """
+    global _METRICS_LOCAL
+    if hasattr(_METRICS_LOCAL, 'stack') is False:
+        _METRICS_LOCAL.stack = []
+    return _METRICS_LOCAL.stack
+
+
+def _metrics_enabled():
+    """
+    Return True if metrics should be recorded (not in a forked worker, as the DB connection can't be used there)
+    >>> _metrics_enabled() is _METRICS
+    True
+    """
+    global _METRICS
+    global _METRICS_PID
+    return bool(_METRICS) and os.getpid() == _METRICS_PID
+
+
+def _add_metric(name, wall_ms, cpu_ms=None, bytes_read=None, rows=None, error=None, in_worker=False):
+    """
+    Record one metric (eg: the elapsed time of a job which was executed in a worker process)
+    :param name: Metric name (normally function name)
+    :param wall_ms: Wall time in milliseconds
+    :param cpu_ms: CPU time in milliseconds
+    :param bytes_read: Bytes read
+    :param rows: Rows produced
+    :param error: Error string
+    :param in_worker: True if the work was done in a worker (so not included in the parent's child time)
+    :return: The metric dict
+    >>> _add_metric("test", 1.0)['name']
+    'test'
+    >>> _ = _METRICS_BUFFER.pop()
+    """
+    global _METRICS_BUFFER
+    global _METRICS_SEQ
+    global _METRICS_SESSION
+    stack = _metrics_stack()
+    m = {'session': _METRICS_SESSION, 'id': next(_METRICS_SEQ), 'parent_id': stack[-1] if len(stack) > 0 else None,
+         'depth': len(stack), 'datetime': _timestamp(), 'name': name, 'wall_ms': wall_ms, 'cpu_ms': cpu_ms,
+         'peak_rss_kb': None, 'rss_delta_kb': None, 'tracemalloc_peak_kb': None, 'bytes_read': bytes_read,
+         'rows': rows, 'error': error, 'in_worker': 1 if in_worker else 0}
+    if _metrics_enabled():
+        _METRICS_BUFFER.append(m)
+    return m
+
+
+@contextlib.contextmanager
+def _perf(name, bytes_read=None, rows=None):
+    """
+    Context manager to record wall time, CPU time, memory, bytes read and rows into t_ju_metrics
+    The yielded dict can be updated (eg: m['rows'] = len(df)) inside the block
+    cpu_ms is process-wide (all threads, eg: the query threads started by this call) in the main thread, and only
+    the thread's own CPU time in other threads.
+    rss_delta_kb is the RSS change of the process during the call (None if not Linux), and peak_rss_kb is the
+    process's lifetime peak RSS at the end of the call (not per call). If _METRICS_TRACEMALLOC is True, tracemalloc
+    peak of the outermost call is also recorded (slower).
+    Metrics are written when the outermost instrumented block (in the main thread) ends.
+    :param name: Metric name (normally function name)
+    :param bytes_read: Bytes read
+    :param rows: Rows produced
+    :return: A dict
+    >>> with _perf("test_perf") as m: m['rows'] = 2
+    >>> perf_report(like="test_perf")[['calls', 'rows']].values.tolist()
+    [[1, 2]]
+    >>> _ = _metrics_conn().execute("DELETE FROM t_ju_metrics WHERE name = 'test_perf'")
+    """
+    global _METRICS_BUFFER
+    global _METRICS_TRACEMALLOC
+    if _metrics_enabled() is False:
+        yield {}
+        return
+    import tracemalloc
+    m = _add_metric(name, None, bytes_read=bytes_read, rows=rows)
+    # Not in the buffer until completed
+    _METRICS_BUFFER.pop()
+    stack = _metrics_stack()
+    stack.append(m['id'])
+    own_tracing = False
+    if _METRICS_TRACEMALLOC and tracemalloc.is_tracing() is False:
+        tracemalloc.start()
+        own_tracing = True
+    cpu_time = process_time if threading.current_thread() is threading.main_thread() else thread_time
+    _start_rss = _rss_kb()
+    _start = time()
+    _start_cpu = cpu_time()
+    try:
+        yield m
+    except Exception as e:
+        m['error'] = str(e)[:1000]
+        raise
+    finally:
+        m['wall_ms'] = round((time() - _start) * 1000, 3)
+        m['cpu_ms'] = round((cpu_time() - _start_cpu) * 1000, 3)
+        m['peak_rss_kb'] = _peak_rss_kb()
+        _end_rss = _rss_kb()
+        if _start_rss is not None and _end_rss is not None:
+            m['rss_delta_kb'] = _end_rss - _start_rss
+        if own_tracing:
+            m['tracemalloc_peak_kb'] = int(tracemalloc.get_traced_memory()[1] / 1024)
+            tracemalloc.stop()
+        stack.pop()
+        _METRICS_BUFFER.append(m)
+        if len(stack) == 0 and threading.current_thread() is threading.main_thread():
+            _flush_metrics()
+
+
+def _peak_rss_kb():
+    """
+    Return the peak RSS of this process in KB (None if not available, eg: Windows)
+    >>> _peak_rss_kb() > 0
+    True
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS returns bytes
+    return int(rss / 1024) if sys.platform == 'darwin' else rss
+
+
+def _rss_kb():
+    """
+    Return the current RSS of this process in KB from /proc (None if not available, eg: macOS, Windows)
+    >>> _rss_kb() is None or _rss_kb() > 0
+    True
+    """
+    global _PAGE_SIZE_KB
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE_KB
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _rows_of(obj):
+    """
+    Return the number of rows from a function's return value (DataFrame, list, int), or None
+    >>> _rows_of([1, 2]), _rows_of(3), _rows_of(True)
+    (2, 3, None)
+    """
+    if isinstance(obj, bool) or obj is None:
+        return None
+    if isinstance(obj, int):
+        return obj
+    if isinstance(obj, (list, tuple)) or type(obj).__name__ == 'DataFrame':
+        return len(obj)
+    if hasattr(obj, 'num_rows'):
+        return obj.num_rows
+    return None
+
+
+def _bytes_of(filename):
+    """
+    Return the total size of the files found from a file name or glob pattern, or None
+    >>> _bytes_of("/no/such/file_ju_test") is None
+    True
+    """
+    if isinstance(filename, str) is False or len(filename) == 0:
+        return None
+    files = _find_files(filename)
+    if len(files) == 0:
+        return None
+    return sum(os.stat(f).st_size for f in files if os.path.isfile(f))
+
+
+def _instrument(name=None, bytes_arg=None, rows_arg=None):
+    """
+    Decorator to record the calls of a function with _perf()
+    :param name: Metric name. If None, the function name
+    :param bytes_arg: An argument name which is a file path or glob, to record bytes read
+    :param rows_arg: An argument name which len() is the rows. If None, rows are from the return value
+    :return: A decorator
+    >>> @_instrument(rows_arg="l")
+    ... def _test_instrument(l): return True
+    >>> _test_instrument([1, 2, 3])
+    True
+    >>> perf_report(like="_test_instrument")[['calls', 'rows']].values.tolist()
+    [[1, 3]]
+    >>> _ = _metrics_conn().execute("DELETE FROM t_ju_metrics WHERE name = '_test_instrument'")
+    """
+
+    def _decorator(func_obj):
+        import inspect
+        params = list(inspect.signature(func_obj).parameters.keys())
+        metric_name = name if bool(name) else func_obj.__name__
+
+        def _arg(args, kwargs, arg_name):
+            if arg_name in kwargs:
+                return kwargs[arg_name]
+            i = params.index(arg_name)
+            return args[i] if i < len(args) else None
+
+        @functools.wraps(func_obj)
+        def _wrapper(*args, **kwargs):
+            if _metrics_enabled() is False:
+                return func_obj(*args, **kwargs)
+            bytes_read = _bytes_of(_arg(args, kwargs, bytes_arg)) if bool(bytes_arg) else None
+            with _perf(metric_name, bytes_read=bytes_read) as m:
+                rtn = func_obj(*args, **kwargs)
+                if bool(rows_arg):
+                    v = _arg(args, kwargs, rows_arg)
+                    m['rows'] = len(v) if v is not None else None
+                else:
+                    m['rows'] = _rows_of(rtn)
+            return rtn
+
+        return _wrapper
+
+    return _decorator
+
+
+def _metrics_conn():
+    """
+    Return the connection of the metrics DB (SQLite), creating t_ju_metrics table if not exists
+    Not using connect(), so that t_ju_metrics is not mixed with the loaded tables.
+    The file path is from JN_UTILS_METRICS_DB env. If not set, in memory (per session)
+    :return: sqlite3 connection object
+    >>> _metrics_conn().execute("SELECT count(*) FROM t_ju_metrics").fetchall()[0][0] >= 0
+    True
+    """
+    global _METRICS_CONN
+    db_path = os.getenv('JN_UTILS_METRICS_DB', ':memory:')
+    if bool(_METRICS_CONN) and _METRICS_CONN[0] == db_path:
+        return _METRICS_CONN[1]
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS t_ju_metrics (session TEXT, id INTEGER, parent_id INTEGER,
+    depth INTEGER, datetime TEXT, name TEXT, wall_ms REAL, cpu_ms REAL, peak_rss_kb INTEGER, rss_delta_kb INTEGER,
+    tracemalloc_peak_kb INTEGER, bytes_read INTEGER, rows INTEGER, error TEXT, in_worker INTEGER)""")
+    if 'rss_delta_kb' not in [r[1] for r in conn.execute("PRAGMA table_info(t_ju_metrics)").fetchall()]:
+        # Metrics DB file created by an older version
+        conn.execute("ALTER TABLE t_ju_metrics ADD COLUMN rss_delta_kb INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS t_ju_metrics_session_parent_id ON t_ju_metrics (session, parent_id)")
+    _METRICS_CONN = (db_path, conn)
+    return conn
+
+
+def _flush_metrics(conn=None):
+    """
+    Write the buffered metrics into t_ju_metrics table
+    :param conn: DB connection object. If None, _metrics_conn()
+    :return: Number of written metrics
+    >>> _flush_metrics() >= 0
+    True
+    """
+    global _METRICS_BUFFER
+    if len(_METRICS_BUFFER) == 0:
+        return 0
+    if bool(conn) is False: conn = _metrics_conn()
+    cols = ['session', 'id', 'parent_id', 'depth', 'datetime', 'name', 'wall_ms', 'cpu_ms', 'peak_rss_kb',
+            'rss_delta_kb', 'tracemalloc_peak_kb', 'bytes_read', 'rows', 'error', 'in_worker']
+    # swapping the buffer first, so that metrics added meanwhile (by other threads) are not lost
+    (buffer, _METRICS_BUFFER) = (_METRICS_BUFFER, [])
+    conn.executemany("INSERT INTO t_ju_metrics (%s) VALUES (%s)" % (", ".join(cols), ", ".join(["?"] * len(cols))),
+                     [tuple(m[c] for c in cols) for m in buffer])
+    return len(buffer)
+
+
+def perf_report(like=None, since=None, all_sessions=False, conn=None):
+    """
+    Summarise t_ju_metrics per name, sorted by the self time (wall time minus instrumented child calls)
+    'pct' is the percentage of the self time in the total wall time of the top level calls
+    :param like: (optional) Filter by name with LIKE (eg: 'stage:%')
+    :param since: (optional) Filter by datetime (eg: '2020-01-01 10:00:00')
+    :param all_sessions: If False, only the metrics recorded since this module was imported
+    :param conn: DB connection object. If None, _metrics_conn()
+    :return: DataFrame
+    >>> pass    # Testing in _perf() and _instrument()
+    """
+    global _METRICS_SESSION
+    if bool(conn) is False: conn = _metrics_conn()
+    _flush_metrics(conn)
+    where_sql = "WHERE 1=1"
+    binds = []
+    if all_sessions is False:
+        where_sql += " AND m.session = ?"
+        binds.append(_METRICS_SESSION)
+    if bool(like):
+        where_sql += " AND m.name LIKE ?"
+        binds.append(like)
+    if bool(since):
+        where_sql += " AND m.datetime >= ?"
+        binds.append(since)
+    sql = """SELECT m.name, count(*) AS calls,
+    ROUND(SUM(m.wall_ms) / 1000, 3) AS wall_s,
+    ROUND(SUM(m.wall_ms - IFNULL(c.child_ms, 0)) / 1000, 3) AS self_s,
+    ROUND(SUM(m.cpu_ms) / 1000, 3) AS cpu_s,
+    ROUND(AVG(m.wall_ms), 1) AS avg_ms,
+    ROUND(MAX(m.wall_ms), 1) AS max_ms,
+    MAX(m.peak_rss_kb) AS peak_rss_kb,
+    MAX(m.rss_delta_kb) AS max_rss_delta_kb,
+    MAX(m.tracemalloc_peak_kb) AS tracemalloc_peak_kb,
+    SUM(m.bytes_read) AS bytes_read,
+    SUM(m.rows) AS rows,
+    CAST(SUM(m.rows) * 1000 / SUM(m.wall_ms) AS INTEGER) AS rows_per_sec,
+    ROUND(SUM(m.bytes_read) * 1000 / SUM(m.wall_ms) / 1024 / 1024, 2) AS mb_per_sec,
+    COUNT(m.error) AS errors,
+    MAX(m.in_worker) AS in_worker
+FROM t_ju_metrics m
+  LEFT JOIN (SELECT session, parent_id, SUM(wall_ms) AS child_ms FROM t_ju_metrics
+             WHERE in_worker = 0 GROUP BY 1, 2) c ON c.session = m.session AND c.parent_id = m.id
+%s
+GROUP BY m.name
+ORDER BY self_s DESC""" % (where_sql)
+    df = pd.read_sql(sql, conn, params=binds)
+    top_sql = "SELECT SUM(wall_ms) FROM t_ju_metrics m %s AND m.depth = 0 AND m.in_worker = 0" % (where_sql)
+    total_ms = conn.execute(top_sql, binds).fetchall()[0][0]
+    if bool(total_ms):
+        df.insert(4, 'pct', (df['self_s'] * 1000 * 100 / total_ms).round(1))
+    return df
+
+
+@_instrument()
+def load_jsons(src="./", conn=None, include_ptn='*.json', exclude_ptn='', chunksize=100000,
+               json_cols=['connectionId', 'planJson', 'json'], num_pool=None):
     """
     Find json files from current path and load as pandas dataframes object
     :param src: source/importing directory path
@@ -240,6 +1136,7 @@ def load_jsons(src="./", conn=None, include_ptn='*.json', exclude_ptn='', chunks
     :param exclude_ptn: Regex string to exclude some file
     :param chunksize: Rows will be written in batches of this size at a time. By default, all rows will be written at once
     :param json_cols: to_sql() fails if column is json, so dropping for now (TODO)
+    :param num_pool: Number of processes to parse files. If None, half of CPUs
     :return: A tuple contain key=>file relationship and Pandas dataframes objects
     #>>> (names_dict, dfs) = load_jsons(src="./engine/aggregates")
     #>>> bool(names_dict)
@@ -247,24 +1144,26 @@ def load_jsons(src="./", conn=None, include_ptn='*.json', exclude_ptn='', chunks
     >>> pass    # TODO: implement test
     """
     names_dict = {}
-    dfs = {}
     ex = re.compile(exclude_ptn)
 
     files = _globr(include_ptn, src)
     for f in files:
         f_name, f_ext = os.path.splitext(os.path.basename(f))
-        if ex.search(f_name):
+        if bool(exclude_ptn) and ex.search(f_name):
             _err("Excluding %s as per exclude_ptn (%d KB)..." % (f_name, os.stat(f).st_size / 1024))
             continue
         new_name = _pick_new_key(f_name, names_dict, using_1st_char=(bool(conn) is False), prefix='t_')
-        _err("Creating table: %s (%d KB) ..." % (new_name, os.stat(f).st_size / 1024))
         names_dict[new_name] = f
-        dfs[new_name] = json2df(file_path=f, conn=conn, tablename=new_name, chunksize=chunksize,
-                                json_cols=json_cols)
+
+    def _writer(df, tablename):
+        return _json_df2table(df, conn=conn, tablename=tablename, json_cols=json_cols, chunksize=chunksize)
+
+    dfs = _load_files_parallel(json2df, names_dict, writer=(_writer if bool(conn) else None), num=num_pool)
     return (names_dict, dfs)
 
 
-def json2df(filename, jq_query="", conn=None, tablename=None, json_cols=[], chunksize=1000):
+@_instrument(bytes_arg='filename')
+def json2df(filename, jq_query="", conn=None, tablename=None, json_cols=[], chunksize=100000):
     """
     Convert a json file, which contains list into a DataFrame
     If conn is given, import into a DB table
@@ -300,22 +1199,39 @@ def json2df(filename, jq_query="", conn=None, tablename=None, json_cols=[], chun
         return False
     df = pd.concat(dfs, sort=False)
     if bool(conn):
-        if bool(json_cols) is False:
-            row = df[:1].to_dict(orient='records')[0]
-            for k in row:
-                if type(row[k]) is dict:
-                    json_cols.append(k)
         if bool(tablename) is False:
             tablename = _pick_new_key(os.path.basename(files[0]), {}, using_1st_char=False, prefix='t_')
-        _err("Creating table: %s ..." % (tablename))
-        # TODO: Temp workaround "<table>: Error binding parameter <N> - probably unsupported type."
-        df_tmp_mod = _avoid_unsupported(df=df, json_cols=json_cols, name=tablename)
-        df_tmp_mod.to_sql(name=tablename, con=conn, chunksize=chunksize, if_exists='replace', schema=_DB_SCHEMA)
-        _autocomp_inject(tablename=tablename)
-        return len(df) > 0
+        return _json_df2table(df, conn=conn, tablename=tablename, json_cols=json_cols, chunksize=chunksize)
     return df
 
 
+def _json_df2table(df, conn, tablename, json_cols=[], chunksize=100000):
+    """
+    Save a DataFrame which was generated from a json file into a DB table
+    :param df: A DataFrame object
+    :param conn: DB connection object
+    :param tablename: Table name
+    :param json_cols: to_sql() fails if column is json, so forcing those columns to string
+    :param chunksize:
+    :return: True if some rows are inserted
+    >>> pass    # Testing in json2df()
+    """
+    global _DB_SCHEMA
+    # not modifying the given (or default) list
+    json_cols = list(json_cols) if bool(json_cols) else []
+    if bool(json_cols) is False and len(df) > 0:
+        row = df[:1].to_dict(orient='records')[0]
+        for k in row:
+            if type(row[k]) is dict:
+                json_cols.append(k)
+    _err("Creating table: %s ..." % (tablename))
+    # TODO: Temp workaround "<table>: Error binding parameter <N> - probably unsupported type."
+    df_tmp_mod = _avoid_unsupported(df=df, json_cols=json_cols, name=tablename)
+    _df2table(df_tmp_mod, conn=conn, tablename=tablename, chunksize=chunksize)
+    _autocomp_inject(tablename=tablename, conn=conn)
+    return len(df) > 0
+
+
 def _json2table(filename, tablename=None, conn=None, col_name='json_text', appending=False):
     """
     NOT WORKING
@@ -358,6 +1274,7 @@ def jq(file_path, query='.', as_string=False):
     >>> pass    # TODO: implement test
     """
     jd = json2dict(file_path)
+    import pyjq
     result = pyjq.all(query, jd)
     if len(result) == 1:
         result = result[0]
@@ -383,7 +1300,8 @@ def json2dict(file_path, sort=True):
     return rtn
 
 
-def xml2df(file_path, row_element_name, tbl_element_name=None, conn=None, tablename=None, chunksize=1000):
+@_instrument(bytes_arg='file_path')
+def xml2df(file_path, row_element_name, tbl_element_name=None, conn=None, tablename=None, chunksize=100000):
     """
     Convert a XML file into a DataFrame
     If conn is given, import into a DB table
@@ -404,13 +1322,14 @@ def xml2df(file_path, row_element_name, tbl_element_name=None, conn=None, tablen
         if bool(tablename) is False:
             tablename, ext = os.path.splitext(os.path.basename(file_path))
         _err("Creating table: %s ..." % (tablename))
-        df.to_sql(name=tablename, con=conn, chunksize=chunksize, if_exists='replace', schema=_DB_SCHEMA)
-        _autocomp_inject(tablename=tablename)
+        _df2table(df, conn=conn, tablename=tablename, chunksize=chunksize)
+        _autocomp_inject(tablename=tablename, conn=conn)
     return df
 
 
 def xml2dict(file_path, row_element_name, tbl_element_name=None, tbl_num=0):
     rtn = []
+    from lxml import etree
     parser = etree.XMLParser(recover=True)
     try:
         r = etree.ElementTree(file=file_path, parser=parser).getroot()
@@ -507,6 +1426,7 @@ def _db(dbname=':memory:', dbtype='sqlite', isolation_level=None, force_sqlalche
     """
     if force_sqlalchemy is False and dbtype == 'sqlite':
         return sqlite3.connect(dbname, isolation_level=isolation_level)
+    from sqlalchemy import create_engine
     return create_engine(dbtype + ':///' + dbname, isolation_level=isolation_level, echo=echo)
 
 
@@ -529,6 +1449,92 @@ def _udf_regex(regex, item, rtn_idx=0):
     return matches.group(rtn_idx)
 
 
+def _ts_shape(value):
+    """
+    Return the 'shape' of a timestamp string (digits replaced with 0), used as the key of the format cache
+    >>> _ts_shape("2020-01-03 00:00:38,357-0600")
+    '0000-00-00 00:00:00,000-0000'
+    """
+    return re.sub(r'\d', '0', str(value).strip())
+
+
+def _ts_detect_format(values, sample_size=100):
+    """
+    Detect the strptime format of timestamp strings from a sample (cached by the shape of the first value)
+    Only the format which parses all values of the sample is cached. If the sample has mixed formats, the format
+    which parses the most values is returned, but detected again next time.
+    :param values: A list or Series of timestamp strings (eg: first column of one log file)
+    :param sample_size: Number of values to try the formats with
+    :return: Format string, or None if no format in _TS_FORMATS matches
+    >>> _ts_detect_format(["2020-01-03 00:00:38,357-0600"])
+    '%Y-%m-%d %H:%M:%S,%f%z'
+    >>> _ts_detect_format(["14/Oct/2019:00:00:05 +0800"])
+    '%d/%b/%Y:%H:%M:%S %z'
+    >>> _ts_detect_format(["not a date"]) is None
+    True
+    >>> _ts_detect_format(["14/Oct/2019:00:00:05", "14/Oct/2019:00:00:06", "2019-10-14 00:00:07"])
+    '%d/%b/%Y:%H:%M:%S'
+    >>> _ts_shape("14/Oct/2019:00:00:05") in _TS_FORMAT_CACHE
+    False
+    """
+    global _TS_FORMAT_CACHE
+    global _TS_FORMATS
+    sample = pd.Series(list(values[:sample_size]) if hasattr(values, '__getitem__') else list(values)[:sample_size],
+                       dtype=object).dropna()
+    if len(sample) == 0:
+        return None
+    key = _ts_shape(sample.iloc[0])
+    if key in _TS_FORMAT_CACHE:
+        return _TS_FORMAT_CACHE[key]
+    fmt = None
+    best = 0
+    for f in _TS_FORMATS:
+        parsed = pd.to_datetime(sample, format=f, errors='coerce', utc=True).notnull().sum()
+        if parsed > best:
+            (fmt, best) = (f, parsed)
+        if best == len(sample):
+            break
+    if best == len(sample):
+        _TS_FORMAT_CACHE[key] = fmt
+    return fmt
+
+
+def _to_epoch_ms(values, fmt=None, tz=None):
+    """
+    Convert timestamp strings to UTC epoch milliseconds in one vectorized pandas call with a fixed format
+    :param values: A list or Series of timestamp strings
+    :param fmt: strptime format. If None, detected from a sample with _ts_detect_format()
+    :param tz: Time zone of the timestamps which don't have an offset (eg: 'America/Chicago'). If None, UTC
+    :return: Int64 Series (<NA> if not parsed)
+    >>> _to_epoch_ms(["2020-01-03 00:00:38,357-0600", "2020-01-03 06:00:38.357"]).tolist()
+    [1578031238357, <NA>]
+    >>> _to_epoch_ms(["2020-01-03 06:00:38.357"]).tolist()
+    [1578031238357]
+    """
+    s = pd.Series(values, dtype=object) if isinstance(values, pd.Series) is False else values
+    if fmt is None:
+        fmt = _ts_detect_format(s)
+    if fmt is None:
+        return pd.Series([pd.NA] * len(s), index=s.index, dtype='Int64')
+    if '%z' in fmt or bool(tz) is False:
+        ts = pd.to_datetime(s, format=fmt, errors='coerce', utc=True)
+    else:
+        ts = pd.to_datetime(s, format=fmt, errors='coerce').dt.tz_localize(tz, ambiguous='NaT',
+                                                                             nonexistent='NaT').dt.tz_convert('UTC')
+    return ((ts - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)).astype('Int64')
+
+
+def _epoch_list(values, fmt=None, tz=None):
+    """
+    Same as _to_epoch_ms() but return a list of int or None, to insert with tuples
+    >>> _epoch_list(["2020-01-03 06:00:38", "x"])
+    [1578031238000, None]
+    """
+    ms = _to_epoch_ms(values, fmt=fmt, tz=tz)
+    return ms.astype(object).where(ms.notnull(), None).tolist()
+
+
+@functools.lru_cache(maxsize=100000)
 def _udf_str2sqldt(date_time, format):
     """
     Date/Time handling UDF for SQLite
@@ -539,6 +1545,7 @@ def _udf_str2sqldt(date_time, format):
     """
     # 14/Oct/2019:00:00:05 +0800 => 2013-10-07 04:23:19.120-04:00
     # https://docs.python.org/3/library/datetime.html#strftime-and-strptime-behavior
+    # NOTE: cached (lru_cache) as same timestamps repeat in logs. For whole columns, use _to_epoch_ms()
     d = datetime.strptime(date_time, format)
     return d.strftime("%Y-%m-%d %H:%M:%S.%f%z")
 
@@ -552,6 +1559,7 @@ def _udf_timestamp(date_time):
     :param date_time: ISO date string (or Date/Time column but SQLite doesn't have date/time columns)
     :return:          Integer of Unix Timestamp
     """
+    from dateutil import parser
     return int(mktime(parser.parse(date_time).timetuple()))
 
 
@@ -680,19 +1688,29 @@ def connect(dbname=':memory:', dbtype='sqlite', isolation_level=None, force_sqla
     return conn
 
 
-def query(sql, conn=None, no_history=False):
+@_instrument()
+def query(sql, conn=None, no_history=False, as_arrow=False):
     """
     Call pd.read_sql() with given query, expecting SELECT statement
     :param sql: SELECT statement
     :param conn: DB connection object
     :param no_history: not saving this query into a history file
+    :param as_arrow: If True, return a pyarrow Table (built from record batches) instead of a DataFrame
     :return: a DF object
     >>> query("select name from sqlite_master where type = 'table'", connect(), True)
     Empty DataFrame
     Columns: [name]
     Index: []
+    >>> query("select 1 as a, 'b' as b", connect(), True, as_arrow=True).to_pydict()
+    {'a': [1], 'b': ['b']}
     """
     if bool(conn) is False: conn = connect()
+    _start = time()
+    if as_arrow:
+        tbl = _query2arrow(sql, conn)
+        if no_history is False and bool(tbl) and tbl.num_rows > 0:
+            _save_query(sql, elapsed_ms=(time() - _start) * 1000, rows=tbl.num_rows, conn=conn)
+        return tbl
     # return conn.execute(sql).fetchall()
     # TODO: pd.options.display.max_colwidth = col_width does not work
     df = pd.read_sql(sql, conn)
@@ -700,103 +1718,360 @@ def query(sql, conn=None, no_history=False):
     # dfStyler = df.style.set_properties(**{'text-align': 'left'})
     # dfStyler.set_table_styles([dict(selector='td', props=[('text-align', 'left')])])
     if no_history is False and df.empty is False:
-        _save_query(sql)
+        _save_query(sql, elapsed_ms=(time() - _start) * 1000, rows=len(df), conn=conn)
     return df
 
 
 q = query
 
 
-def query_execute(sql, conn):
+@_instrument()
+def query_execute(sql, conn, chunksize=None, tablename=None, local_conn=None):
     """
     Call conn.execute() then conn.fetchall() with given query, expecting SELECT statement
-    Comparing to query(), this should support more databases, such as Hive, but NOT SQLite...
+    Comparing to query(), this should support more databases, such as Hive
+    With chunksize or tablename, the result is fetched with fetchmany(), so that a large result is not held in
+    memory at once.
     :param sql: (SELECT) SQL statement
     :param conn: DB connection (cursor)
-    :return: Panda DataFrame
+    :param chunksize: If given (without tablename), return a generator of DataFrames of this many rows
+    :param tablename: If given, save the result into this local table (replaced), and return the number of rows
+    :param local_conn: DB connection object for tablename. If None, connect()
+    :return: Panda DataFrame, generator of DataFrames, or number of rows
     #>>> hc = hive_conn("jdbc:hive2://localhost:10000/default")
     #>>> df = query_execute("SELECT 1", hc)
     #>>> bool(df)
     #True
-    >>> pass    # TODO: implement test
+    #>>> query_execute("SELECT * FROM big_table", hc, tablename="t_big_table"); q("SELECT count(*) FROM t_big_table")
+    >>> c = connect(); _ = c.execute("CREATE TABLE t_test_qe AS SELECT 1 AS a UNION ALL SELECT 2 UNION ALL SELECT 3")
+    >>> [len(df) for df in query_execute("SELECT a FROM t_test_qe", c, chunksize=2)]
+    [2, 1]
+    >>> query_execute("SELECT a FROM t_test_qe", c, chunksize=2, tablename="t_test_qe_copy")
+    3
+    >>> query("SELECT SUM(a) AS s FROM t_test_qe_copy", c, no_history=True)['s'][0]
+    6
+    >>> _ = c.execute("DROP TABLE t_test_qe"); _ = c.execute("DROP TABLE t_test_qe_copy")
     """
-    conn.execute(sql)
-    result = conn.fetchall()
+    if bool(tablename):
+        if bool(local_conn) is False: local_conn = connect()
+        rows = 0
+        if_exists = 'replace'
+        for df in _fetch_chunks(sql, conn, chunksize=chunksize or 100000, empty_chunk=True):
+            rows += _df2table(df, conn=local_conn, tablename=tablename, if_exists=if_exists, index=False)
+            if_exists = 'append'
+        _autocomp_inject(tablename=tablename, conn=local_conn)
+        return rows
+    if bool(chunksize):
+        return _fetch_chunks(sql, conn, chunksize=chunksize)
+    cur = _execute_cursor(sql, conn)
+    result = cur.fetchall()
     if bool(result):
         return pd.DataFrame(result)
     return result
 
 
-def _escape_query(sql):
+def _execute_cursor(sql, conn):
     """
-    TODO: would need to add more characters for escaping (eg: - in table name requires double quotes)
-    :param sql:
-    :return: string - escaped query
+    Execute the sql and return the cursor which has the result
+    (jaydebeapi's cursor.execute() returns None, sqlite3's connection.execute() returns a new cursor)
+    :param sql: SQL statement
+    :param conn: DB connection (cursor)
+    :return: cursor object
+    >>> _execute_cursor("SELECT 1", connect()).fetchall()
+    [(1,)]
     """
-    return sql.replace("'", "''")
+    cur = conn.execute(sql)
+    if cur is not None and hasattr(cur, 'fetchmany'):
+        return cur
+    return conn
 
 
-def _save_query(sql, limit=1000):
+def _fetch_chunks(sql, conn, chunksize=100000, empty_chunk=False):
     """
-    Save a sql into a history file
-    :param sql: query string
-    :param limit: How many queies stores into a history file. Default is 1000
-    :return: void
-    >>> pass    # Testing in qhistory()
+    Execute the sql and yield the result as DataFrames with fetchmany() (column names from cursor.description)
+    :param sql: (SELECT) SQL statement
+    :param conn: DB connection (cursor)
+    :param chunksize: Number of rows per DataFrame
+    :param empty_chunk: If True and no row, yield one empty DataFrame which has the columns
+    :return: generator of DataFrames
+    >>> [df.columns.tolist() for df in _fetch_chunks("SELECT 1 AS a WHERE 1=0", connect(), empty_chunk=True)]
+    [['a']]
     """
-    query_history_csv = os.getenv('JN_UTILS_QUERY_HISTORY', os.getenv('HOME') + os.path.sep + ".ju_qhistory")
-    # removing spaces and last ';'
-    sql = sql.strip().rstrip(';')
-    df_new = pd.DataFrame([[_timestamp(format="%Y%m%d%H%M%S"), sql]], columns=["datetime", "query"])
-    df_hist = csv2df(query_history_csv, header=None)
-    if df_hist is False:
-        df = df_new
-    else:
-        # If not empty (= same query exists), drop/remove old dupe row(s), so that time will be new.
-        df_hist.columns = ["datetime", "query"]
-        df_hist_new = df_hist[df_hist['query'].str.lower().isin([sql.lower()]) == False]
-        df = df_hist_new.append(df_new, ignore_index=True, sort=False)
-    # Currently not appending but overwriting whole file.
-    df2csv(df.tail(limit), query_history_csv, mode="w", header=False)
+    cur = _execute_cursor(sql, conn)
+    columns = [d[0] for d in cur.description] if bool(cur.description) else None
+    yielded = False
+    while True:
+        rows = cur.fetchmany(chunksize)
+        if bool(rows) is False:
+            break
+        yielded = True
+        yield pd.DataFrame.from_records(rows, columns=columns)
+    if yielded is False and empty_chunk:
+        yield pd.DataFrame(columns=columns)
 
 
-def _autocomp_matcher(text):
+def _pa_array(values, pa_type=None):
     """
-    This function is supposed to be a custom matcher for IPython Completer
-    TODO: doesn't work (can't register/append in matchers from 'ju' name space)
-    :param text:
-    :return:
+    Convert a list of values to a pyarrow Array. If the values have mixed types (SQLite allows), use string
+    :param values: list of values
+    :param pa_type: pyarrow DataType. If None, inferred
+    :return: pyarrow Array
+    >>> _pa_array([1, 'a', None]).to_pylist()
+    ['1', 'a', None]
     """
-    global _LAST_CONN
-    conn = _LAST_CONN
-    # Currently only searching table object
-    sql_and = " and tbl_name like '" + str(text) + "%'"
-    rs = conn.execute("select distinct name from sqlite_master where type = 'table'%s" % (sql_and))
-    if bool(rs) is False:
-        return
-    return _get_col_vals(rs.fetchall(), 0)
+    try:
+        return pa.array(values, type=pa_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, OverflowError):
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
 
 
-def _autocomp_inject(tablename=None):
+def _cursor2batches(cursor, batch_size=100000, schema=None):
     """
-    Some hack to use autocomplete in the SQL
-    TODO: doesn't work any more with newer jupyter lab|notebook
-    :param tablename: Optional
-    :return: Void
+    Generator to convert a DB-API cursor result to pyarrow RecordBatches with fetchmany()
+    :param cursor: A cursor which already executed a query
+    :param batch_size: Number of rows per batch
+    :param schema: pyarrow Schema. If None, each batch's types are inferred
+    :return: Generator of RecordBatch objects
+    >>> pass    # Testing in query() and table2parquet()
     """
-    if bool(tablename):
-        tables = [tablename]
-    else:
-        tables = describe().name.to_list()
+    names = [d[0] for d in cursor.description]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if bool(rows) is False:
+            break
+        cols = list(zip(*rows))
+        if schema is None:
+            arrays = [_pa_array(list(c)) for c in cols]
+        else:
+            arrays = [_pa_array(list(c), schema.field(i).type) for i, c in enumerate(cols)]
+        yield pa.RecordBatch.from_arrays(arrays, names=names)
 
-    for t in tables:
-        cols = describe(t).name.to_list()
-        tbl_cls = _gen_class(t, cols)
-        try:
-            get_ipython().user_global_ns[t] = tbl_cls
-            # globals()[t] = tbl_cls
-            # locals()[t] = tbl_cls
-        except:
+
+def _query2arrow(sql, conn, batch_size=100000):
+    """
+    Run a query and return the result as a pyarrow Table
+    :param sql: SELECT statement
+    :param conn: DB connection object
+    :param batch_size: Number of rows per record batch
+    :return: pyarrow Table or False if pyarrow is not installed
+    >>> pass    # Testing in query()
+    """
+    if pa is None:
+        _err("pyarrow is not installed.")
+        return False
+    cur = conn.execute(sql)
+    batches = list(_cursor2batches(cur, batch_size))
+    if len(batches) == 0:
+        names = [d[0] for d in cur.description]
+        return pa.table({n: pa.array([], type=pa.null()) for n in names})
+    # Types can be different per batch (eg: first batch was all NULL), so unifying
+    tables = [pa.Table.from_batches([b]) for b in batches]
+    try:
+        return pa.concat_tables(tables, promote_options="permissive")
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    except TypeError:
+        # older pyarrow doesn't have promote_options (NOTE: ArrowTypeError is also TypeError)
+        try:
+            return pa.concat_tables(tables, promote=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+    # Some column has mixed types, so inferring each column from all values (mixed one becomes string)
+    cols = {}
+    for n in tables[0].column_names:
+        cols[n] = _pa_array(sum([t.column(n).to_pylist() for t in tables], []))
+    return pa.table(cols)
+
+
+def _escape_query(sql):
+    """
+    TODO: would need to add more characters for escaping (eg: - in table name requires double quotes)
+    :param sql:
+    :return: string - escaped query
+    """
+    return sql.replace("'", "''")
+
+
+def _qhistory_conn():
+    """
+    Return the connection of the query history DB (SQLite), creating the table and indexes if not exist
+    The file path is from JN_UTILS_QUERY_HISTORY env, or $HOME/.ju_qhistory.db
+    The old CSV history file ($HOME/.ju_qhistory) is imported when the DB is created.
+    :return: sqlite3 connection object
+    >>> pass    # Testing in qhistory()
+    """
+    global _QHISTORY_CONN
+    db_path = os.getenv('JN_UTILS_QUERY_HISTORY', os.getenv('HOME') + os.path.sep + ".ju_qhistory.db")
+    if bool(_QHISTORY_CONN) and _QHISTORY_CONN[0] == db_path and os.path.exists(db_path):
+        return _QHISTORY_CONN[1]
+    is_new = (os.path.exists(db_path) is False)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    # query_key is the normalised (lower-cased, single-spaced) query
+    conn.execute("""CREATE TABLE IF NOT EXISTS qhistory (id INTEGER PRIMARY KEY, datetime TEXT NOT NULL,
+    query TEXT NOT NULL, query_key TEXT NOT NULL COLLATE NOCASE)""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS qhistory_query_key ON qhistory (query_key COLLATE NOCASE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS qhistory_datetime ON qhistory (datetime)")
+    # One row per execution
+    conn.execute("""CREATE TABLE IF NOT EXISTS qhistory_runs (id INTEGER PRIMARY KEY, qhistory_id INTEGER NOT NULL,
+    datetime TEXT NOT NULL, elapsed_ms REAL, rows INTEGER, tables TEXT, plan TEXT)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS qhistory_runs_qhistory_id ON qhistory_runs (qhistory_id, datetime)")
+    _QHISTORY_CONN = (db_path, conn)
+    legacy_csv = os.getenv('HOME') + os.path.sep + ".ju_qhistory"
+    if is_new and os.path.isfile(legacy_csv):
+        import csv
+        try:
+            with open(legacy_csv) as f:
+                rows = [(r[0], r[1]) for r in csv.reader(f, escapechar='\\') if len(r) > 1]
+            conn.execute("BEGIN")
+            for (dt, sql) in rows:
+                _upsert_query(conn, sql, dt)
+            conn.commit()
+            _err("Imported %d queries from %s into %s" % (len(rows), legacy_csv, db_path))
+        except Exception as e:
+            _err("WARN: Could not import %s: %s" % (legacy_csv, str(e)))
+    return conn
+
+
+def _normalise_query(sql):
+    """
+    Normalise a query to detect same queries
+    :param sql: query string
+    :return: (stripped query, normalised key)
+    >>> _normalise_query("SELECT  *\\n FROM t; ")
+    ('SELECT  *\\n FROM t', 'select * from t')
+    """
+    # removing spaces and last ';'
+    sql = sql.strip().rstrip(';').strip()
+    return (sql, re.sub(r'\s+', ' ', sql).lower())
+
+
+def _upsert_query(conn, sql, dt):
+    (sql, key) = _normalise_query(sql)
+    # If same query exists, only the datetime (and query text) is updated
+    return conn.execute("""INSERT INTO qhistory (datetime, query, query_key) VALUES (?, ?, ?)
+    ON CONFLICT(query_key) DO UPDATE SET datetime = excluded.datetime, query = excluded.query""", (dt, sql, key))
+
+
+def _explain_query(sql, conn):
+    """
+    Return the tables which a query reads and the summary of EXPLAIN QUERY PLAN (SQLite only)
+    The table names are from the root pages of OpenRead in EXPLAIN (the query is not executed, and no authorizer)
+    :param sql: query string
+    :param conn: sqlite3 connection object
+    :return: (comma separated table names, plan summary) or (None, None)
+    >>> _ = _df2table(pd.DataFrame([{"a": 1}]), connect(), "t_test_explain")
+    >>> _explain_query("select * from t_test_explain", connect())
+    ('t_test_explain', 'SCAN t_test_explain')
+    >>> _ = connect().execute("DROP TABLE t_test_explain")
+    """
+    if isinstance(conn, sqlite3.Connection) is False:
+        return (None, None)
+    try:
+        plan = "; ".join([str(r[-1]) for r in conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()])
+        # (addr, opcode, p1, p2 = root page, p3 = database index, ...). Index pages are mapped to the table
+        pages = [(r[4], r[3]) for r in conn.execute("EXPLAIN " + sql).fetchall() if r[1] == 'OpenRead']
+        roots = {(0, r[0]): r[1] for r in conn.execute("SELECT rootpage, tbl_name FROM sqlite_master").fetchall()}
+        if any(p[0] == 1 for p in pages):
+            roots.update({(1, r[0]): r[1] for r in
+                          conn.execute("SELECT rootpage, tbl_name FROM sqlite_temp_master").fetchall()})
+    except Exception as e:
+        _debug("EXPLAIN QUERY PLAN failed: %s" % (str(e)))
+        return (None, None)
+    tables = []
+    for p in pages:
+        t = roots.get(p)
+        if t is not None and t not in tables and t.startswith("sqlite_") is False:
+            tables.append(t)
+    return (",".join(tables), plan)
+
+
+def _explain_cached(sql, conn):
+    """
+    Return _explain_query() result, cached per connection, query and schema version
+    :param sql: query string
+    :param conn: sqlite3 connection object
+    :return: (comma separated table names, plan summary) or (None, None)
+    >>> _explain_cached("select 1", None)
+    (None, None)
+    """
+    global _EXPLAIN_CACHE
+    if isinstance(conn, sqlite3.Connection) is False:
+        return (None, None)
+    key = (id(conn), sql, conn.execute("PRAGMA schema_version").fetchall()[0][0])
+    if key not in _EXPLAIN_CACHE:
+        if len(_EXPLAIN_CACHE) > 1000:
+            _EXPLAIN_CACHE.clear()
+        _EXPLAIN_CACHE[key] = _explain_query(sql, conn)
+    return _EXPLAIN_CACHE[key]
+
+
+def _save_query(sql, limit=1000, elapsed_ms=None, rows=None, conn=None, max_runs=10000):
+    """
+    Save a sql into the query history DB
+    :param sql: query string
+    :param limit: How many queies stores into a history DB. Default is 1000
+    :param elapsed_ms: Wall time of this execution in milliseconds
+    :param rows: Number of returned rows
+    :param conn: DB connection which executed the query. Used for EXPLAIN QUERY PLAN if _QHISTORY_EXPLAIN is True
+    :param max_runs: How many executions (qhistory_runs) are kept
+    :return: void
+    >>> pass    # Testing in qhistory()
+    """
+    hconn = _qhistory_conn()
+    dt = _timestamp(format="%Y%m%d%H%M%S")
+    _upsert_query(hconn, sql, dt)
+    (sql, key) = _normalise_query(sql)
+    qid = hconn.execute("SELECT id FROM qhistory WHERE query_key = ?", (key,)).fetchall()[0][0]
+    (tables, plan) = _explain_cached(sql, conn) if (_QHISTORY_EXPLAIN and bool(conn)) else (None, None)
+    hconn.execute("INSERT INTO qhistory_runs (qhistory_id, datetime, elapsed_ms, rows, tables, plan) "
+                  "VALUES (?, ?, ?, ?, ?, ?)", (qid, dt, elapsed_ms, rows, tables, plan))
+    # Using the datetime index (which contains id) to find older ones
+    res = hconn.execute("""DELETE FROM qhistory WHERE id IN (
+    SELECT id FROM qhistory ORDER BY datetime DESC, id DESC LIMIT -1 OFFSET ?)""", (limit,))
+    if res.rowcount > 0:
+        hconn.execute("DELETE FROM qhistory_runs WHERE qhistory_id NOT IN (SELECT id FROM qhistory)")
+    hconn.execute("DELETE FROM qhistory_runs WHERE id <= (SELECT MAX(id) FROM qhistory_runs) - ?", (max_runs,))
+
+
+def _autocomp_matcher(text):
+    """
+    This function is supposed to be a custom matcher for IPython Completer
+    TODO: doesn't work (can't register/append in matchers from 'ju' name space)
+    :param text:
+    :return:
+    """
+    global _LAST_CONN
+    conn = _LAST_CONN
+    # Currently only searching table object
+    sql_and = " and tbl_name like '" + str(text) + "%'"
+    rs = conn.execute("select distinct name from sqlite_master where type = 'table'%s" % (sql_and))
+    if bool(rs) is False:
+        return
+    return _get_col_vals(rs.fetchall(), 0)
+
+
+def _autocomp_inject(tablename=None, conn=None):
+    """
+    Some hack to use autocomplete in the SQL
+    TODO: doesn't work any more with newer jupyter lab|notebook
+    :param tablename: Optional
+    :param conn: DB connection (cursor) object
+    :return: Void
+    """
+    if bool(conn) is False: conn = connect()
+    if bool(tablename):
+        tables = [tablename]
+    else:
+        tables = _get_col_vals(conn.execute("select name from sqlite_master where type = 'table'").fetchall(), 0)
+
+    for t in tables:
+        cols = _catalog_get(t, conn).get('columns', [])
+        tbl_cls = _gen_class(t, cols)
+        try:
+            get_ipython().user_global_ns[t] = tbl_cls
+            # globals()[t] = tbl_cls
+            # locals()[t] = tbl_cls
+        except:
             _debug("get_ipython().user_global_ns failed")
             pass
 
@@ -812,14 +2087,18 @@ def _gen_class(name, attrs=None, def_value=True):
     return c
 
 
-def display(df, name=""):
+def display(df, name="", page=1, page_size=None):
     """
     Wrapper of IPython.display.display
+    In Jupyter, only one page (page_size rows) is converted to HTML, so that a huge DataFrame doesn't freeze a browser
     :param df: A DataFrame object
     :param name: Used when saving into file
+    :param page: Page number (starting from 1) to display in Jupyter
+    :param page_size: Rows per page. Default is _DISPLAY_PAGE_SIZE
     :return Void
     >>> pass
     """
+    global _DISPLAY_PAGE_SIZE
     if bool(name) is False:
         name = _timestamp(format="%Y%m%d%H%M%S%f")
     is_jupyter = True
@@ -829,30 +2108,273 @@ def display(df, name=""):
         is_jupyter = False
         pass
     if is_jupyter:
-        out = IPython.display.HTML(df.to_html())
-        IPython.display.display(out)
+        if bool(page_size) is False:
+            page_size = _DISPLAY_PAGE_SIZE
+        import IPython
+        html = _page_html(df, page=page, page_size=page_size)
+        IPython.display.display(IPython.display.HTML(html))
     else:
         # print(df.to_html())
         df2csv(df=df, file_path="%s.csv" % (str(name)))
 
 
-def draw(df, width=8, x_col=0, x_colname=None, name="", tail=10):
+def _page_html(df, page=1, page_size=200, total=None):
+    """
+    Convert one page of a DataFrame to HTML with 'Rows x - y of N' footer
+    :param df: A DataFrame object (whole rows or already one page if total is given)
+    :param page: Page number (starting from 1). If None (keyset paging), the absolute row range is unknown, so
+                 only the number of rows is shown
+    :param page_size: Rows per page
+    :param total: Total number of rows if df is already one page
+    :return: HTML string
+    >>> "Rows 3 - 4 of 5" in _page_html(pd.DataFrame({"a": range(5)}), page=2, page_size=2)
+    True
+    >>> "2 rows of 5" in _page_html(pd.DataFrame({"a": range(2)}), page=None, page_size=2, total=5)
+    True
+    """
+    if page is None:
+        return df.to_html() + "<p>%d rows of %s</p>" % (len(df), str(total))
+    if total is None:
+        total = len(df)
+        if total <= page_size:
+            return df.to_html()
+        start = (max(int(page), 1) - 1) * page_size
+        df = df.iloc[start:start + page_size]
+    else:
+        start = (max(int(page), 1) - 1) * page_size
+    footer = "<p>Rows %d - %d of %s (page %d of %s)</p>" % (
+        start + 1, start + len(df), str(total), max(int(page), 1),
+        str(int((int(total) + page_size - 1) / page_size)) if _is_numeric(total) else "?")
+    return df.to_html() + footer
+
+
+def browse(sql, page=1, page_size=None, key_col=None, after=None, count=True, conn=None, html=True):
+    """
+    Display a query result page by page. Only one page is fetched from the DB (LIMIT/OFFSET),
+    or with key_col and after, keyset paging (WHERE key_col > after ORDER BY key_col LIMIT) which is fast for any page
+    :param sql: SELECT statement
+    :param page: Page number (starting from 1). Ignored if 'after' is given
+    :param page_size: Rows per page. Default is _DISPLAY_PAGE_SIZE
+    :param key_col: Unique and ordered column name for keyset paging (eg: 'rowid' of a table, 'id')
+    :param after: The last key_col value of the previous page
+    :param count: If True, run SELECT COUNT(*) to show the total number of rows (this scans the result once)
+    :param conn: DB connection object
+    :param html: If False, return the page as DataFrame
+    :return: DataFrame of the page if html is False
+    #>>> ju.browse("SELECT rowid, * FROM t_logs", key_col="rowid", after=123456)
+    >>> browse("SELECT 1 AS a UNION ALL SELECT 2 UNION ALL SELECT 3", page=2, page_size=2, html=False)['a'].tolist()
+    [3]
+    """
+    global _DISPLAY_PAGE_SIZE
+    if bool(conn) is False: conn = connect()
+    if bool(page_size) is False:
+        page_size = _DISPLAY_PAGE_SIZE
+    if bool(key_col):
+        where_sql = ""
+        params = [int(page_size)]
+        if after is not None:
+            where_sql = "WHERE %s > ?" % (_quote_ident(key_col))
+            params.insert(0, after)
+        page_sql = "SELECT * FROM (%s) %s ORDER BY %s LIMIT ?" % (sql, where_sql, _quote_ident(key_col))
+    else:
+        params = [int(page_size), (max(int(page), 1) - 1) * int(page_size)]
+        page_sql = "SELECT * FROM (%s) LIMIT ? OFFSET ?" % (sql)
+    df = pd.read_sql(page_sql, conn, params=params)
+    if html is False:
+        return df
+    total = conn.execute("SELECT COUNT(*) FROM (%s)" % (sql)).fetchall()[0][0] if count else "?"
+    if bool(key_col) and len(df) > 0:
+        _err("Next page: browse(sql, key_col='%s', after=%s)" % (key_col, repr(df[key_col].iloc[-1])))
+    if bool(key_col):
+        # Keyset paging doesn't know the offset of this page, so not showing the page number (except the first)
+        page = 1 if after is None else None
+    try:
+        get_ipython()
+        import IPython
+        IPython.display.display(IPython.display.HTML(_page_html(df, page=page, page_size=page_size, total=total)))
+    except NameError:
+        print(df.to_string())
+        print("Rows of page %s: %d / total: %s" % (str(page) if page is not None else "after %s" % (repr(after)),
+                                                    len(df), str(total)))
+
+
+def _x_as_numbers(series):
+    """
+    Convert X axis values to float numbers (datetime-like strings become epoch nanoseconds) for bucketing
+    If not numeric nor datetime, row positions are used
+    :param series: Pandas Series
+    :return: numpy array of float
+    >>> _x_as_numbers(pd.Series(["a", "b"])).tolist()
+    [0.0, 1.0]
+    """
+    if pd.api.types.is_numeric_dtype(series):
+        xs = series.to_numpy(dtype=float)
+    else:
+        dt = pd.to_datetime(series, errors='coerce')
+        if dt.isna().any():
+            return np.arange(len(series), dtype=float)
+        xs = dt.values.astype('datetime64[ns]').astype('int64').astype(float)
+    if np.isnan(xs).any():
+        return np.arange(len(series), dtype=float)
+    return xs
+
+
+def _lttb_indices(x, y, n):
+    """
+    Largest-Triangle-Three-Buckets: pick n row positions which keep the visual shape of (x, y)
+    :param x: numpy array of float (sorted)
+    :param y: numpy array of float
+    :param n: Number of points to keep
+    :return: numpy array of row positions
+    >>> _lttb_indices(np.arange(10.0), np.array([0, 0, 0, 9, 0, 0, 0, 0, 0, 0.0]), 4).tolist()
+    [0, 3, 5, 9]
+    """
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+    y = np.nan_to_num(y)
+    edges = np.linspace(1, size - 1, n - 1).astype(int)
+    idx = [0]
+    a = 0
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+        if end <= start:
+            continue
+        nstart = end
+        nend = edges[i + 2] if (i + 2) < len(edges) else size
+        avg_x = x[nstart:nend].mean()
+        avg_y = y[nstart:nend].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        idx.append(a)
+    idx.append(size - 1)
+    return np.array(idx)
+
+
+def _downsample(df, x_colname, n_buckets=1000, method="minmax"):
+    """
+    Reduce rows of a DataFrame for drawing, keeping spikes
+    :param df: A DataFrame object (rows should be ordered by x_colname)
+    :param x_colname: X axis column name
+    :param n_buckets: Number of buckets (about the number of pixels of X axis)
+    :param method: 'minmax' (rows of min and max of each numeric column per bucket) or 'lttb'
+    :return: Downsampled DataFrame
+    >>> df = pd.DataFrame({"x": range(1000), "y": [0] * 500 + [100] + [0] * 499})
+    >>> df2 = _downsample(df, "x", 10)
+    >>> len(df2) <= 40, df2['y'].max()
+    (True, 100)
+    """
+    if len(df) <= (n_buckets * 2):
+        return df
+    y_cols = [c for c in df.columns if c != x_colname and pd.api.types.is_numeric_dtype(df[c])]
+    if len(y_cols) == 0:
+        return df
+    xs = _x_as_numbers(df[x_colname])
+    positions = set([0, len(df) - 1])
+    if method == "lttb":
+        for c in y_cols:
+            positions.update(_lttb_indices(xs, df[c].to_numpy(dtype=float), n_buckets).tolist())
+    else:
+        width = (xs.max() - xs.min()) / n_buckets
+        buckets = ((xs - xs.min()) / (width if width > 0 else 1)).astype(int)
+        g = df[y_cols].reset_index(drop=True).groupby(buckets)
+        for agg in [g.idxmin(), g.idxmax()]:
+            positions.update(int(p) for p in pd.unique(agg.values.ravel()) if pd.notna(p))
+    return df.iloc[sorted(positions)]
+
+
+def _query_downsampled(sql, x_col=0, n_buckets=1000, conn=None):
+    """
+    Run a query with min/max per bucket aggregation pushed down into SQLite, so that millions of rows are not
+    fetched into pandas. Each bucket returns two rows: (first x, min of each column) and (last x, max of each column)
+    :param sql: SELECT statement which first (or x_col) column is date/time string or number
+    :param x_col: Column index number or name used for X axis
+    :param n_buckets: Number of buckets
+    :param conn: DB connection object
+    :return: DataFrame which first column is the X axis column, followed by the numeric columns
+    >>> _ = _df2table(pd.DataFrame({"x": range(1000), "y": [0] * 500 + [100] + [0] * 499}), connect(), "t_test_ds")
+    >>> df = _query_downsampled("select x, y from t_test_ds", n_buckets=10)
+    >>> len(df) <= 22, df['y'].max()
+    (True, 100.0)
+    >>> list(_query_downsampled("select CASE WHEN x > 0 THEN y END AS z, 'a' AS s, x from t_test_ds", x_col=2).columns)
+    ['x', 'z']
+    >>> _ = connect().execute("DROP TABLE t_test_ds")
+    """
+    if bool(conn) is False: conn = connect()
+    # The column types are decided from the first non-NULL value in the sample rows (a query result has no declared
+    # type), and if all sampled values are NULL, from the first non-NULL value of the whole result
+    cur = conn.execute("SELECT * FROM (%s) LIMIT 100" % (sql))
+    cols = [d[0] for d in cur.description]
+    sample = cur.fetchall()
+    if len(sample) == 0:
+        return pd.DataFrame(columns=cols)
+    types = []
+    for i, c in enumerate(cols):
+        vals = [r[i] for r in sample if r[i] is not None]
+        if len(vals) == 0:
+            vals = [r[0] for r in conn.execute("SELECT %s FROM (%s) WHERE %s IS NOT NULL LIMIT 1" % (
+                _quote_ident(c), sql, _quote_ident(c))).fetchall()]
+        types.append(type(vals[0]) if len(vals) > 0 else None)
+    x_name = x_col if x_col in cols else cols[int(x_col)]
+    x_idx = cols.index(x_name)
+    y_cols = [c for i, c in enumerate(cols) if i != x_idx and types[i] in [int, float]]
+    if types[x_idx] in [int, float]:
+        x_num = "%s"
+    else:
+        # julianday() does not accept timezone without ':' (eg: +0800), so using only 'YYYY-MM-DD HH:MM:SS'
+        x_num = "julianday(SUBSTR(%s, 1, 19))"
+    sels = ["MIN(%s) AS _x_min" % (_quote_ident(x_name)), "MAX(%s) AS _x_max" % (_quote_ident(x_name))]
+    for i, c in enumerate(y_cols):
+        sels.append("MIN(CAST(%s AS REAL)) AS _min_%d" % (_quote_ident(c), i))
+        sels.append("MAX(CAST(%s AS REAL)) AS _max_%d" % (_quote_ident(c), i))
+    # The range is from MIN/MAX of x (expecting ISO-like date time string), so that x_num is computed once per row
+    x = _quote_ident(x_name)
+    (lo, hi) = conn.execute("SELECT %s, %s FROM (SELECT MIN(%s) AS _min, MAX(%s) AS _max FROM (%s))" % (
+        x_num % ("_min"), x_num % ("_max"), x, x, sql)).fetchall()[0]
+    if lo is None or hi is None:
+        _err("Could not convert %s to numbers, so not downsampling." % (x_name))
+        df = query(sql, conn=conn, no_history=True)
+        return df[[x_name] + [c for c in df.columns if c != x_name]]
+    width = (hi - lo) / int(n_buckets)
+    agg_sql = """SELECT %s
+FROM (%s)
+GROUP BY CAST((%s - %r) / %r AS INTEGER)
+ORDER BY 1""" % (", ".join(sels), sql, x_num % (x), lo, (width if width > 0 else 1))
+    _debug(agg_sql)
+    df_agg = pd.read_sql(agg_sql, conn)
+    df_min = pd.DataFrame({x_name: df_agg['_x_min']})
+    df_max = pd.DataFrame({x_name: df_agg['_x_max']})
+    for i, c in enumerate(y_cols):
+        df_min[c] = df_agg['_min_%d' % (i)]
+        df_max[c] = df_agg['_max_%d' % (i)]
+    df = pd.concat([df_min, df_max]).sort_values(by=x_name, kind='mergesort')
+    return df.reset_index(drop=True)
+
+
+def draw(df, width=8, x_col=0, x_colname=None, name="", tail=10, max_points=None, method="minmax"):
     """
     Helper function for df.plot()
     As pandas.DataFrame.plot is a bit complicated, using simple options only if this method is used.
     https://pandas.pydata.org/pandas-docs/stable/generated/pandas.DataFrame.plot.html
 
     :param df: A DataFrame object, which first column will be the 'x' if x_col is not specified
+               Or a SELECT statement, then min/max downsampling is done in SQL (method='minmax')
     :param width: This is Inch and default is 16 inch.
     :param x_col: Column index number used for X axis.
     :param x_colname: If column name is given, use this instead of x_col.
+                      If df is a SELECT statement downsampled in SQL, the X column becomes the first column.
     :param name: When saving to file.
     :param tail: To return some sample rows.
+    :param max_points: Number of buckets (about pixels) for downsampling. Default is width * 100 (dpi)
+                       0 or False to disable downsampling
+    :param method: 'minmax' or 'lttb' (Largest-Triangle-Three-Buckets)
     :return: DF (use .tail() or .head() to limit the rows)
     #>>> draw(ju.q("SELECT date, statuscode, bytesSent, elapsedTime from t_request_csv")).tail()
     #>>> draw(ju.q("select QueryHour, SumSqSqlWallTime, SumPostPlanTime, SumSqPostPlanTime from query_stats")).tail()
+    #>>> draw("SELECT date_time, elapsedTime FROM t_request_logs", max_points=2000)
     >>> pass    # TODO: implement test
     """
+    import matplotlib.pyplot as plt
     is_jupyter = True
     if bool(name) is False:
         name = _timestamp(format="%Y%m%d%H%M%S%f")
@@ -862,6 +2384,14 @@ def draw(df, width=8, x_col=0, x_colname=None, name="", tail=10):
         is_jupyter = False
         _debug("get_ipython().run_line_magic('matplotlib', 'inline') failed")
         pass
+    if max_points is None:
+        max_points = int(width * 100)
+    if isinstance(df, str):
+        if bool(max_points) and method == "minmax":
+            df = _query_downsampled(df, x_col=(x_colname if bool(x_colname) else x_col), n_buckets=max_points)
+            x_colname = df.columns[0] if len(df.columns) > 0 else x_colname
+        else:
+            df = query(df)
     height_inch = 8
     if len(df) == 0:
         _debug("No rows to draw.")
@@ -870,7 +2400,11 @@ def draw(df, width=8, x_col=0, x_colname=None, name="", tail=10):
         height_inch = len(df.columns) * 4
     if bool(x_colname) is False:
         x_colname = df.columns[x_col]
-    df.plot(figsize=(width, height_inch), x=x_colname, subplots=True, sharex=True)
+    df_plot = df
+    if bool(max_points) and len(df) > (max_points * 2):
+        df_plot = _downsample(df, x_colname, n_buckets=max_points, method=method)
+        _debug("Downsampled %d rows to %d" % (len(df), len(df_plot)))
+    df_plot.plot(figsize=(width, height_inch), x=x_colname, subplots=True, sharex=True)
     if len(name) > 0:
         plt.savefig("%s.png" % (str(name)))
     if is_jupyter:
@@ -884,21 +2418,27 @@ def draw(df, width=8, x_col=0, x_colname=None, name="", tail=10):
     return df.tail(tail)
 
 
-def gantt(df, index_col="", start_col="min_dt", end_col="max_dt", width=8, name="", tail=10):
+def gantt(df, index_col="", start_col="min_dt", end_col="max_dt", width=8, name="", tail=10, max_lanes=60):
     """
-    Helper function for plt.hlines()
+    Draw a gantt chart (eg: thread timeline) with one LineCollection, so thousands of rows are drawn quickly
     based on https://stackoverflow.com/questions/31820578/how-to-plot-stacked-event-duration-gantt-charts-using-python-pandas
 
-    :param df: A DataFrame object, which first column will be the 'x' if x_col is not specified
-    :param index_col: index column name. default: df.index
+    :param df: A DataFrame object, which contains index_col, start_col and end_col (see gantt_table())
+    :param index_col: index (lane label) column name. default: df.index
     :param start_col: start column name. default: 'min_dt'
     :param end_col: end column name. default: 'max_dt'
     :param width: This is Inch and default is 16 inch.
     :param name: When saving to file.
     :param tail: To return some sample rows.
+    :param max_lanes: If more rows than this, the longest (max_lanes - 1) rows are drawn in own lane and the rest
+                      are aggregated into one 'others' lane
     :return: DF (use .tail() or .head() to limit the rows)
+    #>>> gantt(ju.q("SELECT thread, MIN(date_time) AS min_dt, MAX(date_time) AS max_dt FROM t_logs GROUP BY thread"), "thread")
     >>> pass    # TODO: implement test
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    import matplotlib.dates as mdt
     is_jupyter = True
     if bool(name) is False:
         name = _timestamp(format="%Y%m%d%H%M%S%f")
@@ -911,18 +2451,31 @@ def gantt(df, index_col="", start_col="min_dt", end_col="max_dt", width=8, name=
     if len(df) == 0:
         _debug("No rows to draw.")
         return
-    df[start_col] = pd.to_datetime(df[start_col])
-    df[end_col] = pd.to_datetime(df[end_col])
-    fig = plt.figure(figsize=(width, int(len(df) / 3)))
-    # TODO: don't know how to change this https://matplotlib.org/3.1.0/api/_as_gen/matplotlib.figure.Figure.html#matplotlib.figure.Figure.add_subplot
-    ax = fig.add_subplot(111)
-    ax = ax.xaxis_date()
-    if index_col is False:
-        y = df.index
-    else:
-        y = df[index_col]
-    import matplotlib.dates as mdt
-    ax = plt.hlines(y=y, xmin=mdt.date2num(df[start_col]), xmax=mdt.date2num(df[end_col]))
+    # Not modifying the given df. Sqlite does not like comma in datetime with milliseconds
+    starts = pd.to_datetime(df[start_col].astype(str).str.replace(",", ".", regex=False), errors='coerce')
+    ends = pd.to_datetime(df[end_col].astype(str).str.replace(",", ".", regex=False), errors='coerce')
+    labels = df.index.astype(str) if bool(index_col) is False else df[index_col].astype(str)
+    lanes = pd.DataFrame({'label': labels.values, 'x0': mdt.date2num(starts), 'x1': mdt.date2num(ends)}).dropna()
+    lanes = lanes.sort_values(by='x0', kind='mergesort').reset_index(drop=True)
+    lanes['y'] = np.arange(len(lanes))
+    ytick_labels = lanes['label'].tolist()
+    if len(lanes) > max_lanes:
+        keep = (lanes['x1'] - lanes['x0']).nlargest(max_lanes - 1).index.sort_values()
+        others = lanes.index.difference(keep)
+        lanes.loc[keep, 'y'] = np.arange(len(keep)) + 1
+        lanes.loc[others, 'y'] = 0
+        ytick_labels = ["others (%d)" % (len(others))] + lanes.loc[keep, 'label'].tolist()
+    segments = np.stack([np.column_stack([lanes['x0'], lanes['y']]), np.column_stack([lanes['x1'], lanes['y']])],
+                        axis=1)
+    height_inch = max(2, min(int(len(ytick_labels) / 4) + 1, 40))
+    fig, ax = plt.subplots(figsize=(width, height_inch))
+    ax.add_collection(LineCollection(segments, linewidths=4, alpha=0.6))
+    ax.set_xlim(lanes['x0'].min(), max(lanes['x1'].max(), lanes['x0'].min() + 1e-6))
+    ax.set_ylim(-1, len(ytick_labels))
+    ax.set_yticks(np.arange(len(ytick_labels)))
+    ax.set_yticklabels(ytick_labels)
+    ax.xaxis_date()
+    fig.tight_layout()
     if len(name) > 0:
         plt.savefig("%s.png" % (str(name)))
     if is_jupyter:
@@ -930,15 +2483,39 @@ def gantt(df, index_col="", start_col="min_dt", end_col="max_dt", width=8, name=
     return df.tail(tail)
 
 
-def qhistory(run=None, like=None, html=True, tail=20):
+def gantt_table(tablename="t_logs", lane_col="thread", time_col="date_time", where_sql="", conn=None, **kwargs):
+    """
+    Draw a gantt chart from a table with one grouped query (MIN/MAX of time_col per lane_col)
+    :param tablename: Table name
+    :param lane_col: Column name used as a lane (eg: thread)
+    :param time_col: Date time column name
+    :param where_sql: Optional WHERE clause (eg: "WHERE thread LIKE 'PolicyEvaluateService%'")
+    :param conn: DB connection object
+    :param kwargs: Passed to gantt() (eg: width, name, max_lanes)
+    :return: DF (use .tail() or .head() to limit the rows)
+    #>>> gantt_table("t_logs", "thread", where_sql="WHERE thread LIKE 'PolicyEvaluateService%'", max_lanes=100)
+    >>> pass    # TODO: implement test
+    """
+    sql = """SELECT %s AS lane, MIN(%s) AS min_dt, MAX(%s) AS max_dt, COUNT(*) AS num
+FROM %s %s
+GROUP BY %s""" % (_quote_ident(lane_col), _quote_ident(time_col), _quote_ident(time_col), _quote_ident(tablename),
+                  where_sql, _quote_ident(lane_col))
+    df = query(sql, conn=conn, no_history=True)
+    return gantt(df, index_col="lane", start_col="min_dt", end_col="max_dt", **kwargs)
+
+
+def qhistory(run=None, like=None, html=True, tail=20, slowest=None, trend=None):
     """
     Return query histories as DataFrame (so that it will be display nicely in Jupyter)
-    :param run: Integer of DataFrame row index which will be run
-    :param like: String used in 'like' to search 'query' column
+    :param run: Integer of history ID (DataFrame index) which will be run
+    :param like: String used in SQL 'like' against the normalised (lower-cased) query. 'select%' uses the index.
+                 If no '%', searched as a substring ('_' is not a wildcard, eg: like='t_logs')
     :param html: Whether output in HTML (default) or returning dataframe object
     :param tail: How many last record it displays (default 20)
+    :param slowest: Integer. Show this number of queries ordered by the max elapsed time, with runs/avg/max/total
+    :param trend: Integer of history ID. Show each execution (elapsed_ms, rows, tables, plan) of this query
     :return: Pandas DataFrame contains a list of queries
-    >>> import os; os.environ["JN_UTILS_QUERY_HISTORY"] = "/tmp/text_qhistory.csv"
+    >>> import os; os.environ["JN_UTILS_QUERY_HISTORY"] = "/tmp/text_qhistory.db"
     >>> _save_query("select 1")
     >>> df = qhistory(html=False)
     >>> len(df[df['query'] == 'select 1'])
@@ -947,26 +2524,80 @@ def qhistory(run=None, like=None, html=True, tail=20):
     >>> df = qhistory(html=False)
     >>> len(df)
     1
-    >>> os.remove("/tmp/text_qhistory.csv")
+    >>> len(qhistory(like="select%", html=False))
+    1
+    >>> _save_query("select * from t_logs")
+    >>> qhistory(like="t_logs", html=False)['query'].tolist()
+    ['select * from t_logs']
+    >>> _save_query("select 2", elapsed_ms=10.0, rows=1)
+    >>> qhistory(slowest=1, html=False)['max_ms'].tolist()
+    [10.0]
+    >>> qhistory(trend=qhistory(slowest=1, html=False).index[0], html=False)['rows'].tolist()
+    [1]
+    >>> c = connect(); _ = c.execute("CREATE TABLE t_test_qh AS SELECT 1 AS a")
+    >>> _ = query("SELECT * FROM t_test_qh WHERE a = 1", c); _ = c.execute("CREATE INDEX t_test_qh_a ON t_test_qh (a)")
+    >>> _ = query("SELECT * FROM t_test_qh WHERE a = 1", c)
+    >>> qhistory(trend=qhistory(like="t_test_qh", html=False).index[0], html=False)[['tables', 'plan']].values.tolist()
+    [['t_test_qh', 'SCAN t_test_qh'], ['t_test_qh', 'SEARCH t_test_qh USING COVERING INDEX t_test_qh_a (a=?)']]
+    >>> _ = c.execute("DROP TABLE t_test_qh")
+    >>> os.remove("/tmp/text_qhistory.db")
     """
-    query_history_csv = os.getenv('JN_UTILS_QUERY_HISTORY', os.getenv('HOME') + os.path.sep + ".ju_qhistory")
-    df = csv2df(query_history_csv, header=None)
-    if df is False or df.empty:
+    conn = _qhistory_conn()
+    if bool(slowest) or bool(trend):
+        if bool(slowest):
+            df = pd.read_sql("""SELECT q.id, q.query, COUNT(r.id) AS runs, AVG(r.elapsed_ms) AS avg_ms,
+    MAX(r.elapsed_ms) AS max_ms, SUM(r.elapsed_ms) AS total_ms, MAX(r.rows) AS max_rows, MAX(r.datetime) AS last_run
+FROM qhistory q JOIN qhistory_runs r ON q.id = r.qhistory_id
+WHERE r.elapsed_ms IS NOT NULL
+GROUP BY q.id, q.query
+ORDER BY max_ms DESC
+LIMIT ?""", conn, params=[int(slowest)], index_col='id')
+        else:
+            df = pd.read_sql("""SELECT datetime, elapsed_ms, rows, tables, plan FROM qhistory_runs
+WHERE qhistory_id = ? ORDER BY datetime, id""", conn, params=[int(trend)])
+            if len(df) > 0 and df['plan'].isnull().any():
+                # The runs without plan (_QHISTORY_EXPLAIN was False) are kept NULL, as today's plan may differ
+                rs = conn.execute("SELECT query FROM qhistory WHERE id = ?", (int(trend),)).fetchall()
+                (tables, plan) = _explain_query(rs[0][0], connect()) if bool(rs) else (None, None)
+                if plan is not None:
+                    _err("Current plan (not recorded for the runs with NULL plan): %s" % (plan))
+        if html is False:
+            return df
+        display(df)
         return
-    df.columns = ["datetime", "query"]
     if bool(run):
-        sql = df.loc[run, 'query']  # .loc[row_num, column_name]
+        rs = conn.execute("SELECT query FROM qhistory WHERE id = ?", (int(run),)).fetchall()
+        if bool(rs) is False:
+            _err("No query history for id = %s" % (str(run)))
+            return
+        sql = rs[0][0]
         _err(sql)
         return query(sql=sql, conn=connect())
+    where_sql = ""
+    params = []
     if bool(like):
-        df = df[df['query'].str.contains(like)]
+        like = like.lower()
+        if '%' in like:
+            where_sql = "WHERE query_key LIKE ?"
+            params.append(like)
+        else:
+            # substring match. Table names contain '_', so escaping it (and the escape character)
+            where_sql = "WHERE query_key LIKE ? ESCAPE '\\'"
+            params.append('%' + like.replace('\\', '\\\\').replace('_', '\\_') + '%')
+    limit_sql = ""
     if bool(tail):
-        df = df.tail(tail)
+        limit_sql = "LIMIT %d" % (int(tail))
+    sql = """SELECT id, datetime, query FROM (
+    SELECT id, datetime, query FROM qhistory %s ORDER BY datetime DESC, id DESC %s) ORDER BY datetime, id""" % (
+        where_sql, limit_sql)
+    df = pd.read_sql(sql, conn, params=params, index_col='id')
+    if df.empty:
+        return
     if html is False:
         # TODO: hist(html=False).groupby(['query']).count().sort_values(['count'])
         return df
     current_max_colwitdh = pd.get_option('display.max_colwidth')
-    pd.set_option('display.max_colwidth', -1)
+    pd.set_option('display.max_colwidth', None)
     display(df)
     pd.set_option('display.max_colwidth', current_max_colwitdh)
 
@@ -1000,6 +2631,274 @@ def describe(tablename=None, colname=None, conn=None):
 desc = describe
 
 
+def _catalog_sync(conn, cat, changes=0):
+    """
+    Forget all cached row counts if the connection made more row changes than the loaders reported, or another
+    connection committed (eg: DELETE or INSERT outside of the loaders), so that a stale number is never shown
+    :param conn: sqlite3 connection object
+    :param cat: the catalog dict of this connection
+    :param changes: Number of row changes the caller made (and reports) since the last sync
+    :return: True if the row counts were forgotten
+    >>> pass    # Testing in catalog()
+    """
+    data_version = conn.execute("PRAGMA data_version").fetchall()[0][0]
+    stale = (cat.get('_changes', conn.total_changes) + changes != conn.total_changes or
+             cat.get('_data_version', data_version) != data_version)
+    if stale:
+        for (k, entry) in cat.items():
+            if isinstance(entry, dict):
+                entry['rows'] = None
+    cat['_changes'] = conn.total_changes
+    cat['_data_version'] = data_version
+    return stale
+
+
+def _catalog_update(tablename, conn, rows=None, appending=False, changes=0):
+    """
+    Update the in-process schema catalog for one table (PRAGMA table_info only, no table scan)
+    Loaders call this after writing, so that row counts are known without SELECT count(*)
+    :param tablename: Table name
+    :param conn: sqlite3 connection object
+    :param rows: Number of rows written. None if unknown
+    :param appending: If True, rows are added to the current row count
+    :param changes: Number of row changes (INSERT/UPDATE/DELETE) the caller made since it was called last time
+    :return: the catalog entry (dict) or None
+    >>> pass    # Testing in catalog()
+    """
+    global _SCHEMA_CATALOG
+    if isinstance(conn, sqlite3.Connection) is False:
+        return None
+    cat = _SCHEMA_CATALOG.setdefault(id(conn), {})
+    _catalog_sync(conn, cat, changes)
+    cols = conn.execute("PRAGMA table_info(%s)" % (_quote_ident(tablename))).fetchall()
+    if len(cols) == 0:
+        cat.pop(tablename, None)
+        return None
+    prev = cat.get(tablename, {})
+    if appending:
+        rows = (prev.get('rows') + rows) if (rows is not None and prev.get('rows') is not None) else None
+    cat[tablename] = {'columns': [c[1] for c in cols], 'types': [c[2] for c in cols], 'rows': rows,
+                      'schema_version': conn.execute("PRAGMA schema_version").fetchall()[0][0]}
+    return cat[tablename]
+
+
+def _catalog_get(tablename, conn):
+    """
+    Return the catalog entry of a table. If not cached or the schema was changed, the columns are re-read
+    :param tablename: Table name
+    :param conn: sqlite3 connection object
+    :return: dict (empty if the table does not exist)
+    >>> pass    # Testing in catalog()
+    """
+    global _SCHEMA_CATALOG
+    if isinstance(conn, sqlite3.Connection) is False:
+        return {}
+    cat = _SCHEMA_CATALOG.setdefault(id(conn), {})
+    _catalog_sync(conn, cat)
+    entry = cat.get(tablename)
+    if entry is None:
+        entry = _catalog_update(tablename, conn)
+    elif entry['schema_version'] != conn.execute("PRAGMA schema_version").fetchall()[0][0]:
+        # Some DDL happened (eg: ALTER TABLE), so keeping the row count but reading columns again
+        rows = entry['rows']
+        entry = _catalog_update(tablename, conn)
+        if entry is not None:
+            entry['rows'] = rows
+    return entry if entry is not None else {}
+
+
+def _catalog_rows(tablename, conn, count_rows=False):
+    """
+    Return the row count from the catalog, or the estimate from sqlite_stat1 (after ANALYZE)
+    :param tablename: Table name
+    :param conn: sqlite3 connection object
+    :param count_rows: If True and the row count is unknown (or was forgotten as stale), SELECT count(*) (full scan)
+    :return: String (eg: '123', '~100', 'unknown')
+    >>> pass    # Testing in catalog()
+    """
+    rows = _catalog_get(tablename, conn).get('rows')
+    if rows is None and count_rows:
+        rows = _catalog_update(tablename, conn, rows=conn.execute(
+            "SELECT count(*) FROM %s" % (_quote_ident(tablename))).fetchall()[0][0]).get('rows')
+    if rows is not None:
+        return str(rows)
+    try:
+        rs = conn.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1", (tablename,)).fetchall()
+        if len(rs) > 0:
+            return "~" + str(rs[0][0]).split(" ")[0]
+    except sqlite3.OperationalError:
+        # no sqlite_stat1 (ANALYZE has never run)
+        pass
+    return "unknown"
+
+
+def catalog(refresh=False, count_rows=False, conn=None):
+    """
+    Return the in-process schema catalog (table name, number of columns, columns, rows) as DataFrame
+    :param refresh: If True, re-read all tables' columns
+    :param count_rows: If True, run SELECT count(*) for the tables which row count is unknown (full scan)
+    :param conn: DB connection (cursor) object
+    :return: DataFrame
+    >>> _ = _df2table(pd.DataFrame({"a": range(3)}), connect(), "t_test_catalog")
+    >>> df = catalog(); df[df.name == "t_test_catalog"][["num_cols", "rows"]].values.tolist()
+    [[2, '3']]
+    >>> _ = connect().execute("DELETE FROM t_test_catalog WHERE a = 0")
+    >>> df = catalog(); df[df.name == "t_test_catalog"][["num_cols", "rows"]].values.tolist()
+    [[2, 'unknown']]
+    >>> df = catalog(count_rows=True); df[df.name == "t_test_catalog"][["num_cols", "rows"]].values.tolist()
+    [[2, '2']]
+    >>> _ = connect().execute("DROP TABLE t_test_catalog")
+    """
+    if bool(conn) is False: conn = connect()
+    tables = _get_col_vals(conn.execute("select name from sqlite_master where type = 'table'").fetchall(), 0)
+    rtn = []
+    for t in tables:
+        entry = _catalog_update(t, conn, rows=_catalog_get(t, conn).get('rows')) if refresh else _catalog_get(t, conn)
+        rtn.append({'name': t, 'num_cols': len(entry.get('columns', [])), 'columns': ", ".join(entry.get('columns', [])),
+                    'rows': _catalog_rows(t, conn, count_rows=count_rows)})
+    return pd.DataFrame(rtn, columns=['name', 'num_cols', 'columns', 'rows'])
+
+
+def rollup_register(tablename, keys=[], measures=[], time_col='date_time', bucket_sec=3600, rollup_tablename=None):
+    """
+    Register a time-bucket rollup of a table. While the table is loaded (_insert2table/_df2table, so logs2table,
+    csv2df etc.), each inserted batch is aggregated and only the affected buckets of the rollup table are updated
+    Rollup columns: bucket_ms (UTC epoch), bucket (UTC), keys..., cnt, and <measure>_sum/_min/_max
+    :param tablename: Source table name
+    :param keys: A list of key column names (eg: ['statusCode'])
+    :param measures: A list of numeric column names to sum/min/max (eg: ['elapsedTime'])
+    :param time_col: Date time column. If the table has 'epoch_ms' column, it is used instead of parsing
+    :param bucket_sec: Bucket size in seconds (3600 = hourly, 60 = per minute)
+    :param rollup_tablename: If empty, <tablename>_hourly, <tablename>_minutely or <tablename>_<bucket_sec>s
+    :return: The rollup table name
+    >>> rollup_register('t_test_ru_src', keys=['k'], measures=['v'], bucket_sec=60)
+    't_test_ru_src_minutely'
+    """
+    global _ROLLUPS
+    if bool(rollup_tablename) is False:
+        suffix = {3600: 'hourly', 60: 'minutely', 86400: 'daily'}.get(bucket_sec, '%ds' % (bucket_sec))
+        rollup_tablename = "%s_%s" % (tablename, suffix)
+    specs = [s for s in _ROLLUPS.get(tablename, []) if s['name'] != rollup_tablename]
+    specs.append({'name': rollup_tablename, 'keys': list(keys), 'measures': list(measures), 'time_col': time_col,
+                  'bucket_sec': int(bucket_sec)})
+    _ROLLUPS[tablename] = specs
+    return rollup_tablename
+
+
+def _rollup_reset(tablename, conn):
+    """
+    Drop and create the rollup tables of a source table (called when the source table is replaced)
+    :param tablename: Source table name
+    :param conn: DB connection object
+    :return: None
+    >>> pass    # Testing in rollup_rebuild()
+    """
+    global _ROLLUPS
+    for spec in _ROLLUPS.get(tablename, []):
+        keys = [_quote_ident(k) for k in spec['keys']]
+        col_defs = ["bucket_ms INTEGER", "bucket TEXT"] + ["%s TEXT" % (k) for k in keys] + ["cnt INTEGER"]
+        for m in spec['measures']:
+            col_defs += ["%s REAL" % (_quote_ident(m + s)) for s in ['_sum', '_min', '_max']]
+        conn.execute("DROP TABLE IF EXISTS %s" % (_quote_ident(spec['name'])))
+        conn.execute("CREATE TABLE %s (%s, PRIMARY KEY (%s))" % (
+            _quote_ident(spec['name']), ", ".join(col_defs), ", ".join(["bucket_ms"] + keys)))
+        _catalog_update(spec['name'], conn, rows=0)
+
+
+def _rollup_rows(tablename, conn, rows, columns=None):
+    """
+    Aggregate one inserted batch by bucket and keys, then upsert into the rollup tables of the source table
+    :param tablename: Source table name
+    :param conn: DB connection object
+    :param rows: A DataFrame, or a list of tuples (same order as the table columns)
+    :param columns: Column names of the tuples. If None, from the catalog
+    :return: Number of upserted rollup rows
+    >>> pass    # Testing in rollup_rebuild()
+    """
+    global _ROLLUPS
+    specs = _ROLLUPS.get(tablename)
+    if bool(specs) is False or isinstance(conn, sqlite3.Connection) is False or len(rows) == 0:
+        return 0
+    if isinstance(rows, pd.DataFrame) is False:
+        if columns is None:
+            columns = _catalog_get(tablename, conn).get('columns', [])
+        rows = pd.DataFrame.from_records(rows, columns=columns[:len(rows[0])])
+    upserted = 0
+    for spec in specs:
+        needed = spec['keys'] + spec['measures']
+        if any(c not in rows.columns for c in needed):
+            _debug("rollup %s: column(s) not in %s" % (spec['name'], tablename))
+            continue
+        if 'epoch_ms' in rows.columns:
+            epoch = pd.to_numeric(rows['epoch_ms'], errors='coerce')
+        elif spec['time_col'] in rows.columns:
+            epoch = _to_epoch_ms(rows[spec['time_col']].astype(object))
+        else:
+            continue
+        bucket_ms = spec['bucket_sec'] * 1000
+        df = pd.DataFrame({'bucket_ms': (epoch // bucket_ms) * bucket_ms}, index=rows.index)
+        for k in spec['keys']:
+            df[k] = rows[k].astype(object).where(rows[k].notna(), '').astype(str)
+        for m in spec['measures']:
+            df[m] = pd.to_numeric(rows[m], errors='coerce')
+        df = df[df['bucket_ms'].notna()]
+        if len(df) == 0:
+            continue
+        agg = df.groupby(['bucket_ms'] + spec['keys'], sort=False).agg(
+            **dict([('cnt', ('bucket_ms', 'size'))] + [(m + s, (m, s[1:])) for m in spec['measures'] for s in
+                                                        ['_sum', '_min', '_max']])).reset_index()
+        agg['bucket_ms'] = agg['bucket_ms'].astype('int64')
+        agg.insert(1, 'bucket', pd.to_datetime(agg['bucket_ms'], unit='ms').dt.strftime('%Y-%m-%d %H:%M:%S'))
+        cols = [_quote_ident(c) for c in agg.columns]
+        updates = ["cnt = cnt + excluded.cnt"]
+        for m in spec['measures']:
+            (s, mn, mx) = [_quote_ident(m + x) for x in ['_sum', '_min', '_max']]
+            updates += ["%s = COALESCE(%s + excluded.%s, %s, excluded.%s)" % (s, s, s, s, s),
+                        "%s = COALESCE(MIN(%s, excluded.%s), %s, excluded.%s)" % (mn, mn, mn, mn, mn),
+                        "%s = COALESCE(MAX(%s, excluded.%s), %s, excluded.%s)" % (mx, mx, mx, mx, mx)]
+        sql = "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s" % (
+            _quote_ident(spec['name']), ", ".join(cols), ",".join("?" * len(cols)),
+            ", ".join(["bucket_ms"] + [_quote_ident(k) for k in spec['keys']]), ", ".join(updates))
+        if len(_catalog_get(spec['name'], conn)) == 0:
+            _rollup_reset(tablename, conn)
+        conn.executemany(sql, zip(*_df2columns(agg)))
+        # each upserted row is one change. The rollup's row count is not known (inserted or updated)
+        _catalog_update(spec['name'], conn, changes=len(agg))
+        upserted += len(agg)
+    return upserted
+
+
+def rollup_rebuild(tablename, conn=None, chunksize=100000):
+    """
+    Re-create the rollup tables of a table from all of its rows (eg: loaded before rollup_register())
+    :param tablename: Source table name
+    :param conn: DB connection object
+    :param chunksize: Number of rows to read at once
+    :return: Number of rows read
+    >>> c = connect(); _ = rollup_register('t_test_ru_src', keys=['k'], measures=['v'], bucket_sec=60)
+    >>> _df2table(pd.DataFrame({'date_time': ['2020-01-01 00:00:01', '2020-01-01 00:00:59', '2020-01-01 00:01:00'],
+    ...                         'k': ['a', 'a', None], 'v': [1, 3, 5]}), c, 't_test_ru_src', index=False)
+    3
+    >>> _ = _df2table(pd.DataFrame({'date_time': ['2020-01-01 00:00:02'], 'k': ['a'], 'v': [0.5]}), c,
+    ...               't_test_ru_src', if_exists='append', index=False)
+    >>> c.execute("SELECT bucket, k, cnt, v_sum, v_min, v_max FROM t_test_ru_src_minutely ORDER BY 1").fetchall()
+    [('2020-01-01 00:00:00', 'a', 3, 4.5, 0.5, 3.0), ('2020-01-01 00:01:00', '', 1, 5.0, 5.0, 5.0)]
+    >>> rollup_rebuild('t_test_ru_src', conn=c)
+    4
+    >>> c.execute("SELECT sum(cnt) FROM t_test_ru_src_minutely").fetchall()
+    [(4,)]
+    >>> _ = c.execute("DROP TABLE t_test_ru_src"); _ = c.execute("DROP TABLE t_test_ru_src_minutely")
+    >>> _ = _ROLLUPS.pop('t_test_ru_src')
+    """
+    if bool(conn) is False: conn = connect()
+    _rollup_reset(tablename, conn)
+    n = 0
+    for df in _fetch_chunks("SELECT * FROM %s" % (_quote_ident(tablename)), conn, chunksize=chunksize):
+        _rollup_rows(tablename, conn, df)
+        n += len(df)
+    return n
+
+
 def show_create_table(tablenames=None, like=None, conn=None):
     """
     SHOW CREATE TABLE or SHOW TABLES
@@ -1024,8 +2923,8 @@ def show_create_table(tablenames=None, like=None, conn=None):
             if bool(rs) is False:
                 continue
             print(rs.fetchall()[0][0])
-            # SQLite doesn't like - in a table name. need to escape with double quotes.
-            print("Rows: %s\n" % (conn.execute("SELECT count(oid) FROM \"%s\"" % (t)).fetchall()[0][0]))
+            # Loaders record the row count in the catalog. Counting (full scan) only if other writes made it stale
+            print("Rows: %s\n" % (_catalog_rows(t, conn, count_rows=True)))
         return
     if bool(like):
         # Currently only searching table object
@@ -1033,7 +2932,7 @@ def show_create_table(tablenames=None, like=None, conn=None):
         if bool(rs) is False:
             return
         tablenames = _get_col_vals(rs.fetchall(), 0)
-        return show_create_table(tablenames=tablenames)
+        return show_create_table(tablenames=tablenames, conn=conn)
     return query(
         sql="select distinct name, rootpage from sqlite_master where type = 'table'%s order by rootpage" % (sql_and),
         conn=conn, no_history=True)
@@ -1074,16 +2973,116 @@ def hive_conn(conn_str="jdbc:hive2://localhost:10000/default", user="admin", pwd
         jars += _globr(ptn="hive-jdbc-1.*-standalone.jar", src=jar_dir, loop=1)
         jars += _globr(ptn="hadoop-core-1.*.jar", src=jar_dir, loop=1)
     _debug("Loading jars: %s ..." % (str(jars)))
+    import jaydebeapi
     conn = jaydebeapi.connect("org.apache.hive.jdbc.HiveDriver",
                               conn_str, [user, pwd], jars).cursor()
     return conn
 
 
+def _hive_worker_init(conn_str, user="admin", pwd="admin", thread=False):
+    """
+    Pool initializer: open one Hive connection for this process (or thread), which is reused by hive_query_execute()
+    If connecting fails, only logs, as an exception in an initializer makes the process pool respawn the worker
+    forever, and breaks a ThreadPoolExecutor (BrokenThreadPool for all queries).
+    hive_query_execute() connects again (lazily) and returns the error per query.
+    :param conn_str: jdbc:hive2://localhost:10000/default
+    :param user: admin
+    :param pwd:  admin
+    :param thread: If True, initializing a thread worker (the caller closes the connections)
+    :return: void
+    >>> pass    # TODO: implement test (requires Hive)
+    """
+    from multiprocessing.util import Finalize
+    try:
+        _hive_worker_conn(conn_str, user=user, pwd=pwd)
+    except Exception as e:
+        _err("WARN: Connecting to %s failed in worker %d (%s). Retrying per query." % (
+            conn_str, threading.get_ident() if thread else os.getpid(), str(e)))
+    if thread:
+        return
+    # The persistent pool keeps the workers (and connections) for the next run, so the connection is closed only
+    # when the worker exits normally (pool_close(), or a new pool for a different conn_str/user)
+    Finalize(None, _hive_close_conns, exitpriority=10)
+
+
+def _hive_worker_conn(conn_str, user=None, pwd=None, reconnect=False):
+    """
+    Return the persistent Hive connection (cursor) of this process for the connection string
+    :param conn_str: jdbc:hive2://localhost:10000/default
+    :param user: If None, the user used last time (or admin)
+    :param pwd: If None, the password used last time (or admin)
+    :param reconnect: If True, close the current connection and open a new one
+    :return: connection (cursor) object
+    >>> pass    # TODO: implement test (requires Hive)
+    """
+    global _HIVE_CONNS
+    # One connection per thread, as a cursor can't be shared by threads
+    key = (conn_str, threading.get_ident())
+    (conn, prev_user, prev_pwd) = _HIVE_CONNS.get(key, (None, "admin", "admin"))
+    user = prev_user if user is None else user
+    pwd = prev_pwd if pwd is None else pwd
+    if conn is not None and reconnect:
+        _hive_close(conn)
+        conn = None
+    if conn is None:
+        # Remembering user/pwd even if connecting fails, for the next (lazy) attempt
+        _HIVE_CONNS[key] = (None, user, pwd)
+        _debug("Connecting to %s (pid: %d) ..." % (conn_str, os.getpid()))
+        conn = hive_conn(conn_str, user=user, pwd=pwd)
+        _HIVE_CONNS[key] = (conn, user, pwd)
+    return conn
+
+
+def _hive_close(conn):
+    """
+    Close a Hive connection (cursor) object, ignoring errors (eg: already disconnected)
+    :param conn: connection (cursor) object
+    :return: void
+    >>> _hive_close(None)
+    """
+    try:
+        conn.close()
+        conn.connection.close()
+    except Exception as e:
+        _debug("Ignoring close error: %s" % (str(e)))
+
+
+def _hive_close_conns(dead_threads_only=False):
+    """
+    Close the persistent Hive connections of this process
+    :param dead_threads_only: If True, close only the connections of the threads which already ended
+    :return: void
+    >>> _hive_close_conns()
+    """
+    global _HIVE_CONNS
+    alive = set(t.ident for t in threading.enumerate()) if dead_threads_only else set()
+    for key in list(_HIVE_CONNS.keys()):
+        if key[1] in alive:
+            continue
+        _hive_close(_HIVE_CONNS.pop(key)[0])
+
+
+def _hive_is_alive(conn):
+    """
+    Return True if the Hive connection (cursor) can still execute a query
+    :param conn: connection (cursor) object
+    :return: Boolean
+    >>> _hive_is_alive(None)
+    False
+    """
+    try:
+        conn.execute("SELECT 1")
+        conn.fetchall()
+        return True
+    except Exception:
+        return False
+
+
 def run_hive_queries(query_series, conn, output=True):
     """
     Execute multiple queries in a Pandas Series against Hive
     :param query_series: Panda Series object which contains query strings
-    :param conn:        Hive connection object (if connection string, every time new connections will be created
+    :param conn:        Hive connection object (if connection string, one connection is opened and reused)
     :param output:      Boolean if outputs something or not
     :return:            List of failures
     #>>> df = ju.csv2df(file_path='queries_log_received_distinct.csv', conn=ju.connect())
@@ -1099,11 +3098,13 @@ def run_hive_queries(query_series, conn, output=True):
     return failures
 
 
+@_instrument()
 def hive_query_execute(query, conn, row_num=None, output=False):
     """
     Run one query against Hive
     :param query:   SQL SELECT statement
-    :param conn: Hive connection string or object
+    :param conn: Hive connection string or object. If string, the persistent connection of this process is used
+                 (opened if not yet), and if the connection is broken, reconnects and retries once
     :param row_num: Integer, used like ID
     :param output:  Boolean, if True, output results and error
     :return: String: Error message
@@ -1114,13 +3115,22 @@ def hive_query_execute(query, conn, row_num=None, output=False):
     _r = None
     _error = None
     if bool(query) and str(query).lower() != "nan":
-        # TODO: should pool the connection, and not sure if it's closing in Jupyter
+        conn_str = conn if type(conn) == str else None
         try:
-            if type(conn) == str:
-                conn = hive_conn(conn)
+            if bool(conn_str):
+                conn = _hive_worker_conn(conn_str)
             _r = query_execute(query, conn)
         except Exception as e:
             _error = e
+        # Not retrying if the connection is fine (eg: syntax error), as replaying a query twice changes the result.
+        # Nor if connecting failed (conn is still the string), as the next query tries to connect again.
+        if _error is not None and bool(conn_str) and type(conn) != str and _hive_is_alive(conn) is False:
+            _err("WARN: Hive connection looks broken (%s). Reconnecting ..." % (str(_error)))
+            try:
+                _r = query_execute(query, _hive_worker_conn(conn_str, reconnect=True))
+                _error = None
+            except Exception as e:
+                _error = e
     if output:
         print("### %s at %s ################" % (str(row_num), _time))
         if bool(_error):
@@ -1138,14 +3148,25 @@ def hive_query_execute(query, conn, row_num=None, output=False):
     return _error
 
 
-def run_hive_queries_multi(query_series, conn_str, num_pool=None, output=False):
+def run_hive_queries_multi(query_series, conn_str, num_pool=None, output=False, user="admin", pwd="admin",
+                           threads=False, timeout=None, callback=None):
     """
     Execute multiple queries in a Pandas Series against Hive
+    Each worker (process or thread) opens one connection, and reuses it for all its queries.
+    Process workers belong to the persistent pool, so their connections stay open for the next run with the same
+    conn_str, until pool_close(). Thread workers' connections are closed when this function returns.
     :param query_series: Panda Series object which contains query strings
     :param conn_str:    As each pool creates own connection, need String
-    :param num_pool:    Concurrency number
+    :param num_pool:    Concurrency number. If threads=True, default is 16
     :param output:      Boolean if outputs something or not
-    :return:            List of failures
+    :param user:        Hive user
+    :param pwd:         Hive password
+    :param threads:     If True, use a thread pool in this process instead of processes (queries mostly wait on
+                        the server, so high concurrency like 64 is fine, and no JVM start-up per process)
+    :param timeout:     (threads only) Seconds per query. Timed-out query's result is TimeoutError
+    :param callback:    (threads only) A function object which accepts an outcome dict
+                        {'index', 'result', 'error', 'elapsed_ms'}, called as each query completes
+    :return:            List of errors (None if succeeded), in the same order as query_series
     #>>> df = ju.csv2df(file_path='queries_log_received_distinct.csv', conn=ju.connect())
     #>>> #dfs = ju._chunks(df, 2500)   # May want to split if 'df' is very large, then use _mexec()
     #>>> fails = ju.run_hive_queries_multi(df['extra_lines'], "jdbc:hive2://hostname:port/")
@@ -1155,7 +3176,183 @@ def run_hive_queries_multi(query_series, conn_str, num_pool=None, output=False):
     for (i, query) in query_series.iteritems():
         # from concurrent.futures import ProcessPoolExecutor hangs in Jupyter, so can't use kwargs
         args_list.append((query, conn_str, i, output))
-    return _mexec(hive_query_execute, args_list, num=num_pool)
+    if threads:
+        # Also closing the connections of the threads left by the previous run (eg: timed-out queries)
+        _hive_close_conns(dead_threads_only=True)
+        try:
+            return _texec(hive_query_execute, args_list, num=num_pool or 16, timeout=timeout, callback=callback,
+                          initializer=_hive_worker_init, initargs=(conn_str, user, pwd, True))
+        finally:
+            _hive_close_conns(dead_threads_only=True)
+    return _mexec(hive_query_execute, args_list, num=num_pool, initializer=_hive_worker_init,
+                  initargs=(conn_str, user, pwd))
+
+
+def _replay_conn(conn):
+    """
+    Return the connection which this thread should use for replaying
+    :param conn: Hive connection string (persistent connection per thread), a function object which returns a new
+                 connection (called once per thread), or a connection (cursor) object
+    :return: connection (cursor) object
+    >>> c = connect(); _replay_conn(c) is c
+    True
+    """
+    global _REPLAY_LOCAL
+    if type(conn) == str:
+        return _hive_worker_conn(conn)
+    # NOTE: sqlite3 connection object is also callable
+    if callable(conn) and hasattr(conn, 'execute') is False:
+        if hasattr(_REPLAY_LOCAL, 'conns') is False:
+            _REPLAY_LOCAL.conns = {}
+        if id(conn) not in _REPLAY_LOCAL.conns:
+            _REPLAY_LOCAL.conns[id(conn)] = conn()
+        return _REPLAY_LOCAL.conns[id(conn)]
+    return conn
+
+
+def _replay_one(sql, conn, fetch_size=10000):
+    """
+    Execute one query and count the rows with fetchmany() (not keeping the rows)
+    :param sql: SQL statement
+    :param conn: See _replay_conn()
+    :param fetch_size: Number of rows per fetchmany()
+    :return: (start time (epoch), elapsed seconds, rows or None, error string or None)
+    >>> _replay_one("SELECT 1 UNION ALL SELECT 2", connect())[2:]
+    (2, None)
+    """
+    _start = time()
+    rows = None
+    error = None
+    try:
+        cur = _execute_cursor(sql, _replay_conn(conn))
+        rows = 0
+        if bool(cur.description):
+            while True:
+                r = cur.fetchmany(fetch_size)
+                if bool(r) is False:
+                    break
+                rows += len(r)
+    except Exception as e:
+        error = str(e)
+    return (_start, time() - _start, rows, error)
+
+
+@_instrument()
+def replay_queries(queries, conn, times=None, speed=1.0, num=1, tablename="t_replay_results", local_conn=None,
+                   fetch_size=10000):
+    """
+    Replay queries and record start time, duration, rows and error of each query into a local table, then return
+    the summary (throughput and p50/p95/p99 latency) from replay_summary()
+    If times is given, each query starts at the same offset as the original (divided by speed). If the previous
+    queries are still running (num is too small), the start is delayed (see 'avg_lag_ms' in the summary).
+    :param queries: Pandas Series (or list) of query strings
+    :param conn: Hive connection string (one connection per thread), a function object which returns a new
+                 connection (eg: lambda: sqlite3.connect(path), called once per thread), or a connection object
+                 (only with num=1, as connections normally can't be shared by threads)
+    :param times: (optional) Pandas Series (or list) of the original start times of the queries
+    :param speed: If 2.0, replay twice faster than the original inter-arrival times
+    :param num: Concurrency. If 1, queries are executed in this thread
+    :param tablename: Local table to save the results (appending, with 'replay_id' column)
+    :param local_conn: DB connection object for tablename. If None, connect()
+    :param fetch_size: Number of rows per fetchmany()
+    :return: DataFrame (summary)
+    #>>> _ = logs2table(filename='queries.*log*', tablename='t_queries_log',
+    #       col_names=['date_time', 'ids', 'message', 'extra_lines'],
+    #       line_matching='^(\\d\\d\\d\\d-\\d\\d-\\d\\d.\\d\\d:\\d\\d:\\d\\d[^ ]*) (\\{.*?\\}) - ([^:]+):(.*)')
+    #>>> df = q("SELECT date_time, extra_lines FROM t_queries_log")
+    #>>> replay_queries(df['extra_lines'], "jdbc:hive2://hostname:port/", times=df['date_time'], num=64)
+    >>> c = connect(); _ = c.execute("CREATE TABLE t_test_replay AS SELECT 1 AS a UNION ALL SELECT 2")
+    >>> s = replay_queries(["SELECT a FROM t_test_replay", "SELECT x FROM no_such_table"], c, speed=10,
+    ...                    times=["2020-01-01 00:00:00", "2020-01-01 00:00:01"], tablename="t_test_replay_results")
+    >>> s[['queries', 'errors', 'rows']].values.tolist()
+    [[2, 1, 2]]
+    >>> query("SELECT start_ms >= 100 AS delayed FROM t_test_replay_results WHERE idx = 1", c, True)['delayed'][0]
+    1
+    >>> _ = c.execute("DROP TABLE t_test_replay"); _ = c.execute("DROP TABLE t_test_replay_results")
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if bool(local_conn) is False: local_conn = connect()
+    queries = list(queries)
+    offsets = None
+    if times is not None:
+        ts = pd.to_datetime(pd.Series(list(times)), errors='coerce')
+        offsets = ((ts - ts.min()).dt.total_seconds() / speed).fillna(0).tolist()
+    order = sorted(range(len(queries)), key=lambda i: offsets[i]) if offsets is not None else range(len(queries))
+    replay_id = _timestamp(format="%Y%m%d%H%M%S%f")
+    records = [None] * len(queries)
+    progress = {'done': 0}
+    # '+= 1' on the dict value is not atomic, and the worker threads update it
+    progress_lock = threading.Lock()
+    replay_start = time()
+
+    def _run(i):
+        (started, elapsed, rows, error) = _replay_one(queries[i], conn, fetch_size=fetch_size)
+        records[i] = {'replay_id': replay_id, 'idx': i, 'query': queries[i],
+                      'scheduled_ms': round(offsets[i] * 1000, 3) if offsets is not None else None,
+                      'start_time': _timestamp(started), 'start_ms': round((started - replay_start) * 1000, 3),
+                      'duration_ms': round(elapsed * 1000, 3), 'rows': rows, 'error': error}
+        with progress_lock:
+            progress['done'] += 1
+            done = progress['done']
+        _mexec_progress(done, len(queries), i, None)
+
+    executor = ThreadPoolExecutor(max_workers=num) if num > 1 else None
+    try:
+        for i in order:
+            if offsets is not None:
+                wait_sec = replay_start + offsets[i] - time()
+                if wait_sec > 0:
+                    sleep(wait_sec)
+            if executor is None:
+                _run(i)
+            else:
+                executor.submit(_run, i)
+        if executor is not None:
+            executor.shutdown(wait=True)
+    except KeyboardInterrupt:
+        _err("WARN: Interrupted. Saving the results of %d/%d queries ..." % (progress['done'], len(queries)))
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        # Closing the per thread Hive connections of the ended worker threads (as run_hive_queries_multi)
+        if executor is not None and type(conn) == str:
+            _hive_close_conns(dead_threads_only=True)
+    df = pd.DataFrame([r for r in records if r is not None],
+                      columns=['replay_id', 'idx', 'query', 'scheduled_ms', 'start_time', 'start_ms', 'duration_ms',
+                               'rows', 'error'])
+    # So that the column types are same even if the first replay has no times
+    df = df.astype({'scheduled_ms': 'float64', 'start_ms': 'float64', 'duration_ms': 'float64', 'rows': 'float64'})
+    _df2table(df, conn=local_conn, tablename=tablename, if_exists='append', index=False)
+    _autocomp_inject(tablename=tablename, conn=local_conn)
+    return replay_summary(replay_id=replay_id, tablename=tablename, local_conn=local_conn)
+
+
+def replay_summary(replay_id=None, tablename="t_replay_results", local_conn=None):
+    """
+    Summarise a replay (see replay_queries()): throughput, p50/p95/p99 latency, and the delay of the start
+    :param replay_id: If None, the last replay
+    :param tablename: Local table of the results
+    :param local_conn: DB connection object for tablename. If None, connect()
+    :return: DataFrame (one row)
+    >>> pass    # Testing in replay_queries()
+    """
+    if bool(local_conn) is False: local_conn = connect()
+    if bool(replay_id) is False:
+        replay_id = local_conn.execute("SELECT MAX(replay_id) FROM %s" % (_quote_ident(tablename))).fetchall()[0][0]
+    df = pd.read_sql("SELECT * FROM %s WHERE replay_id = ?" % (_quote_ident(tablename)), local_conn,
+                     params=[replay_id])
+    if len(df) == 0:
+        return pd.DataFrame()
+    df['scheduled_ms'] = pd.to_numeric(df['scheduled_ms'], errors='coerce')
+    wall_s = ((df['start_ms'] + df['duration_ms']).max() - df['start_ms'].min()) / 1000
+    lat = df['duration_ms']
+    return pd.DataFrame([{'replay_id': replay_id, 'queries': len(df), 'errors': int(df['error'].notnull().sum()),
+                          'rows': int(df['rows'].fillna(0).sum()), 'wall_s': round(wall_s, 3),
+                          'qps': round(len(df) / wall_s, 2) if wall_s > 0 else None,
+                          'p50_ms': round(lat.quantile(0.50), 3), 'p95_ms': round(lat.quantile(0.95), 3),
+                          'p99_ms': round(lat.quantile(0.99), 3), 'max_ms': round(lat.max(), 3),
+                          'avg_lag_ms': round((df['start_ms'] - df['scheduled_ms']).mean(), 3)
+                          if df['scheduled_ms'].notnull().any() else None}])
 
 
 def _massage_tuple_for_save(tpl, long_value="", num_cols=None):
@@ -1176,6 +3373,7 @@ def _massage_tuple_for_save(tpl, long_value="", num_cols=None):
     return tpl
 
 
+@_instrument(rows_arg='tpls')
 def _insert2table(conn, tablename, tpls, chunk_size=4000):
     """
     Insert one tuple or tuples to a table
@@ -1197,9 +3395,171 @@ def _insert2table(conn, tablename, tpls, chunk_size=4000):
         res = conn.executemany("INSERT INTO " + tablename + " VALUES (" + placeholders + ")", l)
         if bool(res) is False:
             return res
+    _catalog_update(tablename, conn, rows=len(tpls), appending=True, changes=len(tpls))
+    if tablename in _ROLLUPS:
+        _rollup_rows(tablename, conn, tpls)
     return res
 
 
+def _quote_ident(name):
+    """
+    Quote a table or column name for SQLite (column names like 'physical.memory.free' need quotes)
+    :param name: table or column name
+    :return: quoted string
+    >>> _quote_ident('a"b')
+    '"a""b"'
+    """
+    return '"%s"' % (str(name).replace('"', '""'))
+
+
+def _sqlite_type(dtype):
+    """
+    Return SQLite column type for a pandas/numpy dtype (or the dtype names used in _csv_sample_dtypes)
+    :param dtype: dtype object or string
+    :return: 'INTEGER', 'REAL' or 'TEXT'
+    >>> _sqlite_type('Int64'), _sqlite_type('float64'), _sqlite_type('str')
+    ('INTEGER', 'REAL', 'TEXT')
+    """
+    kind = getattr(pd.api.types.pandas_dtype(dtype), 'kind', 'O') if dtype != 'str' else 'O'
+    if kind in ['i', 'u', 'b']:
+        return "INTEGER"
+    if kind == 'f':
+        return "REAL"
+    return "TEXT"
+
+
+def _df2columns(df):
+    """
+    Convert each column of a DataFrame to a list of values which sqlite3 can bind (column-wise, no per-row dict)
+    :param df: A DataFrame object
+    :return: list of lists (one list per column)
+    >>> _df2columns(pd.DataFrame({"a": [1, 2], "b": [1.5, None], "c": [{"k": 1}, None]}))
+    [[1, 2], [1.5, None], ['{"k": 1}', None]]
+    >>> _df2columns(pd.DataFrame({"d": [pd.Timestamp("2020-01-01 01:02:03"), "x"]}))
+    [['2020-01-01 01:02:03.000000', 'x']]
+    """
+    columns = []
+    for c in df.columns:
+        s = df[c]
+        kind = s.dtype.kind
+        if kind in ['i', 'u', 'b'] and isinstance(s.dtype, np.dtype):
+            # numpy's tolist() returns python int/bool, and these dtypes can't contain NaN
+            columns.append(s.tolist())
+            continue
+        if kind == 'M':
+            s = s.dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+        elif kind == 'm':
+            s = s.astype(str)
+        values = s.astype(object).where(s.notna(), None).tolist()
+        if kind == 'O':
+            # sqlite3 can't bind dict/list (eg: a json column), so saving as JSON string, and Timestamp/datetime in
+            # an object column as same string as datetime64 columns
+            values = [json.dumps(v) if type(v) in [dict, list] else (
+                v.strftime('%Y-%m-%d %H:%M:%S.%f') if isinstance(v, datetime) else v) for v in values]
+        columns.append(values)
+    return columns
+
+
+@_instrument()
+def _df2table(df, conn, tablename, if_exists='replace', index=True, chunksize=100000, col_types=None):
+    """
+    Bulk insert a DataFrame into a SQLite table with one prepared statement (executemany) per transaction.
+    Much faster than df.to_sql(chunksize=1000). Not sqlite3 connection falls back to df.to_sql()
+    :param df: A DataFrame object
+    :param conn: DB connection object
+    :param tablename: Table name
+    :param if_exists: 'replace', 'append' or 'fail' (same as to_sql)
+    :param index: If True, the DataFrame index is saved as a column (same as to_sql)
+    :param chunksize: Number of rows per transaction
+    :param col_types: Optional dict of column name => SQLite type. If empty, decided from dtypes
+    :return: Number of inserted rows
+    >>> _df2table(pd.DataFrame([{"a": 1, "b": "x"}, {"a": 2, "b": None}]), connect(), "t_test_df2table")
+    2
+    >>> query("select typeof(a), b from t_test_df2table", no_history=True).values.tolist()
+    [['integer', 'x'], ['integer', None]]
+    >>> _df2table(pd.DataFrame({"b": ["y"], "a": [3]}), connect(), "t_test_df2table", if_exists='append', index=False)
+    1
+    >>> connect().execute("select a, b from t_test_df2table where b = 'y'").fetchall()
+    [(3, 'y')]
+    >>> _ = connect().execute("DROP TABLE t_test_df2table")
+    """
+    global _DB_SCHEMA
+    if isinstance(conn, sqlite3.Connection) is False:
+        df.to_sql(name=tablename, con=conn, chunksize=chunksize, if_exists=if_exists, index=index, schema=_DB_SCHEMA)
+        return len(df)
+    if index:
+        # same column name as to_sql ('index', or 'level_0' if 'index' is used)
+        df = df.reset_index()
+    if bool(col_types) is False:
+        col_types = {}
+    cols = [str(c) for c in df.columns]
+    col_def_str = ", ".join(
+        "%s %s" % (_quote_ident(c), col_types.get(c, _sqlite_type(df[df.columns[i]].dtype))) for i, c in
+        enumerate(cols))
+    if if_exists == 'replace':
+        conn.execute("DROP TABLE IF EXISTS %s" % (_quote_ident(tablename)))
+        if tablename in _ROLLUPS:
+            _rollup_reset(tablename, conn)
+    create_sql = "CREATE TABLE %s (%s)" if if_exists == 'fail' else "CREATE TABLE IF NOT EXISTS %s (%s)"
+    conn.execute(create_sql % (_quote_ident(tablename), col_def_str))
+    if len(df) == 0:
+        _catalog_update(tablename, conn, rows=0, appending=(if_exists == 'append'))
+        return 0
+    # With the column list, appending a DataFrame which columns are in a different order is safe
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        _quote_ident(tablename), ", ".join(_quote_ident(c) for c in cols), ",".join("?" * len(cols)))
+    rows = zip(*_df2columns(df))
+    in_tx = conn.in_transaction
+    inserted = 0
+    while True:
+        chunk = list(islice(rows, chunksize))
+        if len(chunk) == 0:
+            break
+        if in_tx is False:
+            conn.execute("BEGIN")
+        try:
+            conn.executemany(sql, chunk)
+        except Exception:
+            if in_tx is False:
+                conn.rollback()
+            raise
+        if in_tx is False:
+            conn.commit()
+        inserted += len(chunk)
+    _catalog_update(tablename, conn, rows=inserted, appending=(if_exists == 'append'), changes=inserted)
+    if tablename in _ROLLUPS:
+        _rollup_rows(tablename, conn, df)
+    return inserted
+
+
+def _bench_df2table(rows=200000, conn=None):
+    """
+    Compare rows/sec between df.to_sql(chunksize=1000) and _df2table()
+    :param rows: Number of rows of the test DataFrame
+    :param conn: DB connection object. If empty, a new in-memory DB is used
+    :return: dict of method => rows/sec
+    #>>> _bench_df2table(1000000)
+    >>> pass
+    """
+    if bool(conn) is False:
+        conn = _db()
+    df = pd.DataFrame({"date_time": pd.date_range("2020-01-01", periods=rows, freq="s").astype(str),
+                       "loglevel": ["INFO", "WARN", "ERROR", "DEBUG"] * int(rows / 4) + ["INFO"] * (rows % 4),
+                       "size": np.arange(rows), "time": np.random.rand(rows) * 1000,
+                       "message": "some log message"})
+    rtn = {}
+    _start = time()
+    df.to_sql(name="t_bench_to_sql", con=conn, chunksize=1000, if_exists='replace')
+    rtn['to_sql'] = int(rows / (time() - _start))
+    _start = time()
+    _df2table(df, conn, "t_bench_df2table")
+    rtn['_df2table'] = int(rows / (time() - _start))
+    conn.execute("DROP TABLE IF EXISTS t_bench_to_sql")
+    conn.execute("DROP TABLE IF EXISTS t_bench_df2table")
+    _err("rows/sec: %s" % (str(rtn)))
+    return rtn
+
+
 def _find_matching(line, prev_matches, prev_message, begin_re, line_re, size_re=None, time_re=None, num_cols=None):
     """
     Search one line with given regex (compiled)
@@ -1290,8 +3650,93 @@ def _linecount_wc(filepath):
     return int(os.popen('wc -l %s' % (filepath)).read().split()[0])
 
 
+def _mmap_search(file_path, line_beginning, line_matching, size_re=None, time_re=None, num_cols=None):
+    """
+    Same results as the line loop of _read_file_and_search(), but memory-mapping an uncompressed file and finding the
+    beginnings of the log entries with one re.finditer on the bytes. Each log entry (with its continuation lines,
+    eg: java stacktrace) is decoded once and line_matching runs once per entry, instead of regex on each line
+    :param file_path: A file path (not .gz)
+    :param line_beginning: Regex to find the beginning of the line. Must start with '^'
+    :param line_matching: Regex to capture column values
+    :param size_re: Compiled (str) regex to capture size
+    :param time_re: Compiled (str) regex to capture time/duration
+    :param num_cols: Number of columns
+    :return: A list of tuples, or None if this file/regex can't be scanned with mmap (then use the line loop)
+    >>> _mmap_search("/no/such/file_ju_test", "^.", "(.+)") is None
+    True
+    """
+    import mmap
+    if file_path.endswith(".gz") or line_beginning.startswith('^') is False or os.path.isfile(file_path) is False:
+        return None
+    if os.stat(file_path).st_size == 0:
+        return []
+    begin_re = _compile(line_beginning.encode('utf-8'), re.MULTILINE)
+    line_re = _compile(line_matching)
+    tuples = []
+    pad = None
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # Text mode converts \r\n to \n, so using the line loop for such files
+        if mm.find(b"\r\n", 0, 1024 * 1024) >= 0:
+            return None
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        starts = [m.start() for m in begin_re.finditer(mm)]
+        starts.append(len(mm))
+        for (s, e) in zip(starts, starts[1:]):
+            # One slice and decode per log entry (not per line). The continuation lines are kept as they are
+            event = mm[s:e].decode('utf-8', errors='replace')
+            m = line_re.search(event)
+            if m is None:
+                continue
+            groups = m.groups()
+            message = groups[-1]
+            matches = groups[:-1]
+            if bool(size_re):
+                _size_matches = size_re.search(message or "")
+                matches += (_size_matches.group(1) if _size_matches else None,)
+            if bool(time_re):
+                _time_matches = time_re.search(message or "")
+                matches += (_ms(_time_matches, time_re) if _time_matches else None,)
+            eol = event.find("\n")
+            if 0 <= eol < len(event) - 1:
+                message = (message or "") + event[eol + 1:]
+            if pad is None:
+                # same as _massage_tuple_for_save()
+                pad = (None,) * max((num_cols or 0) - 1 - len(matches), 0)
+            tuples.append(matches + pad + (message,))
+    return tuples
+
+
+def _bench_log_scan(file_path, line_beginning="^\d\d\d\d-\d\d-\d\d",
+                    line_matching="^(\d\d\d\d-\d\d-\d\d.\d\d:\d\d:\d\d[^ ]*) +([^ ]+) +\[([^]]+)\] ([^ ]*) ([^ ]+) - (.*)",
+                    num_cols=6):
+    """
+    Compare the line loop and the mmap scanner of _read_file_and_search() (seconds, and if the results are same)
+    :param file_path: An uncompressed log file path
+    :param line_beginning: Regex to find the beginning of the line
+    :param line_matching: Regex to capture column values
+    :param num_cols: Number of columns
+    :return: dict of 'loop', 'mmap' => seconds, 'rows', 'same'
+    >>> import tempfile; d = tempfile.mkdtemp()
+    >>> with open(d + "/test.log", "w") as f: _ = f.write("junk line\\n"
+    ...     "2020-01-01 00:00:00,001 INFO  [qtp-1] admin a.B - one\\n"
+    ...     "2020-01-01 00:00:01,002 WARN  [qtp-2]  a.C - two\\njava.lang.Exception: x\\n\\tat a.C.d(C.java:1)\\n"
+    ...     "2020-01-01 00:00:02,003 ERROR [qtp-3] admin a.D - three \\u2713\\n")
+    >>> b = _bench_log_scan(d + "/test.log"); b['rows'], b['same']
+    (3, True)
+    """
+    s = time()
+    t_loop = _read_file_and_search(file_path, line_beginning, line_matching, num_cols=num_cols, mmap_scan=False)
+    loop_sec = time() - s
+    s = time()
+    t_mmap = _read_file_and_search(file_path, line_beginning, line_matching, num_cols=num_cols, mmap_scan=True)
+    mmap_sec = time() - s
+    return {'loop': loop_sec, 'mmap': mmap_sec, 'rows': len(t_mmap), 'same': t_loop == t_mmap}
+
+
+@_instrument(bytes_arg='file_path')
 def _read_file_and_search(file_path, line_beginning, line_matching, size_regex=None, time_regex=None, num_cols=None,
-                          replace_comma=False, line_from=0, line_until=0):
+                          replace_comma=False, line_from=0, line_until=0, epoch_col=None, mmap_scan=True):
     """
     Read a file and search each line with given regex
     :param file_path: A file path
@@ -1303,19 +3748,52 @@ def _read_file_and_search(file_path, line_beginning, line_matching, size_regex=N
     :param replace_comma: Sqlite does not like comma in datetime with milliseconds
     :param line_from: Read line from
     :param line_until: Read line until
+    :param epoch_col: (optional) Index of the date/time column. If given, UTC epoch milliseconds of the column is
+                      appended to each tuple (None if not parsed). The format is detected once per file
+    :param mmap_scan: If True, uncompressed files are scanned with _mmap_search() (faster), unless line_from/until
     :return: A list of tuples
     >>> pass    # TODO: implement test
     """
     _debug(f"line_beginning: {line_beginning}")
-    begin_re = re.compile(line_beginning)
-    line_re = re.compile(line_matching)
-    size_re = re.compile(size_regex) if bool(size_regex) else None
-    time_re = re.compile(time_regex) if bool(time_regex) else None
+    begin_re = _compile(line_beginning)
+    line_re = _compile(line_matching)
+    size_re = _compile(size_regex) if bool(size_regex) else None
+    time_re = _compile(time_regex) if bool(time_regex) else None
+    tuples = None
+    time_with_ms = _compile(r"\d\d\d\d-\d\d-\d\d.\d\d:\d\d:\d\d,\d+")
+    if mmap_scan and bool(line_from) is False and bool(line_until) is False:
+        tuples = _mmap_search(file_path, line_beginning, line_matching, size_re=size_re, time_re=time_re,
+                              num_cols=num_cols)
+    if tuples is None:
+        tuples = _read_lines_and_search(file_path, begin_re, line_re, size_re=size_re, time_re=time_re,
+                                        num_cols=num_cols, line_from=line_from, line_until=line_until)
+    # Checking the date format once per file (from a few lines), instead of a regex per line
+    if replace_comma and any(bool(t[0]) and time_with_ms.search(str(t[0])) for t in tuples[:10]):
+        tuples = [((t[0].replace(",", "."),) + t[1:]) if bool(t[0]) else t for t in tuples]
+    if epoch_col is not None and len(tuples) > 0:
+        epochs = _epoch_list([t[epoch_col] for t in tuples])
+        tuples = [t + (e,) for (t, e) in zip(tuples, epochs)]
+    return tuples
+
+
+def _read_lines_and_search(file_path, begin_re, line_re, size_re=None, time_re=None, num_cols=None, line_from=0,
+                           line_until=0):
+    """
+    The line loop of _read_file_and_search() (text or gz file)
+    :param file_path: A file path
+    :param begin_re: Compiled regex to find the beginning of the line
+    :param line_re: Compiled regex to capture column values
+    :param size_re: Compiled regex to capture size
+    :param time_re: Compiled regex to capture time/duration
+    :param num_cols: Number of columns
+    :param line_from: Read line from
+    :param line_until: Read line until
+    :return: A list of tuples
+    >>> pass    # Testing in _bench_log_scan()
+    """
     prev_matches = None
     prev_message = None
     tuples = []
-    time_with_ms = re.compile('\d\d\d\d-\d\d-\d\d.\d\d:\d\d:\d\d,\d+')
-
     ttl_line = _linecount_wc(file_path)
     tmp_counter = int(float(ttl_line) / 10)
     connter = 10000 if tmp_counter < 10000 else tmp_counter
@@ -1343,10 +3821,6 @@ def _read_file_and_search(file_path, line_beginning, line_matching, size_regex=N
                                                                  line_re=line_re, size_re=size_re, time_re=time_re,
                                                                  num_cols=num_cols)
         if bool(tmp_tuple):
-            if replace_comma and time_with_ms.search(tmp_tuple[0]):
-                tmp_l = list(tmp_tuple)
-                tmp_l[0] = tmp_tuple[0].replace(",", ".")
-                tmp_tuple = tuple(tmp_l)
             tuples += [tmp_tuple]
         else:
             _empty += 1
@@ -1361,6 +3835,7 @@ def _read_file_and_search(file_path, line_beginning, line_matching, size_regex=N
 def threads2table(filename="threads.txt", tablename=None, conn=None, date_time=None):
     # TODO: date_time (should use file modified time? but not trust-able)
     # TODO: waiting on | locked
+    # NOTE: for multiple dumps, thread_dumps2tables() saves unique stacks/frames once, with the dump date_time
     return logs2table(filename=filename, tablename=tablename, conn=conn,
                       col_names=['thread_name', 'id', 'state', 'stacktrace'],
                       line_beginning="^\"",
@@ -1368,6 +3843,213 @@ def threads2table(filename="threads.txt", tablename=None, conn=None, date_time=N
                       size_regex=None, time_regex=None)
 
 
+def _parse_thread_dumps(file_path, date_time=None):
+    """
+    Parse a file which contains one or multiple Java thread dumps (threads.txt of support zip, or jstack output)
+    A new dump starts at a date_time line (jstack -l output) or at 'Full thread dump' line
+    :param file_path: A file path
+    :param date_time: The date time of the first dump if the file doesn't contain it. If None, the file modified time
+                      (UTC)
+    :return: A list of dicts: {'date_time': str, 'threads': [(thread_name, tid, state, [frames], locks_str)]}
+    >>> _parse_thread_dumps("/no/such/file_ju_test")
+    []
+    """
+    global _THREAD_HEAD_REGEX
+    global _THREAD_TIME_REGEX
+    if os.path.isfile(file_path) is False:
+        return []
+    if bool(date_time) is False:
+        # UTC, as date_time is converted to epoch_ms as UTC (_epoch_list())
+        date_time = datetime.utcfromtimestamp(os.stat(file_path).st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+    head_r = _compile(_THREAD_HEAD_REGEX)
+    time_r = _compile(_THREAD_TIME_REGEX)
+    dumps = [{'date_time': date_time, 'threads': []}]
+    thread = None
+
+    def _end_thread():
+        if thread is not None:
+            dumps[-1]['threads'].append((thread[0], thread[1], thread[2], thread[3], "\n".join(thread[4])))
+
+    f = _open_file(file_path)
+    for l in f:
+        if bool(l) is False:
+            continue
+        if type(l) == bytes:
+            l = l.decode('utf8', errors='replace')
+        line = l.rstrip()
+        if line.startswith('"'):
+            _end_thread()
+            m = head_r.search(line)
+            if m:
+                (name, rest) = m.groups()
+                m_id = re.search(r'\bid=(\S+)|#(\d+)', rest)
+                m_state = re.search(r'\bstate=(\w+)', rest)
+                thread = [name, (m_id.group(1) or m_id.group(2)) if m_id else None,
+                          m_state.group(1) if m_state else None, [], []]
+            continue
+        stripped = line.strip()
+        if stripped.startswith('at '):
+            if thread is not None:
+                thread[3].append(stripped[3:])
+        elif stripped.startswith('- '):
+            if thread is not None:
+                thread[4].append(stripped[2:])
+        elif stripped.startswith('java.lang.Thread.State:'):
+            if thread is not None:
+                thread[2] = stripped.split()[1]
+        elif time_r.search(line) or line.startswith('Full thread dump'):
+            _end_thread()
+            thread = None
+            m = time_r.search(line)
+            if len(dumps[-1]['threads']) > 0:
+                dumps.append({'date_time': m.group(1) if m else dumps[-1]['date_time'], 'threads': []})
+            elif m:
+                dumps[-1]['date_time'] = m.group(1)
+    _end_thread()
+    f.close()
+    return [d for d in dumps if len(d['threads']) > 0]
+
+
+@_instrument(bytes_arg='filename')
+def thread_dumps2tables(filename="threads*.txt", conn=None, date_time=None, appending=False, prefix="t_td_"):
+    """
+    Save multiple Java thread dumps into normalized tables. Unique frames and stacks are interned (stored once), so
+    finding stuck/hot threads across many dumps is a join of small integer/hash columns instead of long texts.
+      <prefix>dumps(dump_id, date_time, epoch_ms, filename, thread_count)
+      <prefix>frames(frame_id, frame)
+      <prefix>stacks(stack_id, depth, top_frame_id)  # stack_id: md5 of frames
+      <prefix>stack_frames(stack_id, pos, frame_id)  # pos 0 is the top frame
+      <prefix>threads(dump_id, thread_name, tid, state, stack_id, locks)
+      <prefix>stack_counts(dump_id, stack_id, state, thread_count)
+      <prefix>transitions(thread_name, tid, from_dump_id, to_dump_id, from_state, to_state, same_stack)
+    :param filename: a file name (or path) or *simple* glob pattern. Files are ordered by the name
+    :param conn: DB connection object
+    :param date_time: The date time of the dump if the file doesn't contain it. If None, the file modified time
+    :param appending: default is False. If True, dumps/frames/stacks are added to the existing tables
+    :param prefix: Table name prefix
+    :return: Number of dumps saved
+    >>> thread_dumps2tables("/no/such/file_ju_test")
+    0
+    >>> import tempfile; d = tempfile.mkdtemp()
+    >>> dump = ['"worker-1" #10 prio=5 tid=0x1 nid=0x2 runnable', '   java.lang.Thread.State: RUNNABLE',
+    ...         '\\tat a.B.c(B.java:1)', '\\tat a.B.d(B.java:2)', '',
+    ...         '"idle-1" #11 prio=5 tid=0x3 nid=0x4 waiting on condition', '   java.lang.Thread.State: WAITING (parking)',
+    ...         '\\tat a.B.d(B.java:2)', '\\t- parking to wait for  <0x1> (a X)', '']
+    >>> with open(d + "/threads.txt", "w") as f: _ = f.write("\\n".join(["2020-01-01 00:00:00", "Full thread dump"] +
+    ...                                                      dump + ["2020-01-01 00:00:10", "Full thread dump"] + dump))
+    >>> c = connect(); thread_dumps2tables(d + "/threads.txt", c, prefix="t_test_td_")
+    2
+    >>> c.execute("SELECT date_time, epoch_ms FROM t_test_td_dumps WHERE dump_id = 2").fetchall()
+    [('2020-01-01 00:00:10', 1577836810000)]
+    >>> [c.execute("SELECT count(*) FROM t_test_td_" + t).fetchall()[0][0] for t in ['frames', 'stacks', 'threads', 'transitions']]
+    [2, 2, 4, 2]
+    >>> stuck_threads(min_dumps=2, conn=c, prefix="t_test_td_")[['thread_name', 'tid', 'dumps', 'top_frame']].values.tolist()
+    [['worker-1', '10', 2, 'a.B.c(B.java:1)']]
+    >>> thread_dumps2tables(d + "/threads.txt", c, appending=True, prefix="t_test_td_")
+    2
+    >>> [c.execute("SELECT count(*) FROM t_test_td_" + t).fetchall()[0][0] for t in ['frames', 'stacks', 'threads', 'transitions']]
+    [2, 2, 8, 6]
+    >>> stuck_threads(min_dumps=4, state=None, conn=c, prefix="t_test_td_")[['thread_name', 'state', 'dumps']].values.tolist()
+    [['idle-1', 'WAITING', 4], ['worker-1', 'RUNNABLE', 4]]
+    >>> for t in ['dumps', 'frames', 'stacks', 'stack_frames', 'threads', 'stack_counts', 'transitions']:
+    ...     _ = c.execute("DROP TABLE t_test_td_" + t)
+    """
+    import hashlib
+    if bool(conn) is False: conn = connect()
+    files = sorted(_find_files(filename))
+    if len(files) == 0:
+        return 0
+    t = {k: prefix + k for k in ['dumps', 'frames', 'stacks', 'stack_frames', 'threads', 'stack_counts',
+                                  'transitions']}
+    if appending is False:
+        for tbl in t.values():
+            conn.execute("DROP TABLE IF EXISTS %s" % (tbl))
+    conn.execute("CREATE TABLE IF NOT EXISTS %s (dump_id INTEGER PRIMARY KEY, date_time TEXT, epoch_ms INTEGER, "
+                 "filename TEXT, thread_count INTEGER)" % (t['dumps']))
+    conn.execute("CREATE TABLE IF NOT EXISTS %s (frame_id INTEGER PRIMARY KEY, frame TEXT UNIQUE)" % (t['frames']))
+    conn.execute("CREATE TABLE IF NOT EXISTS %s (stack_id TEXT PRIMARY KEY, depth INTEGER, top_frame_id INTEGER)" % (
+        t['stacks']))
+    conn.execute("CREATE TABLE IF NOT EXISTS %s (stack_id TEXT, pos INTEGER, frame_id INTEGER)" % (t['stack_frames']))
+    conn.execute("CREATE TABLE IF NOT EXISTS %s (dump_id INTEGER, thread_name TEXT, tid TEXT, state TEXT, "
+                 "stack_id TEXT, locks TEXT)" % (t['threads']))
+    # Interned frames and stacks (including already saved ones if appending)
+    frames = dict(conn.execute("SELECT frame, frame_id FROM %s" % (t['frames'])).fetchall())
+    stacks = set(r[0] for r in conn.execute("SELECT stack_id FROM %s" % (t['stacks'])).fetchall())
+    dump_id = conn.execute("SELECT IFNULL(MAX(dump_id), 0) FROM %s" % (t['dumps'])).fetchall()[0][0]
+    (new_frames, new_stacks, new_stack_frames, dump_rows, thread_rows) = ([], [], [], [], [])
+    for f in files:
+        for d in _parse_thread_dumps(f, date_time=date_time):
+            dump_id += 1
+            dump_rows.append([dump_id, d['date_time'], None, f, len(d['threads'])])
+            for (name, tid, state, frame_list, locks) in d['threads']:
+                stack_id = hashlib.md5("\n".join(frame_list).encode('utf-8')).hexdigest()
+                if stack_id not in stacks:
+                    stacks.add(stack_id)
+                    frame_ids = []
+                    for frame in frame_list:
+                        if frame not in frames:
+                            frames[frame] = len(frames) + 1
+                            new_frames.append((frames[frame], frame))
+                        frame_ids.append(frames[frame])
+                    new_stacks.append((stack_id, len(frame_ids), frame_ids[0] if len(frame_ids) > 0 else None))
+                    new_stack_frames += [(stack_id, pos, fid) for (pos, fid) in enumerate(frame_ids)]
+                thread_rows.append((dump_id, name, tid, state, stack_id, locks if bool(locks) else None))
+    if len(dump_rows) == 0:
+        return 0
+    for (row, epoch) in zip(dump_rows, _epoch_list([r[1] for r in dump_rows])):
+        row[2] = epoch
+    for (tbl, rows) in [('dumps', dump_rows), ('frames', new_frames), ('stacks', new_stacks),
+                        ('stack_frames', new_stack_frames), ('threads', thread_rows)]:
+        if len(rows) > 0:
+            _insert2table(conn=conn, tablename=t[tbl], tpls=rows)
+    conn.execute("CREATE INDEX IF NOT EXISTS %s_dump_idx ON %s (dump_id, thread_name)" % (t['threads'], t['threads']))
+    # Aggregates are re-computed from all dumps, as appended dumps change the transitions of the previous last dump
+    conn.execute("DROP TABLE IF EXISTS %s" % (t['stack_counts']))
+    conn.execute("""CREATE TABLE %s AS SELECT dump_id, stack_id, state, count(*) as thread_count
+FROM %s GROUP BY dump_id, stack_id, state""" % (t['stack_counts'], t['threads']))
+    conn.execute("DROP TABLE IF EXISTS %s" % (t['transitions']))
+    conn.execute("""CREATE TABLE %s AS
+WITH n AS (SELECT dump_id, LEAD(dump_id) OVER (ORDER BY dump_id) as next_dump_id FROM %s)
+SELECT a.thread_name, a.tid, a.dump_id as from_dump_id, b.dump_id as to_dump_id,
+    a.state as from_state, b.state as to_state, (a.stack_id = b.stack_id) as same_stack
+FROM %s a JOIN n ON n.dump_id = a.dump_id
+  JOIN %s b ON b.dump_id = n.next_dump_id AND b.thread_name = a.thread_name AND b.tid IS a.tid""" % (
+        t['transitions'], t['dumps'], t['threads'], t['threads']))
+    for tbl in t.values():
+        _catalog_update(tbl, conn)
+        _autocomp_inject(tablename=tbl, conn=conn)
+    _err("Saved %d dumps (%d threads, %d new stacks, %d new frames) into %s* tables" % (
+        len(dump_rows), len(thread_rows), len(new_stacks), len(new_frames), prefix))
+    return len(dump_rows)
+
+
+def stuck_threads(min_dumps=3, state='RUNNABLE', conn=None, prefix="t_td_"):
+    """
+    Return the threads which stayed in the same stack (and state) between successive dumps, at least min_dumps - 1
+    times (thread_dumps2tables() needs to be run first)
+    :param min_dumps: Minimum number of dumps
+    :param state: Thread state (eg: RUNNABLE, BLOCKED). If None, any state (but unchanged)
+    :param conn: DB connection object
+    :param prefix: Table name prefix used with thread_dumps2tables()
+    :return: A DataFrame of thread_name, tid, state, stack_id, dumps, top_frame
+    >>> pass    # Testing in thread_dumps2tables()
+    """
+    if bool(conn) is False: conn = connect()
+    state_sql = "" if state is None else " AND tr.to_state = '%s'" % (state)
+    # Each unchanged transition (from_dump -> to_dump) adds one more dump, so the number of dumps is transitions + 1
+    sql = """SELECT tr.thread_name, tr.tid, tr.to_state as state, th.stack_id, count(*) + 1 as dumps, f.frame as top_frame
+FROM {p}transitions tr
+  JOIN {p}threads th ON th.dump_id = tr.to_dump_id AND th.thread_name = tr.thread_name AND th.tid IS tr.tid
+  JOIN {p}stacks s ON s.stack_id = th.stack_id
+  LEFT JOIN {p}frames f ON f.frame_id = s.top_frame_id
+WHERE tr.same_stack = 1 AND tr.from_state = tr.to_state{s}
+GROUP BY tr.thread_name, tr.tid, tr.to_state, th.stack_id
+HAVING count(*) + 1 >= {n}
+ORDER BY dumps DESC""".format(p=prefix, s=state_sql, n=int(min_dumps))
+    return query(sql, conn=conn, no_history=True)
+
+
+@_instrument(bytes_arg='filename')
 def logs2table(filename, tablename=None, conn=None,
                col_names=['date_time', 'loglevel', 'thread', 'user', 'class', 'message'],
                num_cols=None, line_beginning="^\d\d\d\d-\d\d-\d\d",
@@ -1375,7 +4057,7 @@ def logs2table(filename, tablename=None, conn=None,
                size_regex=None, time_regex=None,
                line_from=0, line_until=0,
                max_file_num=10, max_file_size=(1024 * 1024 * 100),
-               appending=False, multiprocessing=False):
+               appending=False, multiprocessing=False, epoch_ms=True):
     """
     Insert multiple log files into *one* table
     :param filename: a file name (or path) or *simple* glob regex
@@ -1393,6 +4075,7 @@ def logs2table(filename, tablename=None, conn=None,
     :param max_file_size: To avoid memory issue, setting max file size per file
     :param appending: default is False. If False, use 'DROP TABLE IF EXISTS'
     :param multiprocessing: (Experimental) default is False. If True, use multiple CPUs
+    :param epoch_ms: default is True. If True and col_names contains 'date_time', add 'epoch_ms' INTEGER column (UTC)
     :return: True if no error, or a tuple contains multiple information for debug
     #>>> logs2table(filename='queries.*log*', tablename='t_queries_log',
             col_names=['date_time', 'ids', 'message', 'extra_lines'],
@@ -1446,6 +4129,11 @@ def logs2table(filename, tablename=None, conn=None,
                 col_def_str += "%s REAL" % (v)
             else:
                 col_def_str += "%s TEXT" % (v)
+    # Parsed once per file with a fixed format (_to_epoch_ms()), so no need to convert date_time string per query
+    epoch_col = None
+    if epoch_ms and isinstance(col_names, list) and 'date_time' in col_names:
+        epoch_col = col_names.index('date_time')
+        col_def_str += ", epoch_ms INTEGER"
 
     if bool(tablename) is False:
         first_filename = os.path.basename(files[0])
@@ -1463,6 +4151,9 @@ def logs2table(filename, tablename=None, conn=None,
         res = conn.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (tablename, col_def_str))
         if bool(res) is False:
             return res
+        if appending is False:
+            _catalog_update(tablename, conn, rows=0)
+            _rollup_reset(tablename, conn)
 
     if multiprocessing:
         args_list = []
@@ -1473,10 +4164,14 @@ def logs2table(filename, tablename=None, conn=None,
                 continue
             # concurrent.futures.ProcessPoolExecutor hangs in Jupyter, so can't use kwargs
             args_list.append(
-                (f, line_beginning, line_matching, size_regex, time_regex, num_cols, True, line_from, line_until))
+                (f, line_beginning, line_matching, size_regex, time_regex, num_cols, True, line_from, line_until,
+                 epoch_col))
         # file_path, line_beginning, line_matching, size_regex=None, time_regex=None, num_cols=None, replace_comma=False
-        rs = _mexec(_read_file_and_search, args_list)
-        for tuples in rs:
+        rs = _mexec(_read_file_and_search, args_list, callback=_mexec_progress, regexes=(line_beginning, line_matching))
+        for (i, tuples) in enumerate(rs):
+            if isinstance(tuples, Exception):
+                _err("WARN: reading %s failed: %s" % (str(args_list[i][0]), str(tuples)))
+                continue
             if bool(tuples) is False or len(tuples) == 0:
                 _err("WARN: _mexec returned empty tuple ...")
                 continue
@@ -1492,17 +4187,19 @@ def logs2table(filename, tablename=None, conn=None,
                 continue
             tuples = _read_file_and_search(file_path=f, line_beginning=line_beginning, line_matching=line_matching,
                                            size_regex=size_regex, time_regex=time_regex, num_cols=num_cols,
-                                           replace_comma=True, line_from=line_from, line_until=line_until)
+                                           replace_comma=True, line_from=line_from, line_until=line_until,
+                                           epoch_col=epoch_col)
             if bool(tuples):
                 _debug(("tuples len:%d" % len(tuples)))
             if len(tuples) > 0:
                 res = _insert2table(conn=conn, tablename=tablename, tpls=tuples)
                 if bool(res) is False:  # if fails once, stop
                     return res
-    _autocomp_inject(tablename=tablename)
+    _autocomp_inject(tablename=tablename, conn=conn)
     return True
 
 
+@_instrument(bytes_arg='filename')
 def logs2dfs(filename, col_names=['datetime', 'loglevel', 'thread', 'ids', 'size', 'time', 'message'],
              num_fields=None, line_beginning="^\d\d\d\d-\d\d-\d\d",
              line_matching="^(\d\d\d\d-\d\d-\d\d.\d\d:\d\d:\d\d[0-9.,]*) (.+?) \[(.+?)\] (\{.*?\}) (.+)",
@@ -1543,9 +4240,12 @@ def logs2dfs(filename, col_names=['datetime', 'loglevel', 'thread', 'ids', 'size
         for f in files:
             args_list.append((f, line_beginning, line_matching, size_regex, time_regex, num_fields, True))
         # from concurrent.futures import ProcessPoolExecutor hangs in Jupyter, so can't use kwargs
-        rs = _mexec(_read_file_and_search, args_list)
-        for tuples in rs:
-            if len(tuples) > 0:
+        rs = _mexec(_read_file_and_search, args_list, callback=_mexec_progress, regexes=(line_beginning, line_matching))
+        for (i, tuples) in enumerate(rs):
+            if isinstance(tuples, Exception):
+                _err("WARN: reading %s failed: %s" % (str(args_list[i][0]), str(tuples)))
+                continue
+            if bool(tuples) and len(tuples) > 0:
                 dfs += [pd.DataFrame.from_records(tuples, columns=col_names)]
     else:
         for f in files:
@@ -1652,7 +4352,141 @@ def _gen_regex_for_hazel_health(sample):
     return (columns, partern_str)
 
 
-def load_csvs(src="./", conn=None, include_ptn='*.csv', exclude_ptn='', chunksize=1000):
+def _kv_col_name(key, used=None):
+    """
+    Return a column name for a key of key=value (non alphanumeric characters are replaced with '_')
+    :param key: A key string
+    :param used: (optional) A set of column names already used. If the name collides (eg: 'a.b' and 'a_b'),
+                 a suffix (_2, _3 ...) is appended, and the returned name is added into the set
+    :return: column name
+    >>> _kv_col_name("heap.memory.used/max")
+    'heap_memory_used_max'
+    >>> used = {'a_b'}; _kv_col_name("a.b", used), _kv_col_name("a/b", used)
+    ('a_b_2', 'a_b_3')
+    """
+    name = re.sub(r'[^0-9a-zA-Z_]', '_', key)
+    if used is None:
+        return name
+    (base, i) = (name, 1)
+    while name in used:
+        i += 1
+        name = "%s_%d" % (base, i)
+    used.add(name)
+    return name
+
+
+def _kv_typed(series):
+    """
+    Decide the SQLite type of one extracted key=value column, and convert the values (only unique values are checked)
+    Integers, decimals, percentages (85.5% => 85.5), sizes (1.2G => bytes) and durations (12ms => msec) are numeric
+    NOTE: sizes are tried before durations, so a column which has only 'm' units (eg: 5m) is bytes (MiB), as
+          HealthMonitor writes sizes like 512M. If other values have a duration unit (eg: 5m and 30s), it's msec.
+    :param series: A Series of value strings (None if the key didn't exist in the line)
+    :return: (converted Series, SQLite type)
+    >>> [_kv_typed(pd.Series(v))[1] for v in [["1", None], ["0.5"], ["12.1%"], ["0", "1.2G"], ["25ms", "1s"], ["a"]]]
+    ['INTEGER', 'REAL', 'REAL', 'INTEGER', 'INTEGER', 'TEXT']
+    >>> _kv_typed(pd.Series(["0", "1.5K", None]))[0].tolist()
+    [0, 1536, <NA>]
+    >>> _kv_typed(pd.Series(["5m"]))[0].tolist(), _kv_typed(pd.Series(["5m", "30s"]))[0].tolist()
+    ([5242880], [300000, 30000])
+    """
+    uniq = pd.Series(series.dropna().unique(), dtype=object).astype(str).str.strip()
+    if len(uniq) == 0:
+        return (series, 'TEXT')
+    if uniq.str.fullmatch(r'-?\d+').all():
+        return (pd.to_numeric(series, errors='coerce').astype('Int64'), 'INTEGER')
+    if uniq.str.fullmatch(r'-?\d*\.?\d+').all():
+        return (pd.to_numeric(series, errors='coerce'), 'REAL')
+    if uniq.str.fullmatch(r'-?\d*\.?\d+%').all():
+        return (pd.to_numeric(series.str.rstrip('%'), errors='coerce'), 'REAL')
+    # Sizes before durations: the order decides only the ambiguous 'm' (MiB or minutes). See NOTE above
+    if uniq.str.fullmatch(r'-?\d*\.?\d+ ?([kKmMgGtT]i?[bB]?|[bB])?').all():
+        return (series.ju.to_bytes(), 'INTEGER')
+    if uniq.str.fullmatch(r'-?\d*\.?\d+ ?(ns|us|ms|s|sec|m|min|h|d)?', flags=re.IGNORECASE).all():
+        return (series.ju.to_ms().round().astype('Int64'), 'INTEGER')
+    return (series.astype(object).where(series.notna(), None), 'TEXT')
+
+
+def kv2df(messages, head=None):
+    """
+    Extract key=value pairs (eg: Hazelcast HealthMonitor lines) into a wide DataFrame with typed columns.
+    The columns are the union of the keys in all messages (no need to be the same keys in the same order)
+    If keys become the same column name (eg: 'a.b' and 'a_b', or a key same as a head column), the key which is
+    already a valid name keeps it, and the others get a suffix (_2, _3 ...) in the sorted order of the keys
+    :param messages: A Series (or list) of strings
+    :param head: (optional) (col_names, regex) to extract the beginning of the messages (eg: _HAZEL_HEALTH_HEAD)
+    :return: (DataFrame, dict of column name => SQLite type). Index is same as messages
+    >>> (df, types) = kv2df(["a=1, b.c=10MB, d=5.0%", "b.c=1G, e=x"])
+    >>> df.values.tolist()
+    [[1, 10485760, 5.0, None], [<NA>, 1073741824, nan, 'x']]
+    >>> types
+    {'a': 'INTEGER', 'b_c': 'INTEGER', 'd': 'REAL', 'e': 'TEXT'}
+    >>> kv2df(["a.b=1, a_b=2"])[0].to_dict('records')
+    [{'a_b_2': 1, 'a_b': 2}]
+    """
+    global _KV_REGEX
+    s = messages if isinstance(messages, pd.Series) else pd.Series(messages, dtype=object)
+    df = pd.DataFrame(index=s.index)
+    if bool(head):
+        df = s.str.extract(head[1])
+        df.columns = head[0]
+    col_types = {c: 'TEXT' for c in df.columns}
+    if len(s) == 0:
+        return (df, col_types)
+    # One dict per line (findall is much faster than str.extractall), then a DataFrame with the union of the keys
+    # If a key is repeated in one line, the last one wins
+    regex = _compile(_KV_REGEX)
+    wide = pd.DataFrame([dict(regex.findall(m)) if isinstance(m, str) else {} for m in s], index=s.index)
+    used = set(df.columns)
+    # The keys which don't need sanitizing pick their names first, so that the suffix doesn't depend on the key order
+    names = {k: _kv_col_name(k, used) for k in sorted(wide.columns, key=lambda k: (_kv_col_name(k) != k, k))}
+    for k in wide.columns:
+        (values, col_type) = _kv_typed(wide[k])
+        c = names[k]
+        df[c] = values
+        col_types[c] = col_type
+    return (df, col_types)
+
+
+def kv2table(df, conn, tablename, col='message', head=None, appending=False):
+    """
+    Save a DataFrame with key=value messages (eg: HealthMonitor lines of t_logs) into a typed wide table.
+    Tolerant schema: if appending, new keys are added with ALTER TABLE, and missing keys are NULL.
+    :param df: A DataFrame which contains the key=value column (other columns, such as date_time, are kept)
+    :param conn: DB connection object
+    :param tablename: Table name
+    :param col: The column name of key=value strings
+    :param head: (optional) (col_names, regex) for the beginning of the messages (eg: _HAZEL_HEALTH_HEAD)
+    :param appending: default is False. If False, use 'DROP TABLE IF EXISTS'
+    :return: Number of inserted rows
+    >>> c = connect(); kv2table(pd.DataFrame({"date_time": ["2020-01-01"], "message": ["a=1"]}), c, "t_test_kv")
+    1
+    >>> kv2table(pd.DataFrame({"date_time": ["2020-01-02"], "message": ["b=2ms, a=3"]}), c, "t_test_kv", appending=True)
+    1
+    >>> c.execute("SELECT date_time, a, b FROM t_test_kv").fetchall()
+    [('2020-01-01', 1, None), ('2020-01-02', 3, 2)]
+    >>> _ = c.execute("DROP TABLE t_test_kv")
+    """
+    (df_kv, col_types) = kv2df(df[col], head=head)
+    df = df.drop(columns=[col]).join(df_kv)
+    existing = []
+    if appending:
+        existing = [r[1] for r in conn.execute("PRAGMA table_info(%s)" % (_quote_ident(tablename))).fetchall()]
+    if len(existing) > 0:
+        for c in df.columns:
+            if c not in existing:
+                conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    _quote_ident(tablename), _quote_ident(c), col_types.get(c, _sqlite_type(df[c].dtype))))
+                existing.append(c)
+        df = df.reindex(columns=existing)
+    rtn = _df2table(df, conn=conn, tablename=tablename, if_exists='append' if appending else 'replace', index=False,
+                    col_types=col_types)
+    _autocomp_inject(tablename=tablename, conn=conn)
+    return rtn
+
+
+@_instrument()
+def load_csvs(src="./", conn=None, include_ptn='*.csv', exclude_ptn='', chunksize=100000, num_pool=None):
     """
     Convert multiple CSV files to DF and DB tables
     Example: _=ju.load_csvs("./", ju.connect(), "tables_*.csv")
@@ -1660,15 +4494,18 @@ def load_csvs(src="./", conn=None, include_ptn='*.csv', exclude_ptn='', chunksiz
     :param conn: DB connection object
     :param include_ptn: Include pattern
     :param exclude_ptn: Exclude pattern
-    :param chunksize: to_sql() chunk size
+    :param chunksize: Rows per transaction when inserting (see _df2table)
+    :param num_pool: Number of processes to parse files. If None, half of CPUs
     :return: A tuple contain key=>file relationship and Pandas dataframes objects
     #>>> (names_dict, dfs) = load_csvs(src="./stats")
     #>>> bool(names_dict)
     #True
     >>> pass    # TODO: implement test
     """
+    global _CSV_CHUNK_THRESHOLD
     names_dict = {}
     dfs = {}
+    small_files = {}
     ex = re.compile(exclude_ptn)
 
     files = _globr(include_ptn, src)
@@ -1677,14 +4514,145 @@ def load_csvs(src="./", conn=None, include_ptn='*.csv', exclude_ptn='', chunksiz
 
         f_name, f_ext = os.path.splitext(os.path.basename(f))
         new_name = _pick_new_key(f_name, names_dict, using_1st_char=(bool(conn) is False), prefix='t_')
-        _err("Creating table: %s ..." % (new_name))
         names_dict[new_name] = f
+        if bool(conn) and os.stat(f).st_size >= _CSV_CHUNK_THRESHOLD:
+            # Large files are read in chunks by csv2df, so not sending them to the pool
+            dfs[new_name] = csv2df(filename=f, conn=conn, tablename=new_name, chunksize=chunksize)
+        else:
+            small_files[new_name] = f
 
-        dfs[new_name] = csv2df(file_path=f, conn=conn, tablename=new_name, chunksize=chunksize)
+    def _writer(df, tablename):
+        global _DB_SCHEMA
+        _err("Creating table: %s ..." % (tablename))
+        _df2table(df, conn=conn, tablename=tablename, chunksize=chunksize)
+        _autocomp_inject(tablename=tablename, conn=conn)
+        return len(df) > 0
+
+    dfs.update(_load_files_parallel(csv2df, small_files, writer=(_writer if bool(conn) else None), num=num_pool))
     return (names_dict, dfs)
 
 
-def csv2df(filename, conn=None, tablename=None, chunksize=1000, header=0):
+def _csv_sample_dtypes(file_path, header=0, names=None, sample_rows=10000):
+    """
+    Read the first rows of a CSV file and decide the dtype of each column, so that chunks use the same types
+    :param file_path: CSV file path
+    :param header: same as pd.read_csv
+    :param names: same as pd.read_csv
+    :param sample_rows: Number of rows to read as a sample
+    :return: (list of column names, dict of column name => 'Int64', 'float64', 'bool' or 'str')
+    >>> pass    # Testing in csv2df()
+    """
+    df = pd.read_csv(file_path, escapechar='\\', header=header, names=names, nrows=sample_rows)
+    dtypes = {}
+    for c in df.columns:
+        kind = df[c].dtype.kind
+        if kind in ['i', 'u']:
+            dtypes[c] = 'Int64'
+        elif kind == 'f':
+            dtypes[c] = 'float64'
+        elif kind == 'b':
+            dtypes[c] = 'bool'
+        else:
+            dtypes[c] = 'str'
+    return (df.columns.tolist(), dtypes)
+
+
+def _csv_chunks(file_path, columns, header=0, names=None, chunksize=100000):
+    """
+    Generator to read a CSV file chunk by chunk as string columns (pyarrow is used if available)
+    :param file_path: CSV file path
+    :param columns: Column names (from _csv_sample_dtypes)
+    :param header: same as pd.read_csv
+    :param names: same as pd.read_csv
+    :param chunksize: Rows per chunk (for pyarrow, this is used to estimate the block size)
+    :return: Generator of DataFrame objects
+    >>> pass    # Testing in csv2df()
+    """
+    if pa is not None and header in [0, None]:
+        from pyarrow import csv as pa_csv
+        # pyarrow does not accept the integer column names which pandas generates when no header
+        str_cols = [str(c) for c in columns]
+        read_opts = pa_csv.ReadOptions(column_names=str_cols, skip_rows=(1 if header == 0 else 0),
+                                       block_size=max(chunksize * 256, 1024 * 1024))
+        parse_opts = pa_csv.ParseOptions(escape_char='\\', newlines_in_values=True)
+        conv_opts = pa_csv.ConvertOptions(column_types={c: pa.string() for c in str_cols},
+                                          strings_can_be_null=True)
+        reader = pa_csv.open_csv(file_path, read_options=read_opts, parse_options=parse_opts,
+                                 convert_options=conv_opts)
+        for batch in reader:
+            df = batch.to_pandas()
+            df.columns = columns
+            yield df
+        return
+    for df in pd.read_csv(file_path, escapechar='\\', header=header, names=names, dtype=str, chunksize=chunksize):
+        yield df
+
+
+def _apply_dtypes(df, dtypes, name=None):
+    """
+    Convert string columns of one chunk to the given dtypes
+    If a column contains a value which can't be converted, the column of this chunk is kept as string
+    :param df: A DataFrame which columns are string
+    :param dtypes: dict of column name => dtype (from _csv_sample_dtypes)
+    :param name: just for logging
+    :return: Modified df
+    >>> pass    # Testing in csv2df()
+    """
+    for c, t in dtypes.items():
+        if t == 'str' or c not in df.columns:
+            continue
+        if t == 'bool':
+            converted = df[c].str.lower().map({'true': True, 'false': False})
+        else:
+            converted = pd.to_numeric(df[c], errors='coerce')
+        try:
+            if converted.isna().sum() > df[c].isna().sum():
+                raise ValueError("non %s value(s)" % (t))
+            df[c] = converted.astype(t) if t != 'bool' else converted
+        except (TypeError, ValueError) as e:
+            _err("WARN: column %s of %s: %s. Keeping as string for this chunk." % (str(c), str(name), str(e)))
+    return df
+
+
+@_instrument(bytes_arg='file_path')
+def _csv2table_chunked(file_path, conn, tablename, chunksize=100000, header=0, names=None, sample_rows=10000,
+                       epoch_col=None):
+    """
+    Load a large CSV file into a DB table chunk by chunk, so that the whole file is not in memory
+    :param file_path: CSV file path
+    :param conn: DB connection object
+    :param tablename: Table name
+    :param chunksize: Rows per chunk
+    :param header: same as pd.read_csv
+    :param names: same as pd.read_csv
+    :param sample_rows: Number of rows used to decide the column types
+    :param epoch_col: (optional) The date/time column name. If given, epoch_ms column (UTC) is added
+    :return: Number of inserted rows
+    >>> pass    # Testing in csv2df()
+    """
+    global _DB_SCHEMA
+    (columns, dtypes) = _csv_sample_dtypes(file_path, header=header, names=names, sample_rows=sample_rows)
+    _debug("dtypes: %s" % (str(dtypes)))
+    # Creating the table from the sample, so that a chunk kept as string doesn't change the column types
+    col_types = {str(c): _sqlite_type(t) for c, t in dtypes.items()}
+    if epoch_col is not None:
+        col_types['epoch_ms'] = 'INTEGER'
+    rows = 0
+    if_exists = 'replace'
+    for df in _csv_chunks(file_path, columns, header=header, names=names, chunksize=chunksize):
+        df = _apply_dtypes(df, dtypes, name=tablename)
+        if epoch_col in df.columns:
+            df['epoch_ms'] = _to_epoch_ms(df[epoch_col].astype(object))
+        _df2table(df, conn=conn, tablename=tablename, if_exists=if_exists, index=False, chunksize=chunksize,
+                  col_types=col_types)
+        if_exists = 'append'
+        rows += len(df)
+        _err("  Inserted %d rows into %s (%s) ..." % (rows, tablename, _timestamp(format="%H:%M:%S")))
+    return rows
+
+
+@_instrument(bytes_arg='filename')
+def csv2df(filename, conn=None, tablename=None, chunksize=100000, header=0, read_chunksize=None, epoch_col=None):
     '''
     Load a CSV file into a DataFrame
     If conn is given, import into a DB table
@@ -1694,11 +4662,17 @@ def csv2df(filename, conn=None, tablename=None, chunksize=1000, header=0):
     :param chunksize: Rows will be written in batches of this size at a time
     :param header: Row number(s) to use as the column names if not the first line (0) is not column name
                    Or a list of column names
+    :param read_chunksize: If conn is given, read the file with this many rows per chunk and append each chunk
+                   into the table. If None, 100000 is used when the file is larger than _CSV_CHUNK_THRESHOLD
+    :param epoch_col: (optional) The date/time column name. If given, epoch_ms column (UTC epoch milliseconds) is
+                   added, so that queries don't need to parse the date/time string per row
     :return: Pandas DF object or False if file is not readable
     #>>> df = ju.csv2df(file_path='./slow_queries.csv', conn=ju.connect())
+    #>>> ju.csv2df('./request.csv', conn=ju.connect(), read_chunksize=200000)
     >>> pass    # Testing in df2csv()
     '''
     global _DB_SCHEMA
+    global _CSV_CHUNK_THRESHOLD
     if os.path.exists(filename):
         file_path = filename
     else:
@@ -1712,16 +4686,27 @@ def csv2df(filename, conn=None, tablename=None, chunksize=1000, header=0):
     if type(header) == list:
         names = header
         header = None
-    df = pd.read_csv(file_path, escapechar='\\', header=header, names=names)
     if bool(tablename) and bool(conn) is False:
         conn = connect()
+    if bool(conn) and read_chunksize is None and os.stat(file_path).st_size >= _CSV_CHUNK_THRESHOLD:
+        read_chunksize = 100000
+    if bool(conn) and bool(read_chunksize):
+        if bool(tablename) is False:
+            tablename = _pick_new_key(os.path.basename(file_path), {}, using_1st_char=False, prefix='t_')
+        _err("Creating table: %s (chunked) ..." % (tablename))
+        rows = _csv2table_chunked(file_path, conn=conn, tablename=tablename, chunksize=read_chunksize,
+                                  header=header, names=names, epoch_col=epoch_col)
+        _autocomp_inject(tablename=tablename, conn=conn)
+        return rows > 0
+    df = pd.read_csv(file_path, escapechar='\\', header=header, names=names)
+    if epoch_col in df.columns:
+        df['epoch_ms'] = _to_epoch_ms(df[epoch_col].astype(object))
     if bool(conn):
         if bool(tablename) is False:
             tablename = _pick_new_key(os.path.basename(file_path), {}, using_1st_char=False, prefix='t_')
         _err("Creating table: %s ..." % (tablename))
-        # Not sure if to_sql returns some result
-        df.to_sql(name=tablename, con=conn, chunksize=chunksize, if_exists='replace', schema=_DB_SCHEMA)
-        _autocomp_inject(tablename=tablename)
+        _df2table(df, conn=conn, tablename=tablename, chunksize=chunksize)
+        _autocomp_inject(tablename=tablename, conn=conn)
         return len(df) > 0
     return df
 
@@ -1766,7 +4751,189 @@ def df2csv(df, file_path, mode="w", header=True):
     return df.to_csv(file_path, mode=mode, header=header, index=False, escapechar='\\')
 
 
-def df2files(df, filepath_prefix, extension="", columns=None, overwriting=False, sep="="):
+def _sqlite_table_arrow_schema(tablename, conn):
+    """
+    Decide pyarrow Schema of a SQLite table from the actual stored value types (not declared types)
+    NOTE: this scans the table once
+    :param tablename: Table name
+    :param conn: DB connection object
+    :return: pyarrow Schema
+    >>> pass    # Testing in table2parquet()
+    """
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(%s)" % (_quote_ident(tablename))).fetchall()]
+    sql = "SELECT %s FROM %s" % (
+        ", ".join("GROUP_CONCAT(DISTINCT typeof(%s))" % (_quote_ident(c)) for c in cols), _quote_ident(tablename))
+    types = conn.execute(sql).fetchall()[0]
+    fields = []
+    for c, t in zip(cols, types):
+        t = set(str(t).split(",")) - {"null", "None"}
+        if t == {"integer"}:
+            fields.append(pa.field(c, pa.int64()))
+        elif len(t) > 0 and t <= {"integer", "real"}:
+            fields.append(pa.field(c, pa.float64()))
+        elif t == {"blob"}:
+            fields.append(pa.field(c, pa.binary()))
+        else:
+            fields.append(pa.field(c, pa.string()))
+    return pa.schema(fields)
+
+
+@_instrument()
+def table2parquet(tablename, file_path=None, conn=None, batch_size=100000, compression='snappy'):
+    """
+    Export a DB table to a Parquet file with record batches, so that types are kept and the table is not in memory
+    :param tablename: Table name
+    :param file_path: Parquet file path. If empty, tablename + ".parquet"
+    :param conn: DB connection object
+    :param batch_size: Number of rows per record batch
+    :param compression: Parquet compression codec
+    :return: Number of written rows, or False if pyarrow is not installed
+    >>> _ = _df2table(pd.DataFrame([{"a": 1, "b": "x"}, {"a": None, "b": "y"}]), connect(), "t_test_pq", index=False)
+    >>> table2parquet("t_test_pq", "/tmp/test_table2parquet.parquet")
+    2
+    >>> parquet2table("/tmp/test_table2parquet.parquet", "t_test_pq2")
+    2
+    >>> query("select * from t_test_pq2", no_history=True).values.tolist()
+    [[1.0, 'x'], [nan, 'y']]
+    >>> _ = connect().execute("DROP TABLE t_test_pq"); _ = connect().execute("DROP TABLE t_test_pq2")
+    >>> os.remove("/tmp/test_table2parquet.parquet")
+    """
+    if pa is None:
+        _err("pyarrow is not installed.")
+        return False
+    if bool(conn) is False: conn = connect()
+    if bool(file_path) is False:
+        file_path = tablename + ".parquet"
+    from pyarrow import parquet as pq
+    schema = _sqlite_table_arrow_schema(tablename, conn)
+    cur = conn.execute("SELECT * FROM %s" % (_quote_ident(tablename)))
+    rows = 0
+    with pq.ParquetWriter(file_path, schema, compression=compression) as writer:
+        for batch in _cursor2batches(cur, batch_size, schema=schema):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    _err("Wrote %d rows of %s into %s" % (rows, tablename, file_path))
+    return rows
+
+
+@_instrument(bytes_arg='file_path')
+def parquet2table(file_path, tablename=None, conn=None, batch_size=100000, appending=False):
+    """
+    Import a Parquet file into a DB table with record batches
+    :param file_path: Parquet file path
+    :param tablename: If empty, table name will be the filename without extension
+    :param conn: DB connection object
+    :param batch_size: Number of rows per record batch
+    :param appending: default is False. If False, the table is replaced
+    :return: Number of inserted rows, or False if pyarrow is not installed
+    >>> pass    # Testing in table2parquet()
+    """
+    if pa is None:
+        _err("pyarrow is not installed.")
+        return False
+    if bool(conn) is False: conn = connect()
+    if bool(tablename) is False:
+        tablename = _pick_new_key(os.path.splitext(os.path.basename(file_path))[0], {}, using_1st_char=False,
+                                  prefix='t_')
+    from pyarrow import parquet as pq
+    pf = pq.ParquetFile(file_path)
+    col_types = {}
+    for f in pf.schema_arrow:
+        if pa.types.is_integer(f.type) or pa.types.is_boolean(f.type):
+            col_types[f.name] = "INTEGER"
+        elif pa.types.is_floating(f.type):
+            col_types[f.name] = "REAL"
+        elif pa.types.is_binary(f.type):
+            col_types[f.name] = "BLOB"
+        else:
+            col_types[f.name] = "TEXT"
+    _err("Creating table: %s ..." % (tablename))
+    if_exists = 'append' if appending else 'replace'
+    rows = 0
+    for batch in pf.iter_batches(batch_size=batch_size):
+        rows += _df2table(batch.to_pandas(), conn=conn, tablename=tablename, if_exists=if_exists, index=False,
+                          chunksize=batch_size, col_types=col_types)
+        if_exists = 'append'
+    if rows == 0 and appending is False:
+        _df2table(pf.schema_arrow.empty_table().to_pandas(), conn=conn, tablename=tablename, index=False,
+                  col_types=col_types)
+    _autocomp_inject(tablename=tablename, conn=conn)
+    return rows
+
+
+def _df2file_contents(df, columns=None, sep="="):
+    """
+    Generate the file contents of each row of a DataFrame with vectorized string operations (no iterrows)
+    :param df: Panda DataFrame
+    :param columns: list of column names or string
+    :param sep: Separator character which is used when multiple columns exist
+    :return: Pandas Series of strings (same index as df)
+    >>> _df2file_contents(pd.DataFrame([{"a": "x", "b": 1}]), ["a", "b"]).tolist()
+    ['=0\\na=x\\nb=1\\n']
+    >>> _df2file_contents(pd.DataFrame([{"a": "x", "b": 1}]), "a").tolist()
+    ['x']
+    """
+    if type(columns) == type('a'):
+        return df[columns].fillna("").astype(str)
+    if type(columns) == type([]) and len(columns) > 0:
+        df = df[columns]
+    # Same format as Series.to_csv(sep=sep): header line (sep + index), then 'column<sep>value' lines
+    contents = sep + df.index.to_series().astype(str)
+    for c in df.columns:
+        v = df[c].fillna("").astype(str)
+        needs_quote = v.str.contains(sep, regex=False) | v.str.contains('"', regex=False) | v.str.contains(
+            "\n", regex=False)
+        v = v.where(~needs_quote, '"' + v.str.replace('"', '""', regex=False) + '"')
+        contents = contents + "\n" + str(c) + sep + v
+    return contents + "\n"
+
+
+def _write_file(file_path, content, overwriting=False):
+    """
+    Write one file. If not overwriting, opening with 'x' mode instead of checking os.path.exists
+    :return: True if written, False if skipped
+    """
+    try:
+        with open(file_path, 'w' if overwriting else 'x') as f:
+            f.write(content)
+        return True
+    except FileExistsError:
+        return False
+
+
+def _write_archive(archive_path, names, contents):
+    """
+    Write contents into one tar (.tar, .tar.gz, .tgz) or zip file
+    :param archive_path: Archive file path
+    :param names: list of member names
+    :param contents: list of strings
+    :return: Number of members
+    >>> _write_archive("/tmp/test_write_archive.zip", ["a.txt"], ["aaa"])
+    1
+    >>> os.remove("/tmp/test_write_archive.zip")
+    """
+    if archive_path.endswith(".zip"):
+        import zipfile
+        with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for n, c in zip(names, contents):
+                zf.writestr(n, c)
+        return len(names)
+    import tarfile, io
+    mode = 'w:gz' if archive_path.endswith((".gz", ".tgz")) else 'w'
+    with tarfile.open(archive_path, mode) as tf:
+        _now = time()
+        for n, c in zip(names, contents):
+            data = c.encode('utf-8')
+            ti = tarfile.TarInfo(name=n)
+            ti.size = len(data)
+            ti.mtime = _now
+            tf.addfile(ti, io.BytesIO(data))
+    return len(names)
+
+
+@_instrument()
+def df2files(df, filepath_prefix, extension="", columns=None, overwriting=False, sep="=", archive_path=None,
+             num_threads=8):
     """
     Write each line/row of a DataFrame into individual file
     :param df: Panda DataFrame
@@ -1775,62 +4942,486 @@ def df2files(df, filepath_prefix, extension="", columns=None, overwriting=False,
     :param columns: list of column names or string
     :param overwriting: if True, the destination file will be overwritten
     :param sep: Separator character which is used when multiple columns exist in the Series
-    :return: None/Void
+    :param archive_path: If given (.zip, .tar, .tar.gz or .tgz), all files are written into this one archive
+    :param num_threads: Number of threads to write files
+    :return: Number of written files (or False if df is empty)
     #>>> df2files(queries_df, "test_", ".sql", ['extra_lines']) # generate a="xxxxx"
     #>>> df2files(queries_df, "test_", ".sql", "extra_lines")   # generate xxxxx
-    >>> pass
+    #>>> df2files(queries_df, "query_", ".sql", "extra_lines", archive_path="./queries.tar.gz")
+    >>> import tempfile; d = tempfile.mkdtemp()
+    >>> df2files(pd.DataFrame({"q": ["select 1", "select 2"]}), d + "/q_", ".sql", "q")
+    2
+    >>> df2files(pd.DataFrame({"q": ["select 1", "select 2"]}), d + "/q_", ".sql", "q")
+    0
     """
+    from concurrent.futures import ThreadPoolExecutor
     if len(df) < 1:
         return False
-    if type(columns) == type([]) and len(columns) > 0:
-        _df = df[columns]
-    else:
-        _df = df
-    for i, row in _df.iterrows():
-        if len(extension) > 0:
-            full_filepath = filepath_prefix + str(i) + "." + extension.lstrip(".")
+    _start = time()
+    contents = _df2file_contents(df, columns=columns, sep=sep)
+    suffix = ("." + extension.lstrip(".")) if len(extension) > 0 else ""
+    paths = (filepath_prefix + df.index.to_series().astype(str) + suffix).tolist()
+    contents = contents.tolist()
+    if bool(archive_path):
+        written = _write_archive(archive_path, [os.path.basename(p) for p in paths], contents)
+        _err("Wrote %d files into %s (%.2fs)" % (written, archive_path, time() - _start))
+        return written
+    written = 0
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for i, rs in enumerate(executor.map(_write_file, paths, contents, [overwriting] * len(paths))):
+            if rs:
+                written += 1
+            if (i + 1) % 10000 == 0:
+                _err("  Processed %d/%d files (%s) ..." % (i + 1, len(paths), _timestamp(format="%H:%M:%S")))
+    skipped = len(paths) - written
+    _err("Wrote %d files (skipped %d existing) with %s* (%.2fs)" % (
+        written, skipped, filepath_prefix, time() - _start))
+    return written
+
+
+def _find_files(filename):
+    """
+    Return file paths for a file name (or path) or *simple* glob pattern
+    :param filename: a file name (or path) or glob pattern
+    :return: A list of file paths (empty if no file found)
+    >>> _find_files("/no/such/file_ju_test")
+    []
+    """
+    if os.path.exists(filename):
+        return [filename]
+    files = _globr(filename)
+    return files if bool(files) else []
+
+
+def _files_fingerprint(patterns):
+    """
+    Return a list of (path, size, mtime) of the files found with the patterns (not reading the contents)
+    :param patterns: A list of file names or glob patterns
+    :return: A list of tuples
+    >>> _files_fingerprint(["/no/such/file_ju_test"])
+    []
+    """
+    items = []
+    for ptn in patterns:
+        for f in sorted(_find_files(ptn)):
+            st = os.stat(f)
+            items.append((f, st.st_size, st.st_mtime_ns))
+    return items
+
+
+def _stage_fingerprint(stage, fingerprints):
+    """
+    Return a fingerprint of a stage from its input files, parameters and upstream stages' fingerprints
+    :param stage: A stage dict (see _run_stages())
+    :param fingerprints: dict of stage name => fingerprint of already processed stages
+    :return: md5 hex string
+    >>> _stage_fingerprint({'name': 'a', 'params': (1,)}, {}) == _stage_fingerprint({'name': 'a', 'params': (1,)}, {})
+    True
+    >>> _stage_fingerprint({'name': 'a', 'params': (1,)}, {}) == _stage_fingerprint({'name': 'a', 'params': (2,)}, {})
+    False
+    """
+    import hashlib
+    key = repr((_files_fingerprint(stage.get('inputs', [])), stage.get('params'),
+                [fingerprints[a] for a in stage.get('after', [])]))
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def _sort_stages(stages):
+    """
+    Return the stages in a topological order (a stage comes after the stages in its 'after')
+    :param stages: A list of stage dicts
+    :return: A list of stage dicts
+    >>> [s['name'] for s in _sort_stages([{'name': 'b', 'after': ['a']}, {'name': 'a'}])]
+    ['a', 'b']
+    """
+    by_name = {s['name']: s for s in stages}
+    rtn = []
+    visiting = set()
+    for s in stages:
+        stack = [(s['name'], False)]
+        while len(stack) > 0:
+            (name, expanded) = stack.pop()
+            if name not in by_name:
+                raise ValueError('Unknown stage: %s' % (name))
+            if by_name[name] in rtn:
+                continue
+            if expanded:
+                visiting.discard(name)
+                rtn.append(by_name[name])
+                continue
+            if name in visiting:
+                raise ValueError('Stage %s is in a cycle' % (name))
+            visiting.add(name)
+            stack.append((name, True))
+            for a in reversed(by_name[name].get('after', [])):
+                if by_name.get(a) not in rtn:
+                    stack.append((a, False))
+    return rtn
+
+
+def _star_stage_job(args):
+    """
+    Execute one job of a stage in a worker (imap_unordered passes one argument only)
+    :param args: (stage name, job index, function object, arguments tuple)
+    :return: (stage name, job index, result or None, elapsed seconds, error string or None)
+    >>> _star_stage_job(('a', 0, max, (1, 2)))[:3]
+    ('a', 0, 2)
+    """
+    (name, idx, func_obj, func_args) = args
+    _start = time()
+    try:
+        return (name, idx, func_obj(*func_args), time() - _start, None)
+    except Exception as e:
+        return (name, idx, None, time() - _start, str(e))
+
+
+def _run_stages(stages, conn=None, num=None, force=False):
+    """
+    Run a DAG of stages. A stage is a dict:
+        name:    Unique stage name
+        inputs:  (optional) A list of file names or glob patterns. Used for the fingerprint
+        params:  (optional) Any repr-able object. Used for the fingerprint
+        after:   (optional) A list of stage names which this stage depends on
+        outputs: (optional) A list of table names. If one of them is missing, the stage runs again.
+                 Only the stages with outputs are cached. Others (eg: charts, display) always run
+        optional_outputs: (optional) A list of table names which the stage may not create (eg: depends on the
+                 log content, or rollup tables skipped for missing columns). Not checked for the cache
+        jobs:    (optional) A list of (function object, arguments tuple). Executed in a process pool, so
+                 these functions must not use the DB connection (eg: parsing a file)
+        run:     A function object which accepts (conn, job results list, results dict of all stages)
+    Jobs of all stages run concurrently, and each 'run' is executed in this (one) thread as soon as its jobs
+    and 'after' stages complete, as SQLite connection should be used by one writer.
+    If the fingerprint of the inputs is same as the previous run (and the outputs exist), the cached result is used.
+    :param stages: A list of stage dicts
+    :param conn: DB connection object
+    :param num: number of pool. if None, number of CPUs
+    :param force: If True, ignore the cache and run all stages
+    :return: dict of stage name => result of 'run'
+    >>> stages = [{'name': 'a', 'outputs': ['t_test_stage'], 'optional_outputs': ['t_test_not_created'],
+    ...            'jobs': [(max, (1, 2))],
+    ...            'run': lambda c, p, d: c.execute("CREATE TABLE IF NOT EXISTS t_test_stage (a)") and p[0]},
+    ...           {'name': 'b', 'after': ['a'], 'run': lambda c, p, d: d['a'] * 10}]
+    >>> _run_stages(stages, num=1)
+    {'a': 2, 'b': 20}
+    >>> _run_stages([dict(stages[1], run=lambda c, p, d: -1), dict(stages[0], run=lambda c, p, d: 0)], num=1)
+    {'a': 2, 'b': -1}
+    >>> _ = connect().execute("DROP TABLE t_test_stage")
+    """
+    global _STAGE_CACHE
+    if bool(conn) is False: conn = connect()
+    stages = _sort_stages(stages)
+    fingerprints = {}
+    results = {}
+    todo = []
+    for s in stages:
+        name = s['name']
+        fingerprints[name] = _stage_fingerprint(s, fingerprints)
+        cached = _STAGE_CACHE.get((id(conn), name))
+        if force is False and cached is not None and cached[0] == fingerprints[name] and bool(s.get('outputs')) and (
+                bool(cached[1]) is False or all(bool(_catalog_get(t, conn)) for t in s['outputs'])):
+            _err("Skipping stage %s (inputs unchanged)" % (name))
+            results[name] = cached[1]
         else:
-            full_filepath = filepath_prefix + str(i)
-        if overwriting is False and os.path.exists(full_filepath):
-            _err("%s exists. Skipping ..." % (full_filepath))
+            todo.append(s)
+    if len(todo) == 0:
+        return results
+
+    jobs_results = {s['name']: [None] * len(s.get('jobs', [])) for s in todo}
+    waiting = {s['name']: len(s.get('jobs', [])) for s in todo}
+    args_list = []
+    for s in todo:
+        for i, (func_obj, func_args) in enumerate(s.get('jobs', [])):
+            args_list.append((s['name'], i, func_obj, func_args))
+    if bool(num) is False:
+        num = mp.cpu_count()
+    num = min(num, len(args_list))
+    if num < 2:
+        results_iter = (_star_stage_job(args) for args in args_list)
+        pool = None
+    else:
+        # Loading (lazily imported) pandas before forking, so that each worker doesn't import it again
+        pd.DataFrame
+        pool = mp.Pool(processes=num)
+        results_iter = pool.imap_unordered(_star_stage_job, args_list)
+
+    def _run_ready():
+        for s in todo:
+            name = s['name']
+            if name in results or waiting[name] > 0 or any(a not in results for a in s.get('after', [])):
+                continue
+            _start = time()
+            try:
+                with _perf("stage:" + name):
+                    results[name] = s['run'](conn, jobs_results[name], results)
+                if bool(s.get('outputs')):
+                    _STAGE_CACHE[(id(conn), name)] = (fingerprints[name], results[name])
+            except Exception as e:
+                _err("ERROR: stage %s failed: %s" % (name, str(e)))
+                results[name] = False
+                _STAGE_CACHE.pop((id(conn), name), None)
+            _err("Stage %s completed (%.2fs)" % (name, time() - _start))
+
+    try:
+        # Stages without jobs can run while the workers are parsing
+        _run_ready()
+        for (name, idx, rs, job_sec, error) in results_iter:
+            if pool is not None:
+                _add_metric("job:" + name, round(job_sec * 1000, 3), rows=_rows_of(rs), error=error, in_worker=True)
+            if bool(error):
+                _err("WARN: stage %s job %d failed (%.2fs): %s" % (name, idx, job_sec, str(error)))
+            jobs_results[name][idx] = rs
+            waiting[name] -= 1
+            if waiting[name] == 0:
+                _run_ready()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    _run_ready()
+    return results
+
+
+def _log_jobs(filename, line_beginning, line_matching, num_cols, max_file_num=10, max_file_size=(1024 * 1024 * 100),
+              epoch_col=None):
+    """
+    Return the jobs (for _run_stages()) which read log files with _read_file_and_search(), one job per file
+    :param filename: a file name (or path) or *simple* glob pattern
+    :param line_beginning: To detect the beginning of the log entry
+    :param line_matching: A group matching regex to separate one log lines into columns
+    :param num_cols: Number of columns
+    :param max_file_num: To avoid memory issue, setting max files to import
+    :param max_file_size: To avoid memory issue, setting max file size per file
+    :param epoch_col: (optional) Index of the date/time column to append UTC epoch milliseconds
+    :return: A list of (function object, arguments tuple)
+    >>> _log_jobs("/no/such/file_ju_test", "^.", "(.+)", 1)
+    []
+    """
+    files = _find_files(filename)
+    if len(files) > max_file_num:
+        raise ValueError('Glob: %s returned too many files (%s)' % (filename, str(len(files))))
+    jobs = []
+    for f in files:
+        if os.stat(f).st_size >= max_file_size:
+            _err("WARN: File %s (%d MB) is too large (max_file_size=%d)" % (
+                str(f), int(os.stat(f).st_size / 1024 / 1024), max_file_size))
             continue
-        _err("Writing index=%s into %s ..." % (str(i), full_filepath))
-        with open(full_filepath, 'w') as f2:
-            if type(columns) == type('a'):
-                f2.write(row[columns])
-            else:
-                f2.write(row.to_csv(sep=sep))
+        jobs.append((_read_file_and_search, (f, line_beginning, line_matching, None, None, num_cols, True, 0, 0,
+                                             epoch_col)))
+    return jobs
 
 
-def analyse_logs(start_isotime=None, end_isotime=None, elapsed_time=0, tail_num=10000):
+def _tuples2table(conn, tablename, col_names, tuples_list, appending=False, epoch=False):
     """
-    A prototype function to analyse log files (expecting request.log converted to request.csv)
-    TODO: cleanup later
-    :param start_isotime:
-    :param end_isotime:
-    :param elapsed_time:
-    :param tail_num:
-    :return: void
-    >>> pass    # test should be done in each function
+    Save the results of _read_file_and_search() into one table (all columns are TEXT), same as logs2table()
+    :param conn: DB connection object
+    :param tablename: Table name
+    :param col_names: A list of column names
+    :param tuples_list: A list of lists of tuples (None is ignored)
+    :param appending: default is False. If False, use 'DROP TABLE IF EXISTS'
+    :param epoch: If True, the tuples have the extra epoch_ms value (_read_file_and_search(epoch_col=N))
+    :return: True if no error
+    >>> c = connect(); _tuples2table(c, "t_test_tuples", ["a", "b"], [[("1", "x")], None, [("2", "y")]])
+    True
+    >>> c.execute("SELECT count(*) FROM t_test_tuples").fetchall()[0][0]
+    2
+    >>> _ = c.execute("DROP TABLE t_test_tuples")
     """
-    ## Audit json if exist
-    _ = json2df('audit.json', tablename="t_audit_logs", json_cols=['attributes', 'data'], conn=connect())
+    if appending is False:
+        conn.execute("DROP TABLE IF EXISTS %s" % (tablename))
+    col_def_str = ", ".join("%s TEXT" % (c) for c in col_names)
+    if epoch:
+        col_def_str += ", epoch_ms INTEGER"
+    conn.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (tablename, col_def_str))
+    if appending is False:
+        _catalog_update(tablename, conn, rows=0)
+        _rollup_reset(tablename, conn)
+    for tuples in tuples_list:
+        if bool(tuples) is False:
+            continue
+        res = _insert2table(conn=conn, tablename=tablename, tpls=tuples)
+        if bool(res) is False:
+            return res
+    _autocomp_inject(tablename=tablename, conn=conn)
+    return True
 
-    ## Request.*csv* exists, use that (because it's faster), if not, logs2table, which is slower.
-    result = csv2df('request.csv', tablename="t_request_logs", conn=connect())
-    if bool(result) is False:
-        (col_names, line_matching) = _gen_regex_for_request_logs('request.log')
-        result = logs2table('request.log', tablename="t_request_logs", col_names=col_names, line_beginning="^.",
-                            line_matching=line_matching)
-    if bool(result):
-        where_sql = "WHERE 1=1"
-        if bool(elapsed_time) is True:
-            where_sql += " AND elapsedTime >= %d" % (elapsed_time)
-        if bool(start_isotime) is True:
-            where_sql += " AND UDF_STR2SQLDT(`date`, '%d/%b/%Y:%H:%M:%S %z') >= UDF_STR2SQLDT('" + start_isotime + " +0000','%Y-%m-%d %H:%M:%S %z')"
-        if bool(end_isotime) is True:
-            where_sql += " AND UDF_STR2SQLDT(`date`, '%d/%b/%Y:%H:%M:%S %z') <= UDF_STR2SQLDT('" + end_isotime + " +0000','%Y-%m-%d %H:%M:%S %z')"
-        query = """SELECT UDF_REGEX('(\d\d/[a-zA-Z]{3}/20\d\d:\d\d)', `date`, 1) AS date_hour, statusCode,
+
+def _stage_audit_logs(conn, jobs_results, results):
+    """
+    analyse_logs() stage: save the DataFrames parsed from audit.json into t_audit_logs
+    >>> _stage_audit_logs(None, [], {})
+    False
+    """
+    dfs = [r[1] for r in jobs_results if r is not None and r[1] is not None]
+    if len(dfs) == 0:
+        return False
+    return _json_df2table(pd.concat(dfs, sort=False), conn=conn, tablename="t_audit_logs",
+                          json_cols=['attributes', 'data'])
+
+
+def _stage_request_logs(conn, jobs_results, results, kind=None, file_path=None, col_names=None):
+    """
+    analyse_logs() stage: save request.csv (parsed DataFrame or large file) or request.log into t_request_logs
+    >>> _stage_request_logs(None, [], {})
+    False
+    """
+    if kind == 'csv' and len(jobs_results) > 0 and jobs_results[0] is not None and jobs_results[0][1] is not None:
+        df = jobs_results[0][1]
+        # UTC epoch milliseconds at ingest, so that the charts don't parse `date` per row
+        if 'date' in df.columns:
+            df['epoch_ms'] = _to_epoch_ms(df['date'].astype(object))
+        _df2table(df, conn=conn, tablename="t_request_logs")
+        _autocomp_inject(tablename="t_request_logs", conn=conn)
+        return len(df) > 0
+    if kind == 'large_csv':
+        # Streaming with the chunked reader, so not in a worker
+        return csv2df(file_path, conn=conn, tablename="t_request_logs", epoch_col='date')
+    if kind == 'log' and len(jobs_results) > 0:
+        return _tuples2table(conn, "t_request_logs", col_names, jobs_results, epoch=('date' in col_names))
+    return False
+
+
+def _stage_app_logs(conn, jobs_results, results, kinds=[]):
+    """
+    analyse_logs() stage: save the tuples parsed from application logs into t_logs
+    As before, if both nexus.log and *server.log exist, the latter replaces the table
+    While the tuples are in memory, HealthMonitor lines of nexus.log are saved into t_health_monitor (kv2table)
+    :param kinds: A list of (kind, col_names, number of jobs), in the same order as the jobs
+    :return: dict of kind => True if the log was loaded (and 'health_monitor')
+    >>> _stage_app_logs(None, [], {}, kinds=[('nxrm', [], 0)])
+    {'health_monitor': False, 'nxrm': False}
+    """
+    rtn = {'health_monitor': False}
+    i = 0
+    for (kind, col_names, n) in kinds:
+        rtn[kind] = False
+        if n > 0:
+            rtn[kind] = _tuples2table(conn, "t_logs", col_names, jobs_results[i:i + n], epoch=True)
+            if kind == 'nxrm' and bool(rtn[kind]):
+                rtn['health_monitor'] = _health_monitor2table(conn, col_names, jobs_results[i:i + n])
+        i += n
+    return rtn
+
+
+def _health_monitor2table(conn, col_names, tuples_list):
+    """
+    Save Hazelcast HealthMonitor lines (from _read_file_and_search() tuples with epoch_ms) into t_health_monitor
+    :param conn: DB connection object
+    :param col_names: A list of column names of the tuples (without epoch_ms)
+    :param tuples_list: A list of lists of tuples (None is ignored)
+    :return: True if t_health_monitor was created
+    >>> _health_monitor2table(None, ['date_time', 'loglevel', 'class', 'message'], [[('2020', 'INFO', 'x', 'a=1', 1)]])
+    False
+    """
+    global _HAZEL_HEALTH_CLASS
+    global _HAZEL_HEALTH_HEAD
+    if any(c not in col_names for c in ['date_time', 'loglevel', 'class', 'message']):
+        return False
+    (i_lvl, i_cls, i_msg) = (col_names.index('loglevel'), col_names.index('class'), col_names.index('message'))
+    rows = [(t[0], t[-1], t[i_msg]) for tuples in tuples_list if bool(tuples) for t in tuples if
+            t[i_cls] == _HAZEL_HEALTH_CLASS and t[i_lvl] == 'INFO']
+    if len(rows) == 0:
+        return False
+    _err("Generating t_health_monitor (%d lines) ..." % (len(rows)))
+    df_hm = pd.DataFrame(rows, columns=['date_time', 'epoch_ms', 'message'])
+    kv2table(df_hm, conn=conn, tablename="t_health_monitor", head=_HAZEL_HEALTH_HEAD)
+    return True
+
+
+def _isotime2ms(isotime):
+    """
+    Convert 'YYYY-MM-DD hh:mm:ss' (UTC) to epoch milliseconds
+    :param isotime: 'YYYY-MM-DD hh:mm:ss' string
+    :return: Integer
+    >>> _isotime2ms("2020-01-03 06:00:00")
+    1578031200000
+    """
+    ms = _to_epoch_ms([isotime], fmt='%Y-%m-%d %H:%M:%S')[0]
+    if pd.isna(ms):
+        raise ValueError("Not 'YYYY-MM-DD hh:mm:ss' (UTC): %s" % (str(isotime)))
+    return int(ms)
+
+
+def _logs_where_sql(start_isotime=None, end_isotime=None, col="epoch_ms", bucket_sec=None):
+    """
+    Return WHERE clause of the time window for analyse_logs() charts. start/end_isotime are UTC, and compared with
+    the UTC epoch_ms column of the loaded tables, or bucket_ms of the rollup tables (the buckets overlapping the
+    window, so that the partial first bucket is included)
+    Tables loaded by older versions don't have epoch_ms, then date_time strings are compared (col="date_time")
+    :param start_isotime: 'YYYY-MM-DD hh:mm:ss' (UTC)
+    :param end_isotime: 'YYYY-MM-DD hh:mm:ss' (UTC)
+    :param col: epoch_ms, bucket_ms (with bucket_sec) or date_time
+    :param bucket_sec: Bucket size in seconds of the rollup table, if col is bucket_ms
+    :return: String
+    >>> _logs_where_sql("2020-01-03 06:30:00", col="bucket_ms", bucket_sec=3600)
+    'WHERE 1=1 AND bucket_ms + 3600000 > 1578033000000'
+    >>> _logs_where_sql("2020-01-01 00:00:00", col="date_time")
+    "WHERE 1=1 AND date_time >= '2020-01-01 00:00:00'"
+    """
+    where_sql = "WHERE 1=1"
+    if bool(start_isotime) is True:
+        if col == "date_time":
+            where_sql += " AND " + col + " >= '" + start_isotime + "'"
+        elif bool(bucket_sec):
+            where_sql += " AND %s + %d > %d" % (col, int(bucket_sec) * 1000, _isotime2ms(start_isotime))
+        else:
+            where_sql += " AND %s >= %d" % (col, _isotime2ms(start_isotime))
+    if bool(end_isotime) is True:
+        if col == "date_time":
+            where_sql += " AND " + col + " <= '" + end_isotime + "'"
+        else:
+            where_sql += " AND %s <= %d" % (col, _isotime2ms(end_isotime))
+    return where_sql
+
+
+def _rollup_bucket_sec(rollup_tablename, default=3600):
+    """
+    Return bucket_sec of a registered rollup table
+    >>> _rollup_bucket_sec("t_logs_hourly")
+    3600
+    """
+    global _ROLLUPS
+    for specs in _ROLLUPS.values():
+        for spec in specs:
+            if spec['name'] == rollup_tablename:
+                return spec['bucket_sec']
+    return default
+
+
+def _stage_request_charts(conn, jobs_results, results, start_isotime=None, end_isotime=None, elapsed_time=0,
+                          tail_num=10000):
+    """
+    analyse_logs() stage: display/draw t_request_logs
+    >>> _stage_request_charts(None, [], {'request_logs': False})
+    False
+    """
+    if bool(results.get('request_logs')) is False:
+        return False
+    # epoch_ms (UTC) is stored at ingest. Tables loaded by older versions need to parse `date` per row
+    has_epoch = 'epoch_ms' in _catalog_get('t_request_logs', conn).get('columns', [])
+    where_sql = "WHERE 1=1"
+    if bool(elapsed_time) is True:
+        where_sql += " AND elapsedTime >= %d" % (elapsed_time)
+    for (isotime, op) in [(start_isotime, ">="), (end_isotime, "<=")]:
+        if bool(isotime) is False:
+            continue
+        if has_epoch:
+            where_sql += " AND epoch_ms %s %d" % (op, _isotime2ms(isotime))
+        else:
+            where_sql += " AND UDF_STR2SQLDT(`date`, '%d/%b/%Y:%H:%M:%S %z') " + op + " UDF_STR2SQLDT('" + isotime + " +0000','%Y-%m-%d %H:%M:%S %z')"
+    # The hourly rollup is maintained while loading, so no need to aggregate t_request_logs (unless elapsed_time)
+    if bool(elapsed_time) is False and bool(_catalog_get('t_request_logs_hourly', conn)):
+        sql = """SELECT bucket AS date_hour, statusCode,
+    CAST(MAX(elapsedTime_max) AS INT) AS max_elaps,
+    CAST(MIN(elapsedTime_min) AS INT) AS min_elaps,
+    CAST(SUM(elapsedTime_sum) / SUM(cnt) AS INT) AS avg_elaps,
+    CAST(SUM(bytesSent_sum) / SUM(cnt) AS INT) AS avg_bytes,
+    SUM(cnt) AS occurrence
+FROM t_request_logs_hourly
+%s
+GROUP BY 1, 2""" % (_logs_where_sql(start_isotime, end_isotime, col="bucket_ms",
+                                    bucket_sec=_rollup_bucket_sec('t_request_logs_hourly')))
+    else:
+        sql = """SELECT %s AS date_hour, statusCode,
     CAST(MAX(CAST(elapsedTime AS INT)) AS INT) AS max_elaps, 
     CAST(MIN(CAST(elapsedTime AS INT)) AS INT) AS min_elaps, 
     CAST(AVG(CAST(elapsedTime AS INT)) AS INT) AS avg_elaps, 
@@ -1838,112 +5429,165 @@ def analyse_logs(start_isotime=None, end_isotime=None, elapsed_time=0, tail_num=
     count(*) AS occurrence
 FROM t_request_logs
 %s
-GROUP BY 1, 2""" % (where_sql)
-        name = "request_log-hourly_aggs"
-        _err("Query (%s): \n%s" % (name, query))
-        display(q(query), name=name)
-        query = """SELECT UDF_STR2SQLDT(`date`, '%%d/%%b/%%Y:%%H:%%M:%%S %%z') AS date_time, 
+GROUP BY 1, 2""" % ("STRFTIME('%Y-%m-%d %H:00:00', epoch_ms / 1000, 'unixepoch')" if has_epoch else
+                    "UDF_REGEX('(\d\d/[a-zA-Z]{3}/20\d\d:\d\d)', `date`, 1)", where_sql)
+    name = "request_log-hourly_aggs"
+    _err("Query (%s): \n%s" % (name, sql))
+    display(query(sql, conn=conn), name=name)
+    sql = """SELECT %s AS date_time, 
     CAST(statusCode AS INTEGER) AS statusCode, 
     CAST(bytesSent AS INTEGER) AS bytesSent, 
     CAST(elapsedTime AS INTEGER) AS elapsedTime 
-FROM t_request_logs %s""" % (where_sql)
-        name = "request_log-status_bytesent_elapsed"
-        _err("Query (%s): \n%s" % (name, query))
-        draw(q(query).tail(tail_num), name=name)
+FROM t_request_logs %s""" % ("STRFTIME('%Y-%m-%d %H:%M:%S', epoch_ms / 1000, 'unixepoch')" if has_epoch else
+                             "UDF_STR2SQLDT(`date`, '%d/%b/%Y:%H:%M:%S %z')", where_sql)
+    name = "request_log-status_bytesent_elapsed"
+    _err("Query (%s): \n%s" % (name, sql))
+    draw(query(sql, conn=conn).tail(tail_num), name=name)
+    return True
 
-    ## Loading application log file(s) into database.
-    (col_names, line_matching) = _gen_regex_for_app_logs('nexus.log')
-    nxrm_logs = logs2table('nexus.log', tablename="t_logs", col_names=col_names, line_matching=line_matching)
-    (col_names, line_matching) = _gen_regex_for_app_logs('*server.log')
-    nxiq_logs = logs2table('*server.log', tablename="t_logs", col_names=col_names, line_matching=line_matching)
-
-    # Hazelcast health monitor
-    # if "health_monitor.json" exists:
-    #   result = ju.json2df('health_monitor.json', tablename="t_health_monitor", conn=ju.connect())
-    #   query = """select date_time, xxxx from t_health_monitor"""
-    #   ju.draw(ju.q(query))
-    if bool(nxrm_logs):
-        _err("Generating t_health_monitor from t_logs ...")
-        df_hm = q("""select date_time, message from t_logs
-    where loglevel = 'INFO'
-    and class = 'com.hazelcast.internal.diagnostics.HealthMonitor'""")
-        if len(df_hm) > 0:
-            (col_names, line_matching) = _gen_regex_for_hazel_health(df_hm['message'][1])
-            msg_ext = df_hm['message'].str.extract(line_matching)
-            msg_ext.columns = col_names
-            # Delete unnecessary column(s), then left join the extracted dataframe, then load into SQLite
-            df_hm.drop(columns=['message']).join(msg_ext).to_sql(name="t_health_monitor", con=connect(), chunksize=1000,
-                                                                 if_exists='replace', schema=_DB_SCHEMA)
-            _autocomp_inject(tablename='t_health_monitor')
-            where_sql = "WHERE 1=1"
-            if bool(start_isotime) is True:
-                where_sql += " AND date_time >= '" + start_isotime + "'"
-            if bool(end_isotime) is True:
-                where_sql += " AND date_time <= '" + end_isotime + "'"
-            query = """select date_time
-    , UDF_STR_TO_INT(`physical.memory.free`) as sys_mem_free_bytes
-    --, UDF_STR_TO_INT(`swap.space.free`) as swap_free_bytes
-    , CAST(`swap.space.free` AS INTEGER) as swap_free_bytes
-    , UDF_STR_TO_INT(`heap.memory.used/max`) as heap_used_percent
-    , CAST(`major.gc.count` AS INTEGER) as majour_gc_count
-    , UDF_STR_TO_INT(`major.gc.time`) as majour_gc_msec
-    , CAST(`load.process` AS REAL) as load_proc_percent
-    , CAST(`load.system` AS REAL) as load_sys_percent
-    , CAST(`load.systemAverage` AS REAL) as load_system_avg
-    , CAST(`thread.count` AS INTEGER) as thread_count
-    , CAST(`connection.active.count` AS INTEGER) as node_conn_count
+
+def _stage_health_monitor_chart(conn, jobs_results, results, start_isotime=None, end_isotime=None):
+    """
+    analyse_logs() stage: draw t_health_monitor
+    >>> _stage_health_monitor_chart(None, [], {'app_logs': {'health_monitor': False}})
+    False
+    """
+    if bool(results.get('app_logs')) is False or bool(results['app_logs'].get('health_monitor')) is False:
+        return False
+    # t_health_monitor columns are already typed (bytes, percent, msec) by kv2table()
+    # As the keys depend on the Hazelcast version, only existing columns are selected
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(t_health_monitor)").fetchall()]
+    select_str = "".join("\n    , %s as %s" % (c, a) for (c, a) in [
+        ('physical_memory_free', 'sys_mem_free_bytes'), ('swap_space_free', 'swap_free_bytes'),
+        ('heap_memory_used_max', 'heap_used_percent'), ('major_gc_count', 'majour_gc_count'),
+        ('major_gc_time', 'majour_gc_msec'), ('load_process', 'load_proc_percent'),
+        ('load_system', 'load_sys_percent'), ('load_systemAverage', 'load_system_avg'),
+        ('thread_count', 'thread_count'), ('connection_active_count', 'node_conn_count')] if c in cols)
+    # Filter and show in UTC, same as the other charts
+    dt_str = "date_time"
+    where_sql = _logs_where_sql(start_isotime, end_isotime, col="date_time")
+    if 'epoch_ms' in cols:
+        dt_str = "STRFTIME('%Y-%m-%d %H:%M:%S', epoch_ms / 1000, 'unixepoch') as date_time"
+        where_sql = _logs_where_sql(start_isotime, end_isotime)
+    sql = """select %s%s
 FROM t_health_monitor
-%s""" % (where_sql)
-            name = "nexus_health_monitor"
-            _err("Query (%s): \n%s" % (name, query))
-            draw(q(query), name=name)
-
-    # Nexus IQ
-    if bool(nxiq_logs):
-        # below queries are not so good, so not executing at this moment.
-        query = """SELECT thread, min(date_time), max(date_time), 
-    STRFTIME('%s', UDF_REGEX('(\d\d\d\d-\d\d-\d\d.\d\d:\d\d:\d\d.\d+)', max(date_time), 1))
-  - STRFTIME('%s', UDF_REGEX('(\d\d\d\d-\d\d-\d\d.\d\d:\d\d:\d\d.\d+)', min(date_time), 1)) as diff,
-    count(*)
-FROM t_logs
-WHERE thread LIKE 'PolicyEvaluateService%'
-GROUP BY 1
-ORDER BY diff, thread"""
-        name = "nxiq_log-policy_scan_aggs"
-        # _err("Query (%s): \n%s" % (name,query))
-        # display(q(query), name=name)
-        query = """SELECT date_time, 
-  UDF_REGEX(' in (\d+) ms', message, 1) as ms,
-  UDF_REGEX('ms. (\d+)$', message, 1) as status
-FROM t_logs
-WHERE t_logs.class = 'com.sonatype.insight.brain.hds.HdsClient'
-  AND t_logs.message LIKE 'Completed request%'"""
-        name = "nxiq_log-hdfsclient_results"
-        # _err("Query (%s): \n%s" % (name,query))
-        # display(q(query), name=name)
+%s""" % (dt_str, select_str, where_sql)
+    name = "nexus_health_monitor"
+    _err("Query (%s): \n%s" % (name, sql))
+    draw(query(sql, conn=conn), name=name)
+    return True
+
 
-        query = """SELECT date_time, thread,
+def _stage_nxiq_report(conn, jobs_results, results):
+    """
+    analyse_logs() stage: display the slowest policy evaluations from the Nexus IQ log
+    >>> _stage_nxiq_report(None, [], {'app_logs': {'nxiq': False}})
+    False
+    """
+    if bool(results.get('app_logs')) is False or bool(results['app_logs'].get('nxiq')) is False:
+        return False
+    # TODO: policy scan aggs (PolicyEvaluateService) and HdsClient results are not so good, so not executing.
+    sql = """SELECT date_time, thread,
     UDF_REGEX(' scan id ([^ ]+),', message, 1) as scan_id,
     CAST(UDF_REGEX(' in (\d+) ms', message, 1) as INT) as ms 
 FROM t_logs
 WHERE t_logs.message like 'Evaluated policy for%'
 ORDER BY ms DESC
 LIMIT 10"""
-        name = "nxiq_log-top10_slow_scan"
-        _err("Query (%s): \n%s" % (name, query))
-        display(q(query), name="nxiq_log-top10_slow_scan")
+    name = "nxiq_log-top10_slow_scan"
+    _err("Query (%s): \n%s" % (name, sql))
+    display(query(sql, conn=conn), name=name)
+    return True
 
-    if bool(nxrm_logs) or bool(nxiq_logs):
-        ## analyse t_logs table (eg: cout ERROR|WARN)
-        query = """SELECT UDF_REGEX('(\d\d\d\d-\d\d-\d\d.\d\d)', date_time, 1) as date_hour, loglevel, count(1) 
+
+def _stage_warn_error_chart(conn, jobs_results, results, start_isotime=None, end_isotime=None):
+    """
+    analyse_logs() stage: draw the number of WARN/ERROR (not TRACE/DEBUG/INFO) per hour in t_logs
+    >>> _stage_warn_error_chart(None, [], {'app_logs': {}})
+    False
+    """
+    if bool(results.get('app_logs')) is False or any(results['app_logs'].values()) is False:
+        return False
+    if bool(_catalog_get('t_logs_hourly', conn)):
+        # Pre-aggregated while loading t_logs (bucket is UTC)
+        sql = """SELECT bucket as date_hour, loglevel, SUM(cnt) 
+    FROM t_logs_hourly
+    %s
+      AND loglevel NOT IN ('TRACE', 'DEBUG', 'INFO')
+    GROUP BY 1, 2""" % (_logs_where_sql(start_isotime, end_isotime, col="bucket_ms",
+                                        bucket_sec=_rollup_bucket_sec('t_logs_hourly')))
+    elif 'epoch_ms' in _catalog_get('t_logs', conn).get('columns', []):
+        # Same UTC hours as t_logs_hourly
+        sql = """SELECT STRFTIME('%%Y-%%m-%%d %%H:00:00', epoch_ms / 1000, 'unixepoch') as date_hour, loglevel, count(1) 
+    FROM t_logs
+    %s
+      AND loglevel NOT IN ('TRACE', 'DEBUG', 'INFO')
+    GROUP BY 1, 2""" % (_logs_where_sql(start_isotime, end_isotime))
+    else:
+        sql = """SELECT UDF_REGEX('(\d\d\d\d-\d\d-\d\d.\d\d)', date_time, 1) as date_hour, loglevel, count(1) 
     FROM t_logs
     %s
       AND loglevel NOT IN ('TRACE', 'DEBUG', 'INFO')
-    GROUP BY 1, 2""" % (where_sql)
-        name = "warn_error_hourly"
-        _err("Query (%s): \n%s" % (name, query))
-        draw(q(query), name=name)
+    GROUP BY 1, 2""" % (_logs_where_sql(start_isotime, end_isotime, col="date_time"))
+    name = "warn_error_hourly"
+    _err("Query (%s): \n%s" % (name, sql))
+    draw(query(sql, conn=conn), name=name)
+    return True
+
 
+def _analyse_logs_stages(start_isotime=None, end_isotime=None, elapsed_time=0, tail_num=10000):
+    """
+    Return the stages (DAG) of analyse_logs()
+    audit_logs, request_logs, app_logs (load, and t_health_monitor) -> charts
+    :return: A list of stage dicts for _run_stages()
+    >>> [s['name'] for s in _sort_stages(_analyse_logs_stages())][:3]
+    ['audit_logs', 'request_logs', 'app_logs']
+    """
+    global _CSV_CHUNK_THRESHOLD
+    stages = [{'name': 'audit_logs', 'inputs': ['audit.json'], 'outputs': ['t_audit_logs'],
+               'jobs': [(_load_file_worker, (json2df, f)) for f in _find_files('audit.json')],
+               'run': _stage_audit_logs}]
+
+    ## Request.*csv* exists, use that (because it's faster), if not, request.log, which is slower.
+    req_csvs = _find_files('request.csv')
+    if len(req_csvs) > 0 and os.stat(req_csvs[0]).st_size < _CSV_CHUNK_THRESHOLD:
+        req_kwargs = {'kind': 'csv'}
+        req_jobs = [(_load_file_worker, (csv2df, req_csvs[0]))]
+    elif len(req_csvs) > 0:
+        req_kwargs = {'kind': 'large_csv', 'file_path': req_csvs[0]}
+        req_jobs = []
+    else:
+        (col_names, line_matching) = _gen_regex_for_request_logs('request.log')
+        req_kwargs = {'kind': 'log', 'col_names': col_names}
+        req_jobs = _log_jobs('request.log', "^.", line_matching, len(col_names),
+                             epoch_col=col_names.index('date') if 'date' in col_names else None) if bool(
+            col_names) else []
+    stages.append({'name': 'request_logs', 'inputs': ['request.csv', 'request.log'], 'outputs': ['t_request_logs'],
+                   'optional_outputs': ['t_request_logs_hourly'],
+                   'jobs': req_jobs, 'run': lambda c, j, r: _stage_request_logs(c, j, r, **req_kwargs)})
+
+    ## Loading application log file(s) into database.
+    app_jobs = []
+    app_kinds = []
+    for (kind, filename) in [('nxrm', 'nexus.log'), ('nxiq', '*server.log')]:
+        (col_names, line_matching) = _gen_regex_for_app_logs(filename)
+        jobs = _log_jobs(filename, "^\d\d\d\d-\d\d-\d\d", line_matching, len(col_names),
+                         epoch_col=0) if bool(col_names) else []
+        app_jobs += jobs
+        app_kinds.append((kind, col_names, len(jobs)))
+    stages.append({'name': 'app_logs', 'inputs': ['nexus.log', '*server.log'],
+                   'outputs': ['t_logs'], 'optional_outputs': ['t_logs_hourly', 't_health_monitor'],
+                   'jobs': app_jobs, 'run': lambda c, j, r: _stage_app_logs(c, j, r, kinds=app_kinds)})
+
+    stages.append({'name': 'request_charts', 'after': ['request_logs'],
+                   'params': (start_isotime, end_isotime, elapsed_time, tail_num),
+                   'run': lambda c, j, r: _stage_request_charts(c, j, r, start_isotime, end_isotime, elapsed_time,
+                                                                tail_num)})
+    stages.append({'name': 'health_monitor_chart', 'after': ['app_logs'], 'params': (start_isotime, end_isotime),
+                   'run': lambda c, j, r: _stage_health_monitor_chart(c, j, r, start_isotime, end_isotime)})
+    stages.append({'name': 'nxiq_report', 'after': ['app_logs'], 'run': _stage_nxiq_report})
+    stages.append({'name': 'warn_error_chart', 'after': ['app_logs'], 'params': (start_isotime, end_isotime),
+                   'run': lambda c, j, r: _stage_warn_error_chart(c, j, r, start_isotime, end_isotime)})
     # TODO: analyse db job triggers
     # q("""SELECT description, fireInstanceId
     # , nextFireTime
@@ -1956,6 +5600,29 @@ LIMIT 10"""
     #  AND nextFireTime > 1578290830000
     # ORDER BY nextFireTime
     # """)
+    return stages
+
+
+@_instrument()
+def analyse_logs(start_isotime=None, end_isotime=None, elapsed_time=0, tail_num=10000, num=None, force=False):
+    """
+    A prototype function to analyse log files (expecting request.log converted to request.csv)
+    Files are parsed concurrently (see _analyse_logs_stages() and _run_stages()), and re-running this function
+    executes only the stages which input files or parameters were changed.
+    TODO: cleanup later
+    :param start_isotime: 'YYYY-MM-DD hh:mm:ss' in UTC. All charts filter with the UTC epoch_ms (bucket_ms of the
+                          rollup tables), and show UTC date times
+    :param end_isotime: 'YYYY-MM-DD hh:mm:ss' in UTC
+    :param elapsed_time:
+    :param tail_num:
+    :param num: number of pool. if None, number of CPUs
+    :param force: If True, run all stages even if the inputs are not changed
+    :return: void
+    >>> pass    # test should be done in each function
+    """
+    _run_stages(_analyse_logs_stages(start_isotime=start_isotime, end_isotime=end_isotime,
+                                     elapsed_time=elapsed_time, tail_num=tail_num), conn=connect(), num=num,
+                force=force)
     _err("Completed.")
 
 
@@ -2060,7 +5727,7 @@ def help(func_name=None):
     for attr_str in dir(ju):
         if attr_str.startswith("_"): continue
         # TODO: no idea why those functions matches if condition.
-        if attr_str in ['create_engine', 'datetime', 'help']: continue
+        if attr_str in ['datetime', 'help']: continue
         m = getattr(ju, attr_str, None)
         if callable(m) and hasattr(m, '__doc__') and bool(m.__doc__):
             print("    " + attr_str)